@@ -1,51 +1,50 @@
 import os
 import re
 import json
+import math
 import time
 import secrets
-import requests
-import traceback
+import functools
+import threading
 from flask_cors import CORS
 from flask_mqtt import Mqtt
-from datetime import timedelta, datetime
+from datetime import timedelta, datetime, timezone
+from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import select, func, CheckConstraint, ForeignKey, Index
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import relationship
-from flask import Flask, request, jsonify, make_response
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import select, update, func, and_, or_, text, column, CheckConstraint, ForeignKey, Index
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import aliased, relationship
+from flask import Flask, Blueprint, Response, current_app, g, request, jsonify, make_response, send_file, stream_with_context
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity, unset_jwt_cookies, set_access_cookies, verify_jwt_in_request
 from flask_jwt_extended.exceptions import NoAuthorizationError
 from utils.email import send_registration_email, send_fingerprint_action_email
 from utils.topic import topic
-
+from utils.export import EXPORT_FORMATS, export_stream
+from utils.migrations import run_migrations
+from utils.search import fts_match_query, like_pattern
+from utils.payload import parse_payload, payload_text, extract_fields
+from utils.passwords import PasswordHasher, HashingBusy
+from utils.ratelimit import TokenBucketLimiter
+from utils.http import http_session
+from utils.phash import HammingIndex, HashWorker, hamming, to_signed, to_unsigned
+from utils.anomaly import AccessAnomalyModel
+from utils.coalesce import DeviceCommandScheduler, HELD
+from utils.publisher import AckPublisher
+from utils.digest import EventDigester
+from utils.querystats import QueryStats
+from utils.spool import Spool, SpoolReplayer
+from utils.blobstore import BlobStore
+from utils.images import ImagePool, JPEG_MAGIC, parse_variants, render_variants
+from utils.timelapse import MJPEG_BOUNDARY, prefetch, mjpeg_stream
+from utils.cursor import encode_cursor, decode_cursor, merge_desc
+from utils.profiling import Profiler
+from utils.snapshot import SnapshotCache
+from utils.devicestate import DeviceStateStore
+from utils.timers import TimerHeap, next_weekly, parse_time_of_day, weekday_mask
+from utils.logpipe import parse_sample_rates, setup_logging
+from utils.timeindex import TimestampIndex
 load_dotenv()
-app = Flask(__name__)
-
-CORS(app, resources={r"/api/*": {"origins": os.getenv('FRONT_END_URL')}}, supports_credentials=True)
-
-BACK_END_PORT = int(os.getenv('BACK_END_PORT', '8000'))
-
-app.config['BACK_END_PORT'] = BACK_END_PORT
-
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URI', 'sqlite:///mydb.sqlite')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-app.config['JWT_TOKEN_LOCATION'] = ['cookies']
-app.config['JWT_ACCESS_COOKIE_PATH'] = '/api/'
-app.config['JWT_COOKIE_SECURE'] = False        # True if HTTPS
-app.config['JWT_COOKIE_SAMESITE'] = 'Lax'
-app.config['JWT_COOKIE_CSRF_PROTECT'] = False
-app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY')
-ttl_seconds = int(os.getenv('JWT_ACCESS_TOKEN_EXPIRES', '3600'))
-app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(seconds=ttl_seconds)
-
-app.config['MQTT_BROKER_URL'] = os.getenv('MQTT_BROKER_URL')
-app.config['MQTT_BROKER_PORT'] = int(os.getenv('MQTT_BROKER_PORT', 1883))
-app.config['MQTT_KEEPALIVE'] = 60
-
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
 MQTT_TOPIC_CAPTURE              = topic("camera-captures")
 MQTT_TOPIC_FINGERPRINT_LOG      = topic("fingerprint", "log")
@@ -54,13 +53,129 @@ MQTT_TOPIC_LCD_LOG              = topic("lcd", "log")
 MQTT_TOPIC_FINGERPRINT_COMMAND  = topic("fingerprint", "command")
 MQTT_TOPIC_SERVO_COMMAND        = topic("servo", "command")
 MQTT_TOPIC_LCD_COMMAND          = topic("lcd", "command")
+MQTT_TOPIC_DEVICE_STATUS        = topic("status", "+")        # <prefix>/status/<device>: "online" | "offline" (LWT)
+
+# topic -> tên thiết bị trong DeviceStateStore
+DEVICE_TOPICS = {
+    MQTT_TOPIC_CAPTURE:         "camera",
+    MQTT_TOPIC_SERVO_LOG:       "servo",
+    MQTT_TOPIC_FINGERPRINT_LOG: "fingerprint",
+    MQTT_TOPIC_LCD_LOG:         "lcd",
+}
+
+# role -> (serve HTTP API, ingest MQTT device traffic)
+APP_ROLES = {
+    "all":    (True,  True),
+    "api":    (True,  False),
+    "ingest": (False, True),
+}
+
+def _env_bool(name, default):
+    return os.getenv(name, default).strip().lower() in ('1', 'true', 'yes', 'on')
+
+def default_config() -> dict:
+    return {
+        'APP_ROLE': os.getenv('APP_ROLE', 'all'),
+        'BACK_END_PORT': int(os.getenv('BACK_END_PORT', '8000')),
+        'FRONT_END_URL': os.getenv('FRONT_END_URL'),
+
+        'SQLALCHEMY_DATABASE_URI': os.getenv('DATABASE_URI', 'sqlite:///mydb.sqlite'),
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'QUERY_STATS_ENABLED': _env_bool('QUERY_STATS_ENABLED', 'true'),
+        'SLOW_QUERY_MS': float(os.getenv('SLOW_QUERY_MS', '100')),
+        'QUERY_STATS_MAX_STATEMENTS': int(os.getenv('QUERY_STATS_MAX_STATEMENTS', '500')),
+
+        'PROFILE_RING_SIZE': int(os.getenv('PROFILE_RING_SIZE', '20')),
+        'PROFILE_SAMPLE_INTERVAL_MS': float(os.getenv('PROFILE_SAMPLE_INTERVAL_MS', '5')),
+        'DASHBOARD_CACHE_TTL': float(os.getenv('DASHBOARD_CACHE_TTL', '5')),     # seconds; bounds staleness across processes
+        'DASHBOARD_RECENT_COMMANDS': int(os.getenv('DASHBOARD_RECENT_COMMANDS', '10')),
+        'DEVICE_HEARTBEAT_TIMEOUT': float(os.getenv('DEVICE_HEARTBEAT_TIMEOUT', '300')),  # seconds without traffic -> offline
+        'DEVICE_STATE_SYNC_INTERVAL': float(os.getenv('DEVICE_STATE_SYNC_INTERVAL', '30')), # seconds between DB snapshots
+        'SCHEDULE_TZ': os.getenv('SCHEDULE_TZ', 'Asia/Ho_Chi_Minh'),                  # weekly schedules use local wall time
+        'SCHEDULE_MISFIRE_GRACE': int(os.getenv('SCHEDULE_MISFIRE_GRACE', '60')),      # seconds late a run may still fire
+        'SCHEDULE_MIN_INTERVAL': int(os.getenv('SCHEDULE_MIN_INTERVAL', '10')),
+        'SCHEDULE_MAX_PER_USER': int(os.getenv('SCHEDULE_MAX_PER_USER', '100')),
+        'LOG_LEVEL': os.getenv('LOG_LEVEL', 'INFO'),
+        'LOG_JSON': _env_bool('LOG_JSON', 'true'),
+        'LOG_QUEUE_SIZE': int(os.getenv('LOG_QUEUE_SIZE', '10000')),                  # full -> records dropped, never block
+        'LOG_SAMPLE': parse_sample_rates(os.getenv('LOG_SAMPLE', 'ingest:0.1')),      # child logger -> kept fraction (< WARNING)
+        'ADMIN_USER_IDS': {int(x) for x in os.getenv('ADMIN_USER_IDS', '').split(',') if x.strip()},
+
+        'JWT_TOKEN_LOCATION': ['cookies'],
+        'JWT_ACCESS_COOKIE_PATH': '/api/',
+        'JWT_COOKIE_SECURE': False,        # True if HTTPS
+        'JWT_COOKIE_SAMESITE': 'Lax',
+        'JWT_COOKIE_CSRF_PROTECT': False,
+        'JWT_SECRET_KEY': os.getenv('JWT_SECRET_KEY'),
+        'JWT_ACCESS_TOKEN_EXPIRES': timedelta(seconds=int(os.getenv('JWT_ACCESS_TOKEN_EXPIRES', '3600'))),
+
+        'MQTT_ENABLED': _env_bool('MQTT_ENABLED', 'true'),
+        'MQTT_BROKER_URL': os.getenv('MQTT_BROKER_URL'),
+        'MQTT_BROKER_PORT': int(os.getenv('MQTT_BROKER_PORT', 1883)),
+        'MQTT_KEEPALIVE': 60,
+        'MQTT_COMMAND_QOS': int(os.getenv('MQTT_COMMAND_QOS', '1')),
+        'MQTT_MAX_INFLIGHT': int(os.getenv('MQTT_MAX_INFLIGHT', '20')),
+        'MQTT_ACK_TIMEOUT': float(os.getenv('MQTT_ACK_TIMEOUT', '10')),   # seconds until a command without PUBACK is 'error'
+        'MQTT_ACK_WAIT': float(os.getenv('MQTT_ACK_WAIT', '2')),         # default ?wait= for command endpoints
+
+        'EMAIL_ENABLED': _env_bool('EMAIL_ENABLED', 'true'),
+        'WEBHOOKS_ENABLED': _env_bool('WEBHOOKS_ENABLED', 'true'),
+        'WEBHOOK_DIGEST_WINDOW': float(os.getenv('WEBHOOK_DIGEST_WINDOW', '60')),       # seconds, 0 = off
+        'WEBHOOK_DIGEST_IMMEDIATE': int(os.getenv('WEBHOOK_DIGEST_IMMEDIATE', '1')),    # events sent as-is per window
+        'GEMINI_API_KEY': os.getenv('GEMINI_API_KEY'),
+
+        'FINGERPRINT_MAX_CAPACITY': int(os.getenv('FINGERPRINT_MAX_CAPACITY', '5')),
+        'FINGERPRINT_ENROLL_TIMEOUT': int(os.getenv('FINGERPRINT_ENROLL_TIMEOUT', '300')),  # seconds a queued enroll holds a slot
+
+        'INGEST_SPOOL_ENABLED': _env_bool('INGEST_SPOOL_ENABLED', 'true'),
+        'INGEST_SPOOL_PATH': os.getenv('INGEST_SPOOL_PATH', 'spool/ingest.spool'),
+        'INGEST_SPOOL_SIZE_MB': int(os.getenv('INGEST_SPOOL_SIZE_MB', '16')),
+        'INGEST_SPOOL_RETRY': float(os.getenv('INGEST_SPOOL_RETRY', '2')),       # seconds, doubles up to 60
+
+        'COMMAND_COALESCE_WINDOW': float(os.getenv('COMMAND_COALESCE_WINDOW', '1.0')),  # seconds, 0 = off
+        'LCD_DEDUP_TTL': float(os.getenv('LCD_DEDUP_TTL', '300')),                      # seconds
+
+        'BLOB_ROOT': os.getenv('BLOB_ROOT', 'blobs'),
+        'PUBLIC_BASE_URL': os.getenv('PUBLIC_BASE_URL', ''),                 # prefix of /api/blobs URLs saved on Capture
+        'DEVICE_UPLOAD_TOKEN': os.getenv('DEVICE_UPLOAD_TOKEN'),             # unset = upload endpoint disabled
+        'UPLOAD_MAX_BYTES': int(os.getenv('UPLOAD_MAX_BYTES', str(4 << 20))),
+        'INGEST_BATCH_MAX': int(os.getenv('INGEST_BATCH_MAX', '1000')),     # records per batched MQTT message / HTTP POST
+        'CAPTURE_TIME_INDEX_REFRESH': float(os.getenv('CAPTURE_TIME_INDEX_REFRESH', '1')),  # seconds between catch-up reads
+        'IMAGE_WORKERS': int(os.getenv('IMAGE_WORKERS', '2')),
+        'IMAGE_VARIANTS': parse_variants(os.getenv('IMAGE_VARIANTS', 'thumb:320,medium:1024')),
+        'IMAGE_QUALITY': int(os.getenv('IMAGE_QUALITY', '80')),
+        'IMAGE_RENDER_TIMEOUT': float(os.getenv('IMAGE_RENDER_TIMEOUT', '10')),
+        'TIMELAPSE_PREFETCH': int(os.getenv('TIMELAPSE_PREFETCH', '8')),    # frames fetched ahead per stream
+        'TIMELAPSE_FULL_VARIANT': os.getenv('TIMELAPSE_FULL_VARIANT', 'medium'),
+
+        'CAPTURE_HASH_ENABLED': _env_bool('CAPTURE_HASH_ENABLED', 'true'),
+        'CAPTURE_HASH_ALGO': os.getenv('CAPTURE_HASH_ALGO', 'dhash'),        # 'dhash' | 'phash'
+        'CAPTURE_HASH_TIMEOUT': float(os.getenv('CAPTURE_HASH_TIMEOUT', '5')),
+        'CAPTURE_DEDUP_WINDOW': int(os.getenv('CAPTURE_DEDUP_WINDOW', '120')),         # seconds
+        'CAPTURE_DEDUP_MAX_DISTANCE': int(os.getenv('CAPTURE_DEDUP_MAX_DISTANCE', '4')), # bits of 64
+        'CAPTURE_INDEX_RESCAN': int(os.getenv('CAPTURE_INDEX_RESCAN', '1024')),  # capture ids re-read below the watermark
+
+        'ANOMALY_ENABLED': _env_bool('ANOMALY_ENABLED', 'true'),
+        'ANOMALY_TZ_OFFSET_HOURS': int(os.getenv('ANOMALY_TZ_OFFSET_HOURS', '7')),
+        'ANOMALY_MIN_EVENTS': int(os.getenv('ANOMALY_MIN_EVENTS', '20')),       # history needed before scoring a user
+        'ANOMALY_SCORE_THRESHOLD': float(os.getenv('ANOMALY_SCORE_THRESHOLD', '0.8')),
+        'ANOMALY_FAIL_WINDOW': int(os.getenv('ANOMALY_FAIL_WINDOW', '60')),     # seconds
+        'ANOMALY_FAIL_BURST': int(os.getenv('ANOMALY_FAIL_BURST', '3')),
+
+        'PASSWORD_HASH_WORKERS': int(os.getenv('PASSWORD_HASH_WORKERS', '2')),
+        'PASSWORD_HASH_MAX_PENDING': int(os.getenv('PASSWORD_HASH_MAX_PENDING', '8')),
+        'PASSWORD_HASH_TIMEOUT': float(os.getenv('PASSWORD_HASH_TIMEOUT', '10')),
+        'LOGIN_EMAIL_PER_MINUTE': float(os.getenv('LOGIN_EMAIL_PER_MINUTE', '5')),
+        'LOGIN_EMAIL_BURST': float(os.getenv('LOGIN_EMAIL_BURST', '5')),
+        'LOGIN_IP_PER_MINUTE': float(os.getenv('LOGIN_IP_PER_MINUTE', '30')),
+        'LOGIN_IP_BURST': float(os.getenv('LOGIN_IP_BURST', '20')),
+    }
 
-FINGERPRINT_MAX_CAPACITY = int(os.getenv('FINGERPRINT_MAX_CAPACITY', '5'))
-
-# Initialize extensions
-db  = SQLAlchemy(app)
-jwt = JWTManager(app)
-mqtt = Mqtt(app)
+# Extensions are created unbound and attached to an app in create_app()
+# (Flask-MQTT giữ một client / một on_connect cho mỗi instance -> tạo riêng cho từng app)
+db   = SQLAlchemy()
+jwt  = JWTManager()
+api  = Blueprint('api', __name__)
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -72,9 +187,9 @@ class User(db.Model):
 
 
     def set_password(self, pw):
-        self.password_hash = generate_password_hash(pw)
+        self.password_hash = current_app.extensions['password_hasher'].hash(pw)
     def check_password(self, pw):
-        return check_password_hash(self.password_hash, pw)
+        return current_app.extensions['password_hasher'].verify(self.password_hash, pw)
 
 class Capture(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -82,9 +197,11 @@ class Capture(db.Model):
     url = db.Column(db.String(2048), unique=True, nullable=False)
     thumb_url = db.Column(db.String(2048), unique=True)
     description = db.Column(db.String(255))
+    phash = db.Column(db.BigInteger, nullable=True, index=True)                                   # 64-bit perceptual hash (signed)
+    duplicate_of_id = db.Column(db.Integer, ForeignKey('capture.id', ondelete="SET NULL"), nullable=True, index=True)
     
     def to_dict(self) -> dict:
-        return {"id": self.id, "timestamp": self.timestamp, "url": self.url, "thumb_url": self.thumb_url , "description": self.description}
+        return {"id": self.id, "timestamp": self.timestamp, "url": self.url, "thumb_url": self.thumb_url , "description": self.description, "duplicate_of_id": self.duplicate_of_id}
     
     @classmethod
     def get_last_capture(cls) -> "Capture | None":
@@ -101,6 +218,37 @@ class Capture(db.Model):
         stmt = select(cls).where(cls.timestamp >= start_timestamp, cls.timestamp <= end_timestamp).order_by(cls.timestamp.asc(), cls.id.asc())
         return list(db.session.execute(stmt).scalars().all())
 
+    @classmethod
+    def get_timeline(cls, start_timestamp: int, end_timestamp: int, bucket_seconds: int, skip_duplicates: bool = False) -> list[dict]:
+        # Một capture đại diện (capture đầu tiên) cho mỗi bucket, tính trong một query:
+        # range scan trên index timestamp + window function theo bucket
+        bucket = ((cls.timestamp - start_timestamp) // bucket_seconds).label("bucket")
+        conds = [cls.timestamp >= start_timestamp, cls.timestamp <= end_timestamp]
+        if skip_duplicates:
+            conds.append(cls.duplicate_of_id.is_(None))
+        ranked = (
+            select(
+                cls.id, cls.timestamp, cls.url, cls.thumb_url, cls.description, bucket,
+                func.row_number().over(partition_by=bucket, order_by=(cls.timestamp.asc(), cls.id.asc())).label("rn"),
+                func.count().over(partition_by=bucket).label("n"),
+            )
+            .where(*conds)
+            .subquery()
+        )
+        stmt = select(ranked).where(ranked.c.rn == 1).order_by(ranked.c.bucket.asc())
+        return [
+            {
+                "bucket_start": start_timestamp + row.bucket * bucket_seconds,
+                "count": row.n,
+                "capture": {"id": row.id, "timestamp": row.timestamp, "url": row.url,
+                            "thumb_url": row.thumb_url, "description": row.description},
+            }
+            for row in db.session.execute(stmt)
+        ]
+
+# Cột dùng cho các đường đọc danh sách capture (Row tuple -> dict, không tạo object ORM)
+CAPTURE_COLUMNS = ("id", "timestamp", "url", "thumb_url", "description", "duplicate_of_id")
+
 class OTPRequest(db.Model):
     id         = db.Column(db.Integer, primary_key=True)
     email      = db.Column(db.String, index=True, nullable=False)
@@ -125,13 +273,13 @@ class Command(db.Model):
     command_type  = db.Column(db.String(32), nullable=False)                    # 'servo.open' | 'servo.close' | 'lcd.set'
     topic         = db.Column(db.String(255), nullable=True)                    # e.g. '/MQTT_PREFIX/door'
     payload       = db.Column(db.Text, nullable=True)                           # e.g. 'OPEN' or LCD text
-    status        = db.Column(db.String(16), nullable=False, default='sent')    # 'sent'|'error'
+    status        = db.Column(db.String(16), nullable=False, default='sent')    # 'sent'|'error'|'pending'|'superseded'
     note          = db.Column(db.Text, nullable=True)                           # error detail, optional
 
-    user          = relationship("User", lazy="joined")
+    user          = relationship("User", lazy="select")             # load explicitly when needed
 
     __table_args__ = (
-        CheckConstraint("status IN ('sent','error','pending')", name="ck_command_status"),
+        CheckConstraint("status IN ('sent','error','pending','superseded')", name="ck_command_status"),
         Index("ix_command_user_created", "user_id", "created_at"),
         Index("ix_command_type_created", "command_type", "created_at"),
     )
@@ -148,26 +296,125 @@ class Command(db.Model):
             "note": self.note,
         }
 
+class CommandItem(db.Model):
+    # Một thao tác trong batch command (fingerprint.batch_enroll / fingerprint.batch_delete).
+    # Thiết bị vẫn nhận từng message {"cmd_id": <batch id>, "action", "id"} và trả log với
+    # command_id = batch id -> item được xác định bằng (batch, slot) hoặc enroll chờ sớm nhất.
+    id             = db.Column(db.Integer, primary_key=True)
+    command_id     = db.Column(db.Integer, ForeignKey('command.id', ondelete="CASCADE"), nullable=False)
+    seq            = db.Column(db.Integer, nullable=False)
+    action         = db.Column(db.String(16), nullable=False)                    # 'enroll' | 'delete'
+    fingerprint_id = db.Column(db.Integer, nullable=True)                        # enroll: điền khi enroll.success
+    status         = db.Column(db.String(16), nullable=False, default='pending') # 'pending'|'sent'|'success'|'error'
+    note           = db.Column(db.Text, nullable=True)
+    updated_at     = db.Column(db.BigInteger, nullable=False)
+
+    __table_args__ = (
+        CheckConstraint("status IN ('pending','sent','success','error')", name="ck_command_item_status"),
+        Index("ix_command_item_command_seq", "command_id", "seq", unique=True),
+        Index("ix_command_item_action_status", "action", "status"),
+    )
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "seq": self.seq,
+            "action": self.action,
+            "fingerprint_id": self.fingerprint_id,
+            "status": self.status,
+            "note": self.note,
+            "updated_at": self.updated_at,
+        }
+
+BATCH_COMMAND_PREFIX = "fingerprint.batch_"
+BATCH_TERMINAL_LOG_TYPES = ("enroll.success", "enroll.error", "delete.success", "delete.error")
+
+def is_batch_command(cmd) -> bool:
+    return cmd is not None and cmd.command_type.startswith(BATCH_COMMAND_PREFIX)
+
+class Schedule(db.Model):
+    # Lệnh hẹn giờ, chạy qua cùng đường với /api/servo, /api/lcd (mỗi lần chạy có một Command):
+    # - once:     chạy một lần ở next_run_at (vd. tự đóng cửa 30 giây sau khi mở)
+    # - interval: mỗi every_s giây
+    # - weekly:   các ngày trong bitmask weekdays (bit 0 = thứ Hai) lúc time_of_day, giờ SCHEDULE_TZ
+    id              = db.Column(db.Integer, primary_key=True)
+    user_id         = db.Column(db.Integer, ForeignKey('user.id', ondelete="CASCADE"), nullable=False, index=True)
+    command_type    = db.Column(db.String(32), nullable=False)       # 'servo.open' | 'servo.close' | 'lcd.set'
+    message         = db.Column(db.Text, nullable=True)              # lcd.set
+    kind            = db.Column(db.String(16), nullable=False)       # 'once' | 'interval' | 'weekly'
+    every_s         = db.Column(db.Integer, nullable=True)
+    weekdays        = db.Column(db.Integer, nullable=True)
+    time_of_day     = db.Column(db.Integer, nullable=True)           # giây từ nửa đêm
+    next_run_at     = db.Column(db.BigInteger, nullable=True)        # None: đã chạy xong / tắt
+    enabled         = db.Column(db.Boolean, nullable=False, default=True)
+    created_at      = db.Column(db.BigInteger, nullable=False)
+    last_run_at     = db.Column(db.BigInteger, nullable=True)
+    last_command_id = db.Column(db.Integer, ForeignKey('command.id', ondelete="SET NULL"), nullable=True)
+
+    __table_args__ = (
+        CheckConstraint("kind IN ('once','interval','weekly')", name="ck_schedule_kind"),
+        CheckConstraint("command_type IN ('servo.open','servo.close','lcd.set')", name="ck_schedule_command_type"),
+        Index("ix_schedule_enabled_next", "enabled", "next_run_at"),
+    )
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "command_type": self.command_type,
+            "message": self.message,
+            "kind": self.kind,
+            "every_s": self.every_s,
+            "weekdays": [i for i in range(7) if (self.weekdays or 0) & (1 << i)] if self.kind == 'weekly' else None,
+            "time_of_day": self.time_of_day,
+            "next_run_at": self.next_run_at,
+            "enabled": self.enabled,
+            "created_at": self.created_at,
+            "last_run_at": self.last_run_at,
+            "last_command_id": self.last_command_id,
+        }
+
+class DeviceState(db.Model):
+    # Snapshot định kỳ của DeviceStateStore (RAM) để khôi phục sau restart
+    device     = db.Column(db.String(32), primary_key=True)
+    state      = db.Column(db.Text, nullable=False)           # JSON
+    updated_at = db.Column(db.BigInteger, nullable=False)
+
 class Log(db.Model):
 
     id               = db.Column(db.Integer, primary_key=True)
     created_at       = db.Column(db.BigInteger, nullable=False, index=True)
     log_type         = db.Column(db.String(32), nullable=False)
     description      = db.Column(db.Text, nullable=True)
-    payload          = db.Column(db.Text, nullable=True)
+    payload          = db.Column(db.Text, nullable=True)                           # raw text as received
+    payload_json     = db.Column(db.JSON, nullable=True)                           # parsed once at ingest
+    fingerprint_id   = db.Column(db.Integer, nullable=True)                        # extracted from payload.id
+    action           = db.Column(db.String(16), nullable=True)                     # e.g. 'open' | 'close'
     topic            = db.Column(db.String(255), nullable=True)
-    command_id       = db.Column(db.Integer, ForeignKey('command.id', ondelete="SET NULL"), nullable=True)
-    related_log_id   = db.Column(db.Integer, ForeignKey('log.id',     ondelete="SET NULL"), nullable=True)
+    command_id       = db.Column(db.Integer, ForeignKey('command.id', ondelete="SET NULL"), nullable=True, index=True)
+    related_log_id   = db.Column(db.Integer, ForeignKey('log.id',     ondelete="SET NULL"), nullable=True, index=True)
 
-    command          = relationship("Command", lazy="joined")
-    related_log      = relationship("Log", remote_side=[id], lazy="joined")
+    # lazy="select": Log không còn kéo theo join Command -> User -> Log cha ở mọi query;
+    # đường đọc danh sách select theo cột (LOG_COLUMNS)
+    command          = relationship("Command", lazy="select")
+    related_log      = relationship("Log", remote_side=[id], lazy="select")
 
     __table_args__ = (
         # at most one parent: command OR log (both NULL allowed)
         CheckConstraint("(command_id IS NULL) OR (related_log_id IS NULL)", name="ck_log_at_most_one_parent"),
         Index("ix_log_type_created", "log_type", "created_at"),
+        Index("ix_log_fingerprint_created", "fingerprint_id", "created_at"),
+        Index("ix_log_action_created", "action", "created_at"),
     )
 
+    def set_payload(self, raw):
+        # gọi sau khi đã gán log_type
+        data = parse_payload(raw)
+        self.payload      = payload_text(raw)
+        self.payload_json = data
+        self.fingerprint_id, self.action = extract_fields(self.log_type, data)
+        return data
+
     def to_dict(self):
         return {
             "id": self.id,
@@ -175,21 +422,36 @@ class Log(db.Model):
             "log_type": self.log_type,
             "description": self.description,
             "payload": self.payload,
+            "fingerprint_id": self.fingerprint_id,
+            "action": self.action,
             "topic": self.topic,
             "command_id": self.command_id,
             "related_log_id": self.related_log_id,
         }
-    
+
+# Cột dùng cho các đường đọc danh sách (select theo cột, không load cả graph ORM)
+LOG_COLUMNS = ("id", "created_at", "log_type", "description", "payload", "fingerprint_id", "action", "topic", "command_id", "related_log_id")
+
 class Fingerprint(db.Model):
     __tablename__ = 'fingerprint'
     
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     name = db.Column(db.String(100), nullable=True) 
     created_at = db.Column(db.BigInteger, nullable=False)
 
     user = relationship("User", back_populates="fingerprints")
 
+    @classmethod
+    def list_dicts(cls) -> list[dict]:
+        # một query cho cả danh sách: cột fingerprint + username (outer join), không load User từng dòng
+        stmt = (
+            select(cls.id, cls.user_id, func.coalesce(User.username, "N/A"), cls.name, cls.created_at)
+            .outerjoin(User, User.id == cls.user_id)
+            .order_by(cls.id)
+        )
+        return [dict(zip(FINGERPRINT_COLUMNS, row)) for row in db.session.execute(stmt)]
+
     def to_dict(self):
         return {
             "id": self.id,
@@ -199,9 +461,11 @@ class Fingerprint(db.Model):
             "created_at": self.created_at
         }
 
+FINGERPRINT_COLUMNS = ("id", "user_id", "username", "name", "created_at")
+
 class Webhook(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     url = db.Column(db.String(255), nullable=False)
     created_at = db.Column(db.Integer, nullable=False)
 
@@ -215,6 +479,9 @@ class Webhook(db.Model):
         if len(content) > 2000:
             content = content[:1990] + "…"
 
+        if not current_app.config.get('WEBHOOKS_ENABLED', True):
+            return (False, 0, "webhooks disabled")
+
         payload = {"content": content}
 
         # đưa metadata vào embeds để tránh Invalid Form Body
@@ -228,9 +495,11 @@ class Webhook(db.Model):
             if fields:
                 payload["embeds"] = [{"title": title, "fields": fields[:25]}]
 
+        import requests
+        session = http_session()
         for attempt in (1, 2):
             try:
-                r = requests.post(self.url, json=payload, timeout=(3, timeout))
+                r = session.post(self.url, json=payload, timeout=(3, timeout))
                 if r.status_code == 429 and attempt == 1:
                     try:
                         delay = float(r.headers.get("Retry-After", "1"))
@@ -245,266 +514,847 @@ class Webhook(db.Model):
                 return (False, 0, f"timeout: {e}")
             except Exception as e:
                 return (False, 0, str(e))
-# Create tables on startup
-def init_db():
-    with app.app_context():
-        # db.drop_all()  # REMEMBER TO DELETE THIS
-        db.create_all()
 
-@mqtt.on_connect()
-def handle_connect(client, userdata, flags, rc):
-    mqtt.subscribe(MQTT_TOPIC_CAPTURE)
-    mqtt.subscribe(MQTT_TOPIC_FINGERPRINT_LOG)
-    mqtt.subscribe(MQTT_TOPIC_SERVO_LOG)
-    mqtt.subscribe(MQTT_TOPIC_LCD_LOG)
-
-@mqtt.on_topic(MQTT_TOPIC_CAPTURE)
-def handle_capture_topic(client, userdata, message):
+def admin_required(fn):
+    # JWT + user id nằm trong ADMIN_USER_IDS
+    @functools.wraps(fn)
+    @jwt_required()
+    def wrapper(*args, **kwargs):
+        try:
+            uid = int(get_jwt_identity())
+        except (TypeError, ValueError):
+            return jsonify(error='Invalid token identity'), 422
+        if uid not in current_app.config['ADMIN_USER_IDS']:
+            return jsonify(error='Admin only'), 403
+        return fn(*args, **kwargs)
+    return wrapper
+
+def is_admin_request() -> bool:
+    # như admin_required nhưng không trả lỗi (dùng trong hook trước request)
     try:
-        obj = json.loads(message.payload.decode("utf-8"))
-    except json.JSONDecodeError as e:
-        app.logger.warning(f"Invalid JSON on {MQTT_TOPIC_CAPTURE}: %s", e)
+        verify_jwt_in_request(optional=True)
+        return int(get_jwt_identity() or -1) in current_app.config['ADMIN_USER_IDS']
+    except Exception:
+        return False
+
+def throttled(*checks):
+    # checks: (limiter name, key) — trả về response 429 nếu một bucket bất kỳ đã cạn
+    limiters = current_app.extensions['login_limiters']
+    wait = max((limiters[name].take(key) for name, key in checks if key), default=0.0)
+    if wait <= 0:
+        return None
+    resp = jsonify(error='Too many attempts, please try again later')
+    # rate = 0 (LOGIN_*_PER_MINUTE=0) -> wait = inf: chặn hẳn, Retry-After tối đa 1 giờ
+    resp.headers['Retry-After'] = str(max(1, math.ceil(min(wait, 3600))))
+    return resp, 429
+
+@api.errorhandler(HashingBusy)
+def handle_hashing_busy(e):
+    resp = jsonify(error='Server busy, please try again')
+    resp.headers['Retry-After'] = '1'
+    return resp, 503
+
+def publish_command(cmd: 'Command'):
+    # Row phải đã commit ở trạng thái 'pending'; PUBACK (hoặc lỗi/timeout) cập nhật status
+    # bất đồng bộ qua on_command_published. -> ticket, hoặc None khi app chạy không có MQTT
+    invalidate_dashboard('commands')
+    publisher = current_app.extensions.get('mqtt_publisher')
+    if publisher is None:
+        cmd.status = 'error'
+        cmd.note   = 'MQTT disabled'
+        db.session.commit()
+        track_lcd_display(cmd, False)
+        return None
+    return publisher.publish(cmd.topic, cmd.payload, current_app.config['MQTT_COMMAND_QOS'], item=cmd.id)
+
+def on_command_published(cmd_id, ok: bool, error: str | None):
+    if isinstance(cmd_id, tuple):        # ("item", CommandItem.id): một message của batch
+        return on_batch_item_published(cmd_id[1], ok, error)
+    cmd = db.session.get(Command, cmd_id)
+    if cmd is None or cmd.status != 'pending':
         return
+    cmd.status = 'sent' if ok else 'error'
+    cmd.note   = error
+    db.session.commit()
+    invalidate_dashboard('commands')
+    track_lcd_display(cmd, ok)
 
-    if "timestamp" not in obj or "url" not in obj  or "thumb_url" not in obj:
-        app.logger.warning("Missing required keys (timestamp, url, thumb_url): %r", obj)
+def track_lcd_display(cmd: 'Command', ok: bool):
+    # LCD chỉ được coi là đang hiển thị payload khi thiết bị đã ack; mọi đường lỗi -> không rõ nội dung
+    scheduler = current_app.extensions.get('command_scheduler')
+    if scheduler is None or cmd.topic != MQTT_TOPIC_LCD_COMMAND:
         return
+    if ok:
+        scheduler.mark_current(MQTT_TOPIC_LCD_COMMAND, cmd.payload)
+    else:
+        scheduler.invalidate(MQTT_TOPIC_LCD_COMMAND)
 
-    try:
-        ts  = int(obj["timestamp"])
-        url = str(obj["url"])
-        thumb_url = str(obj["thumb_url"])
-        desc = obj.get("description")
-    except (TypeError, ValueError) as e:
-        app.logger.warning("Bad field types: %s | payload=%r", e, obj)
+def on_batch_item_published(item_id: int, ok: bool, error: str | None):
+    item = db.session.get(CommandItem, item_id)
+    if item is None or item.status != 'pending':
+        return
+    item.status     = 'sent' if ok else 'error'
+    item.note       = error
+    item.updated_at = int(time.time())
+    db.session.flush()
+    refresh_batch_status(item.command_id)
+    db.session.commit()
+    invalidate_dashboard('commands')
+
+def batch_status_counts(cmd_id: int) -> dict[str, int]:
+    return dict(db.session.execute(
+        select(CommandItem.status, func.count())
+        .where(CommandItem.command_id == cmd_id)
+        .group_by(CommandItem.status)
+    ).all())
+
+def batch_open_items(cmd_id: int) -> int:
+    # số item chưa có kết quả từ thiết bị
+    counts = batch_status_counts(cmd_id)
+    return counts.get('pending', 0) + counts.get('sent', 0)
+
+def refresh_batch_status(cmd_id: int):
+    # batch command: 'pending' tới khi mọi message đã được broker nhận (hoặc lỗi publish)
+    cmd = db.session.get(Command, cmd_id)
+    if cmd is None or cmd.status != 'pending':
+        return
+    counts = batch_status_counts(cmd_id)
+    if counts.get('pending'):
+        return
+    failed = counts.get('error', 0)
+    cmd.status = 'error' if failed and failed == sum(counts.values()) else 'sent'
+    cmd.note   = f"{failed} item(s) failed" if failed else None
+
+def reconcile_batch_item(cmd_id: int, log_type: str, slot, description: str | None):
+    # gọi trong build_fingerprint_log -> cùng transaction với Log và thay đổi Fingerprint
+    cmd = db.session.get(Command, cmd_id)
+    if not is_batch_command(cmd):
         return
+    action, _, outcome = log_type.partition('.')
+    stmt = (
+        select(CommandItem)
+        .where(CommandItem.command_id == cmd_id, CommandItem.action == action,
+               CommandItem.status.in_(('pending', 'sent')))
+        .order_by(CommandItem.seq)
+        .limit(1)
+    )
+    if action == 'delete' and slot is not None:
+        stmt = stmt.where(CommandItem.fingerprint_id == int(slot))
+    item = db.session.execute(stmt).scalar_one_or_none()
+    if item is None:
+        current_app.logger.warning("No open batch item for %s on command %s (slot %s)", log_type, cmd_id, slot)
+        return
+    item.status     = 'success' if outcome == 'success' else 'error'
+    item.note       = None if outcome == 'success' else description
+    item.updated_at = int(time.time())
+    if action == 'enroll' and slot is not None:
+        item.fingerprint_id = int(slot)
+    db.session.flush()
+    refresh_batch_status(cmd_id)
+
+def ack_wait() -> float:
+    # ?wait=<giây> chờ PUBACK trước khi trả response; 0 = trả 202 ngay
+    wait = request.args.get('wait', type=float)
+    if wait is None:
+        wait = current_app.config['MQTT_ACK_WAIT']
+    return max(0.0, min(wait, current_app.config['MQTT_ACK_TIMEOUT']))
+
+def wait_for_command(cmd: 'Command', ticket) -> int:
+    # -> status code: 200 đã có PUBACK, 500 lỗi, 202 vẫn đang chờ ack
+    if ticket is not None and ticket.wait(ack_wait()):
+        db.session.refresh(cmd)
+    return {'sent': 200, 'error': 500}.get(cmd.status, 202)
+
+def publish_held_command(cmd_id: int):
+    # gọi từ thread của DeviceCommandScheduler khi hết cửa sổ coalesce
+    cmd = db.session.get(Command, cmd_id)
+    if cmd is None or cmd.status != 'pending':
+        return
+    publish_command(cmd)
 
-    with app.app_context():
-        cap = Capture(timestamp=ts, url=url, thumb_url=thumb_url, description=desc)
-        db.session.add(cap)
-        try:
-            db.session.commit()
-            app.logger.info("Stored capture id=%s url=%s", cap.id, cap.url)
-        except IntegrityError:
-            db.session.rollback()
-            app.logger.info("Duplicate capture (url) ignored: %s", url)
-        except Exception as e:
-            db.session.rollback()
-            app.logger.exception("DB insert failed: %s", e)
+def supersede_command(cmd_id: int, reason: str):
+    db.session.execute(
+        update(Command)
+        .where(Command.id == cmd_id, Command.status == 'pending')
+        .values(status='superseded', note=reason)
+    )
+    db.session.commit()
+    invalidate_dashboard('commands')
 
-@mqtt.on_topic(MQTT_TOPIC_SERVO_LOG)
-def handle_servo_log(client, userdata, message):
-    try:
-        obj = json.loads(message.payload.decode())
-    except json.JSONDecodeError:
-        app.logger.warning("Bad JSON on servo/log")
-        return
+def invalidate_dashboard(*sections: str):
+    # gọi sau commit; ghi từ process khác (APP_ROLE=ingest) chỉ thấy sau DASHBOARD_CACHE_TTL
+    cache = current_app.extensions.get('dashboard_cache')
+    if cache:
+        cache.invalidate(*sections)
 
-    if "created_at" not in obj or "log_type" not in obj:
-        app.logger.warning("Missing keys in servo/log: %r", obj)
+def send_email(fn, *args):
+    if not current_app.config.get('EMAIL_ENABLED', True):
+        current_app.logger.info("Email disabled; skipped %s", fn.__name__)
         return
+    fn(*args)
 
-    cmd_id  = obj.get("command_id")
-    rel_id  = obj.get("related_log_id")
+WEBHOOK_DIGEST_MESSAGES = {
+    "fingerprint.match.fail": "❌ {count} lần quét vân tay thất bại trong {seconds}s",
+}
 
-    if cmd_id and rel_id:
-        app.logger.warning(
-            "servo/log violates parent rule: BOTH command_id=%s AND related_log_id=%s",
-            cmd_id, rel_id
+def deliver_webhook_digest(key, count: int, first_ts: int, last_ts: int):
+    # gọi từ timer của EventDigester khi hết cửa sổ gom event
+    webhook_id, event = key
+    wh = db.session.get(Webhook, webhook_id)
+    if wh is None:
+        return
+    template = WEBHOOK_DIGEST_MESSAGES.get(event, "{count} × {event} trong {seconds}s")
+    ok, code, body = wh.notify(
+        content=template.format(count=count, event=event, seconds=int(current_app.config['WEBHOOK_DIGEST_WINDOW'])),
+        event=f"{event}.digest",
+        count=count,
+        first_at=first_ts,
+        last_at=last_ts,
+    )
+    if ok:
+        current_app.logger.info("Sent webhook digest (%s x%d) to %s", event, count, wh.url)
+    else:
+        current_app.logger.error("Webhook digest failed (%s) to %s: %s", code, wh.url, body)
+
+def escalate_anomaly(content: str, **extra):
+    # Sự kiện bất thường -> báo cho tất cả webhook
+    current_app.logger.warning("Anomaly: %s %r", content, extra)
+    for wh in Webhook.query.order_by(Webhook.id.asc()).all():
+        ok, code, body = wh.notify(content=content, **extra)
+        if not ok:
+            current_app.logger.error("Anomaly webhook failed (%s) to %s: %s", code, wh.url, body)
+
+def score_access_event(user_id: int, ts: int, source: str, **extra):
+    model = get_anomaly_model()
+    if model is None:
+        return
+    score, anomalous = model.score_access(user_id, ts)
+    if anomalous:
+        user = db.session.get(User, user_id)
+        username = user.username if user else f"#{user_id}"
+        # cùng múi giờ mà model dùng để chấm điểm (ANOMALY_TZ_OFFSET_HOURS), không phải giờ server
+        tz = timezone(timedelta(hours=current_app.config['ANOMALY_TZ_OFFSET_HOURS']))
+        when = datetime.fromtimestamp(ts, tz).strftime('%Y-%m-%d %H:%M')
+        escalate_anomaly(
+            f"⚠️ {username} mở cửa vào thời điểm bất thường ({when})",
+            event="anomaly.access",
+            user_id=user_id, source=source, score=round(score, 3), created_at=ts, **extra,
         )
+
+def score_failure_event(ts: int):
+    model = get_anomaly_model()
+    if model is None:
         return
+    score, count, anomalous = model.score_failure(ts)
+    if anomalous:
+        escalate_anomaly(
+            f"⚠️ {count} lần quét vân tay thất bại trong {model.fail_window}s",
+            event="anomaly.match.fail_burst",
+            count=count, window_seconds=model.fail_window, score=round(score, 3), created_at=ts,
+        )
 
+def get_anomaly_model() -> AccessAnomalyModel | None:
+    # Dựng trong init_db (sau khi bảng đã có), không phải lúc create_app(); nếu init_db không chạy
+    # thì dựng ở sự kiện đầu tiên -- lock để MQTT thread và spool replayer không cùng nạp lịch sử
+    if not current_app.config['ANOMALY_ENABLED']:
+        return None
+    model = current_app.extensions.get('anomaly_model')
+    if model is None:
+        with current_app.extensions['anomaly_lock']:
+            model = current_app.extensions.get('anomaly_model')
+            if model is None:
+                model = current_app.extensions['anomaly_model'] = build_anomaly_model(current_app._get_current_object())
+    return model
+
+def build_anomaly_model(app) -> AccessAnomalyModel:
+    # Nạp lịch sử mở cửa (web + vân tay) thành 2 mảng (user_id, created_at) rồi rebuild vector hoá
+    model = AccessAnomalyModel(
+        tz_offset_hours = app.config['ANOMALY_TZ_OFFSET_HOURS'],
+        min_events      = app.config['ANOMALY_MIN_EVENTS'],
+        threshold       = app.config['ANOMALY_SCORE_THRESHOLD'],
+        fail_window     = app.config['ANOMALY_FAIL_WINDOW'],
+        fail_burst      = app.config['ANOMALY_FAIL_BURST'],
+    )
     with app.app_context():
-        log = Log(
-            created_at     = int(obj["created_at"]),
-            log_type       = obj.get("log_type"),
-            description    = obj.get("description"),
-            payload        = obj.get("payload"),
-            topic          = obj.get("topic"),
-            command_id     = cmd_id,
-            related_log_id = rel_id,
+        web = (
+            select(Command.user_id, Log.created_at)
+            .join(Command, Command.id == Log.command_id)
+            .where(Log.action == 'open', Log.log_type == 'servo.status')
         )
-        db.session.add(log)
-        try:
-            db.session.commit()
-            app.logger.info("Stored servo log id=%s", log.id)
-        except Exception as e:
-            db.session.rollback()
-            app.logger.exception("DB insert failed: %s", e)
-        
-        if cmd_id:
-            original_command = db.session.get(Command, cmd_id)
-            if original_command:
-                wh = Webhook.query.filter_by(user_id=original_command.user_id).first()
-                if wh:
-                    user = User.query.filter_by(id=original_command.user_id).first()
-                    username = user.username if user else "Unknown"
-                    tmp = "mở" if obj.get('payload') == "open" else "đóng"
-                                        
-                    ok, code, body = wh.notify(
-                        content=f"🔔 Cửa được {tmp} bởi {username}",
-                        event="servo.log",
-                        log_type=obj.get("log_type"),
-                        description=obj.get("description"),
-                        payload=obj.get("payload"),
-                        log_id=log.id,
-                        command_id=cmd_id,
-                    )
-                    if ok:
-                        app.logger.info(f"Sent webhook to {wh.url} for log #{log.id}")
-                    else:
-                        app.logger.error(f"Webhook failed ({code}): {body}")
-            else:
-                app.logger.error(f"Can not found user id for command id {original_command}")
-        else:
-            app.logger.error(f"No cmd_id field in log")
+        finger = (
+            select(Fingerprint.user_id, Log.created_at)
+            .join(Fingerprint, Fingerprint.id == Log.fingerprint_id)
+            .where(Log.log_type == 'match.success')
+        )
+        t0 = time.perf_counter()
+        rows = db.session.execute(web.union_all(finger)).all()
+        n = model.rebuild([r[0] for r in rows], [r[1] for r in rows])
+        app.logger.info("Anomaly model rebuilt from %s events in %.2fs", n, time.perf_counter() - t0)
+    return model
+
+def store_capture_hash(capture_id: int, h: int):
+    # Lưu hash; nếu gần trùng (Hamming <= ngưỡng) với capture gốc gần nhất trong cửa sổ
+    # thời gian thì đánh dấu duplicate_of_id thay vì coi là một khung hình mới
+    cap = db.session.get(Capture, capture_id)
+    if cap is None:
+        return
+    cap.phash = to_signed(h)
 
-@mqtt.on_topic(MQTT_TOPIC_FINGERPRINT_LOG)
-def handle_fingerprint_log(client, userdata, message):
-    # 1) Parse JSON
+    window   = current_app.config['CAPTURE_DEDUP_WINDOW']
+    max_dist = current_app.config['CAPTURE_DEDUP_MAX_DISTANCE']
+    recent = db.session.execute(
+        select(Capture.id, Capture.phash)
+        .where(
+            Capture.timestamp >= cap.timestamp - window,
+            Capture.timestamp <= cap.timestamp,
+            Capture.id != cap.id,
+            Capture.phash.isnot(None),
+            Capture.duplicate_of_id.is_(None),
+        )
+        .order_by(Capture.timestamp.desc(), Capture.id.desc())
+        .limit(50)
+    ).all()
+    for other_id, other_hash in recent:
+        if hamming(h, other_hash) <= max_dist:
+            cap.duplicate_of_id = other_id
+            break
+
+    db.session.commit()
+    current_app.extensions['capture_index'].add(cap.id, h)
+
+def refresh_capture_times(force: bool = False):
+    # Đọc bù capture do process khác ghi (id > watermark, range scan trên PK), tối đa mỗi
+    # CAPTURE_TIME_INDEX_REFRESH giây; capture do process này ghi đã được add() ngay khi commit
+    capture_times = current_app.extensions['capture_times']
+    if not force and time.monotonic() - capture_times.loaded_at < current_app.config['CAPTURE_TIME_INDEX_REFRESH']:
+        return
+    rows = db.session.execute(
+        select(Capture.id, Capture.timestamp)
+        .where(Capture.id > capture_times.watermark)
+        .order_by(Capture.id.asc())
+    ).all()
+    added = capture_times.load([tuple(r) for r in rows])
+    if force:
+        current_app.logger.info("Capture time index: %s timestamp(s)", added)
+
+def refresh_capture_index(force: bool = False):
+    # phash được ghi sau khi capture đã commit (thread băm, có thể ở process ingest khác) nên hash
+    # có thể xuất hiện dưới watermark -> đọc lại CAPTURE_INDEX_RESCAN id cuối; id đã có bị bỏ qua
+    capture_index = current_app.extensions['capture_index']
+    floor = max(0, capture_index.watermark - current_app.config['CAPTURE_INDEX_RESCAN'])
+    rows = db.session.execute(
+        select(Capture.id, Capture.phash)
+        .where(Capture.id > floor, Capture.phash.isnot(None))
+        .order_by(Capture.id.asc())
+    ).all()
+    added = capture_index.load([tuple(r) for r in rows])
+    if force:
+        current_app.logger.info("Capture hash index: %s hash(es)", added)
+
+BLOB_URL_PATH = '/api/blobs/'
+
+def blob_url(digest: str, variant: str | None = None) -> str:
+    return f"{current_app.config['PUBLIC_BASE_URL']}{BLOB_URL_PATH}{digest}" + (f"/{variant}" if variant else "")
+
+def blob_key(url: str) -> tuple[str, str | None] | None:
+    # URL do blob_url() tạo -> (digest, variant); URL ngoài (ImgBB...) -> None
+    i = url.find(BLOB_URL_PATH)
+    if i < 0:
+        return None
+    digest, _, variant = url[i + len(BLOB_URL_PATH):].partition('/')
+    return digest, variant or None
+
+def render_capture_variants(digest: str, data: bytes):
+    pool = current_app.extensions['image_pool']
+    return pool.submit(render_variants, data, current_app.config['IMAGE_VARIANTS'], current_app.config['IMAGE_QUALITY'])
+
+def store_capture_variants(capture_id: int, digest: str, fut):
+    # done-callback của future render (thread quản lý của process pool)
     try:
-        obj = json.loads(message.payload.decode("utf-8"))
-    except json.JSONDecodeError:
-        app.logger.warning("Bad JSON on fingerprint/log")
+        variants = fut.result()
+    except Exception as e:
+        current_app.logger.warning("Rendering variants for capture id=%s failed: %s", capture_id, e)
         return
+    store = current_app.extensions['blob_store']
+    for name, data in variants.items():
+        store.put_variant(digest, name, data)
+    cap = db.session.get(Capture, capture_id)
+    if cap:
+        notify_capture(None, cap)
+
+def _fetch_image(url: str) -> bytes:
+    key = blob_key(url)
+    if key:
+        return current_app.extensions['blob_store'].read(*key)
+    r = http_session().get(url, timeout=current_app.config['CAPTURE_HASH_TIMEOUT'])
+    r.raise_for_status()
+    return r.content
+
+# Create tables on startup
+def init_db(app):
+    with app.app_context():
+        # db.drop_all()  # REMEMBER TO DELETE THIS
+        db.create_all()
+        run_migrations(db.engine, app.logger)
+        reload_device_state()
+        load_schedules()
+        refresh_capture_times(force=True)
+        refresh_capture_index(force=True)
+        get_anomaly_model()
+# Logger con cho dòng log tần suất cao -> lấy mẫu theo LOG_SAMPLE (vd. "ingest:0.1")
+def ingest_logger():
+    return current_app.logger.getChild("ingest")
+
+def webhook_logger():
+    return current_app.logger.getChild("webhook")
+
+def handle_connect(client, userdata, flags, rc):
+    # network thread của paho, trong app context của app sở hữu client
+    mqtt = current_app.extensions['mqtt']
+    for t in current_app.extensions['mqtt_subscriptions']:
+        mqtt.subscribe(t)
+
+def mqtt_connected() -> bool:
+    return bool(getattr(current_app.extensions.get('mqtt'), 'connected', False))
 
-    if "created_at" not in obj or "log_type" not in obj:
-        app.logger.warning("Missing keys in fingerprint/log: %r", obj)
+# ─── Device state (RAM) ───────────────────────────────────────────────────────
+# Cập nhật ngay khi message tới (trước khi ghi DB, nên vẫn đúng khi DB lỗi và message vào spool);
+# process ingest ghi snapshot xuống bảng device_state, process chỉ chạy API đọc lại bảng đó.
+
+def track_device(topic: str, obj: dict):
+    store = current_app.extensions['device_state']
+    device = DEVICE_TOPICS[topic]
+    try:
+        if topic == MQTT_TOPIC_CAPTURE:
+            store.touch(device, int(obj["timestamp"]), last_capture_at=int(obj["timestamp"]))
+            return
+        created_at = int(obj["created_at"])
+    except (KeyError, TypeError, ValueError):
+        current_app.logger.warning("No usable timestamp for device state on %s: %r", topic, obj)
         return
+    log_type   = obj.get("log_type")
+    fields = {"last_log": {"log_type": log_type, "created_at": created_at, "description": obj.get("description")}}
+    if log_type == "servo.status":
+        _, action = extract_fields(log_type, parse_payload(obj.get("payload")))
+        if action:
+            fields["door"], fields["door_changed_at"] = action, created_at
+    store.touch(device, created_at, **fields)
+
+def handle_lcd_log(client, userdata, message):
+    # LCD log chưa lưu DB; chỉ dùng làm heartbeat của màn hình
+    try:
+        obj = json.loads(message.payload.decode())
+    except (UnicodeDecodeError, ValueError):
+        current_app.logger.warning("Bad JSON on lcd/log")
+        return
+    if isinstance(obj, dict):
+        track_device(MQTT_TOPIC_LCD_LOG, obj)
+
+def handle_device_status(client, userdata, message):
+    device   = message.topic.rsplit("/", 1)[-1]
+    presence = message.payload.decode(errors="replace").strip().lower()
+    if presence not in ("online", "offline"):
+        current_app.logger.warning("Unknown device status %r on %s", presence, message.topic)
+        return
+    current_app.extensions['device_state'].set_presence(device, presence, int(time.time()))
+
+def persist_device_state():
+    store   = current_app.extensions['device_state']
+    changed = store.take_dirty()
+    if not changed:
+        return
+    now = int(time.time())
+    try:
+        for device, state in changed.items():
+            db.session.merge(DeviceState(device=device, state=json.dumps(state), updated_at=now))
+        db.session.commit()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        store.mark_dirty(changed)
+        current_app.logger.warning("Device state snapshot failed, will retry: %s", e)
+
+def reload_device_state():
+    try:
+        rows = db.session.execute(select(DeviceState.device, DeviceState.state)).all()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        current_app.logger.warning("Device state reload failed: %s", e)
+        return
+    current_app.extensions['device_state'].load({device: json.loads(state) for device, state in rows})
+
+# ─── Ingest: parse -> store (DB) -> notify (webhook/email/anomaly) ───────────
+# store lỗi DB (SQLite bị lock, đang migrate, đầy đĩa...) -> message gốc vào spool trên đĩa,
+# SpoolReplayer chạy lại đúng thứ tự khi DB sẵn sàng. Còn backlog thì message mới cũng xếp
+# vào spool để không vượt lên trước.
 
+def decode_message(topic: str, raw: bytes):
+    # -> object JSON (một record) hoặc list (batch thiết bị gửi bù sau khi mất kết nối)
+    try:
+        return json.loads(raw.decode("utf-8"))
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        current_app.logger.warning("Invalid JSON on %s: %s", topic, e)
+        return None
+
+def validate_capture(obj) -> dict:
+    if not isinstance(obj, dict) or "timestamp" not in obj or "url" not in obj or "thumb_url" not in obj:
+        raise ValueError("missing required keys (timestamp, url, thumb_url)")
+    try:
+        return {
+            "timestamp":   int(obj["timestamp"]),
+            "url":         str(obj["url"]),
+            "thumb_url":   str(obj["thumb_url"]),
+            "description": obj.get("description"),
+        }
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"bad field types: {e}") from e
+
+def build_capture(obj):
+    return Capture(**obj)
+
+def notify_capture(obj, cap):
+    hasher = current_app.extensions.get('capture_hasher')
+    if hasher:
+        hasher.submit(cap.id, cap.thumb_url or cap.url)
+
+def _validate_log(obj) -> dict:
+    if not isinstance(obj, dict) or "created_at" not in obj or "log_type" not in obj:
+        raise ValueError("missing required keys (created_at, log_type)")
+    try:
+        int(obj["created_at"])
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"bad created_at: {e}") from e
+    return obj
+
+def validate_servo_log(obj) -> dict:
+    obj = _validate_log(obj)
+    if obj.get("command_id") and obj.get("related_log_id"):
+        raise ValueError("violates parent rule: both command_id and related_log_id are set")
+    return obj
+
+def build_servo_log(obj):
+    log = Log(
+        created_at     = int(obj["created_at"]),
+        log_type       = obj.get("log_type"),
+        description    = obj.get("description"),
+        topic          = obj.get("topic"),
+        command_id     = obj.get("command_id"),
+        related_log_id = obj.get("related_log_id"),
+    )
+    log.set_payload(obj.get("payload"))
+    return log
+
+def notify_servo_log(obj, log):
+    cmd_id = obj.get("command_id")
+    if cmd_id:
+        original_command = db.session.get(Command, cmd_id)
+        if original_command:
+            if log.log_type == "servo.status" and log.action == "open":
+                score_access_event(original_command.user_id, log.created_at, source="web")
+            wh = Webhook.query.filter_by(user_id=original_command.user_id).first()
+            if wh:
+                user = User.query.filter_by(id=original_command.user_id).first()
+                username = user.username if user else "Unknown"
+                tmp = "mở" if obj.get('payload') == "open" else "đóng"
+
+                ok, code, body = wh.notify(
+                    content=f"🔔 Cửa được {tmp} bởi {username}",
+                    event="servo.log",
+                    log_type=obj.get("log_type"),
+                    description=obj.get("description"),
+                    payload=obj.get("payload"),
+                    log_id=log.id,
+                    command_id=cmd_id,
+                )
+                if ok:
+                    webhook_logger().info("Sent webhook to %s for log #%s", wh.url, log.id)
+                else:
+                    webhook_logger().error("Webhook failed (%s): %s", code, body)
+        else:
+            current_app.logger.error("Can not found user id for command id %s", cmd_id)
+    else:
+        current_app.logger.error("No cmd_id field in log")
+
+def validate_fingerprint_log(obj) -> dict:
+    return _validate_log(obj)
+
+def _payload_id(obj):
+    data = parse_payload(obj.get("payload"))
+    return data.get("id") if isinstance(data, dict) else None
+
+def build_fingerprint_log(obj):
+    # Liên kết/xoá Fingerprint (enroll.success / delete.success) và Log cùng một transaction
     cmd_id   = obj.get("command_id")
     log_type = obj.get("log_type", "")
 
-    # Normalize payload -> dict
-    payload_raw = obj.get("payload")
-    payload_data = {}
-    if isinstance(payload_raw, dict):
-        payload_data = payload_raw
-    elif isinstance(payload_raw, str):
-        try:
-            payload_data = json.loads(payload_raw) if payload_raw else {}
-        except json.JSONDecodeError:
-            payload_data = {}
-    # else: leave as {}
-
-    with app.app_context():
-        
-        if log_type == "match.success":
-            fingerprint_id = payload_data.get("id")
-            if fingerprint_id is not None:
-                fp = Fingerprint.query.get(int(fingerprint_id))
-                if fp:
-                    user = User.query.get(fp.user_id)
-                    wh = Webhook.query.filter_by(user_id=fp.user_id).first()
-                    if wh:
-                        app.logger.info(f"Webhook retrieved for user {user.username}")
-                        ok, code, body = wh.notify(
-                            content=f"✅ Người dùng {user.username} quét vân tay thành công",
-                            event="fingerprint.match.success",
-                            fingerprint_id=fingerprint_id
-                        )
-                        if ok:
-                            app.logger.info(f"Sent webhook (match.success) to {wh.url}")
-                        else:
-                            app.logger.error(f"Webhook failed ({code}): {body}")
+    if log_type == "enroll.success" and cmd_id:
+        fingerprint_id = _payload_id(obj)
+        original_command = db.session.get(Command, cmd_id)
+        if fingerprint_id is None:
+            current_app.logger.error("Failed to create/update Fingerprint link: payload.id missing for enroll.success")
+        elif original_command:
+            fingerprint_id = int(fingerprint_id)
+            fp = db.session.get(Fingerprint, fingerprint_id)
+            if fp is None:
+                fp = Fingerprint(
+                    id=fingerprint_id,
+                    user_id=original_command.user_id,
+                    name=f"Vân tay #{fingerprint_id}",
+                    created_at=int(obj["created_at"]),
+                )
+                db.session.add(fp)
             else:
-                app.logger.warning("match.success missing fingerprint id")
+                fp.user_id    = original_command.user_id
+                fp.name       = fp.name or f"Vân tay #{fingerprint_id}"
+                fp.created_at = int(obj["created_at"])
+            current_app.logger.info(
+                "Linked fingerprint ID %s to user ID %s",
+                fingerprint_id, original_command.user_id
+            )
+
+    elif log_type == "delete.success" and cmd_id:
+        fingerprint_id_to_delete = _payload_id(obj)
+        if fingerprint_id_to_delete is None:
+            current_app.logger.error("Failed to delete Fingerprint record: payload.id missing for delete.success")
+        else:
+            Fingerprint.query.filter_by(id=int(fingerprint_id_to_delete)).delete()
+            current_app.logger.info(
+                "Deleted fingerprint record ID %s from database.",
+                fingerprint_id_to_delete
+            )
 
-        elif log_type == "match.fail":
-            # Nếu fail thì gửi cho TẤT CẢ webhook, tại vì quét fail thì trong log không có cmmd_id và id vân tay 
-            fingerprint_id = payload_data.get("id")
+    # Batch command: cập nhật item tương ứng trong cùng transaction
+    if cmd_id and log_type in BATCH_TERMINAL_LOG_TYPES:
+        reconcile_batch_item(cmd_id, log_type, _payload_id(obj), obj.get("description"))
+
+    # Always store the log row
+    log = Log(
+        created_at     = int(obj["created_at"]),
+        log_type       = obj.get("log_type"),
+        description    = obj.get("description"),
+        topic          = MQTT_TOPIC_FINGERPRINT_LOG,
+        command_id     = cmd_id,
+    )
+    log.set_payload(obj.get("payload"))
+    return log
 
-            webhooks = Webhook.query.order_by(Webhook.id.asc()).all()
-            if not webhooks:
-                app.logger.info("No webhooks configured; skipping match.fail notification")
-            else:
-                for wh in webhooks:
+def notify_fingerprint_log(obj, log):
+    cmd_id   = obj.get("command_id")
+    log_type = obj.get("log_type", "")
+    fingerprint_id = log.fingerprint_id
+
+    # ESP32 in description của mọi fingerprint log lên LCD -> nội dung LCD đã đổi
+    scheduler = current_app.extensions.get('command_scheduler')
+    if scheduler:
+        scheduler.invalidate(MQTT_TOPIC_LCD_COMMAND)
+
+    if log_type == "match.success":
+        if fingerprint_id is not None:
+            fp = db.session.get(Fingerprint, fingerprint_id)
+            if fp:
+                user = db.session.get(User, fp.user_id)
+                score_access_event(fp.user_id, log.created_at, source="fingerprint",
+                                   fingerprint_id=fingerprint_id)
+                wh = Webhook.query.filter_by(user_id=fp.user_id).first()
+                if wh:
+                    webhook_logger().debug("Webhook retrieved for user %s", user.username)
                     ok, code, body = wh.notify(
-                        content="❌ Có người quét vân tay nhưng thất bại",
-                        event="fingerprint.match.fail",
+                        content=f"✅ Người dùng {user.username} quét vân tay thành công",
+                        event="fingerprint.match.success",
                         fingerprint_id=fingerprint_id
                     )
                     if ok:
-                        app.logger.info(f"Sent webhook (match.fail) to {wh.url}")
+                        webhook_logger().info("Sent webhook (match.success) to %s", wh.url)
                     else:
-                        app.logger.error(f"Webhook failed ({code}) to {wh.url}: {body}")
- 
-        elif log_type == "enroll.success" and cmd_id:
-            original_command = db.session.get(Command, cmd_id)
-            user = User.query.filter_by(id=original_command.user_id).first()
-            
-            send_fingerprint_action_email(user.email, user.username, "enroll") # send email when user enroll a fingerprint successfully
+                        webhook_logger().error("Webhook failed (%s): %s", code, body)
+        else:
+            current_app.logger.warning("match.success missing fingerprint id")
+
+    elif log_type == "match.fail":
+        # Nếu fail thì gửi cho TẤT CẢ webhook, tại vì quét fail thì trong log không có cmmd_id và id vân tay 
+        score_failure_event(log.created_at)
+
+        # Quét fail liên tục -> chỉ event đầu được gửi ngay, phần còn lại gom thành một digest
+        digester = current_app.extensions.get('webhook_digester')
+        webhooks = Webhook.query.order_by(Webhook.id.asc()).all()
+        if not webhooks:
+            current_app.logger.info("No webhooks configured; skipping match.fail notification")
+        else:
+            for wh in webhooks:
+                if digester and not digester.offer((wh.id, "fingerprint.match.fail"), log.created_at):
+                    continue
+                ok, code, body = wh.notify(
+                    content="❌ Có người quét vân tay nhưng thất bại",
+                    event="fingerprint.match.fail",
+                    fingerprint_id=fingerprint_id
+                )
+                if ok:
+                    webhook_logger().info("Sent webhook (match.fail) to %s", wh.url)
+                else:
+                    webhook_logger().error("Webhook failed (%s) to %s: %s", code, wh.url, body)
+
+    elif log_type in ("enroll.success", "delete.success") and cmd_id:
+        # send email when user enroll/delete a fingerprint successfully (batch: một email khi xong cả batch)
+        original_command = db.session.get(Command, cmd_id)
+        user = db.session.get(User, original_command.user_id) if original_command else None
+        if user and not (is_batch_command(original_command) and batch_open_items(cmd_id)):
+            send_email(send_fingerprint_action_email, user.email, user.username,
+                       "enroll" if log_type == "enroll.success" else "delete")
+
+INGEST_PIPELINES = {
+    MQTT_TOPIC_CAPTURE:         (validate_capture,         build_capture,         notify_capture),
+    MQTT_TOPIC_SERVO_LOG:       (validate_servo_log,       build_servo_log,       notify_servo_log),
+    MQTT_TOPIC_FINGERPRINT_LOG: (validate_fingerprint_log, build_fingerprint_log, notify_fingerprint_log),
+}
+
+# mục dashboard cần invalidate sau khi ghi record của topic
+INGEST_DASHBOARD_SECTIONS = {
+    MQTT_TOPIC_CAPTURE:         ('latest_capture',),
+    MQTT_TOPIC_SERVO_LOG:       ('last_open',),
+    MQTT_TOPIC_FINGERPRINT_LOG: ('fingerprints', 'last_open'),
+}
+
+def store_records(topic: str, objs: list) -> list:
+    # Ghi mọi record trong một transaction: các row cùng bảng được flush thành một INSERT nhiều
+    # VALUES (RETURNING id). IntegrityError (trùng url, FK...) với batch -> ghi lại từng record trong
+    # SAVEPOINT để chỉ record lỗi bị loại. -> row hoặc Exception cho từng record, đúng thứ tự.
+    _, build, _ = INGEST_PIPELINES[topic]
+
+    def build_all():
+        out = []
+        for obj in objs:
             try:
-                fingerprint_id = payload_data.get("id")
-                if fingerprint_id is None:
-                    raise ValueError("payload.id missing for enroll.success")
-                fingerprint_id = int(fingerprint_id)
-
-                original_command = db.session.get(Command, cmd_id)
-                if original_command:
-                    fp = db.session.get(Fingerprint, fingerprint_id)
-                    if fp is None:
-                        fp = Fingerprint(
-                            id=fingerprint_id,
-                            user_id=original_command.user_id,
-                            name=f"Vân tay #{fingerprint_id}",
-                            created_at=int(obj["created_at"]),
-                        )
-                        db.session.add(fp)
-                    else:
-                        fp.user_id    = original_command.user_id
-                        fp.name       = fp.name or f"Vân tay #{fingerprint_id}"
-                        fp.created_at = int(obj["created_at"])
-                    db.session.commit()
-                    app.logger.info(
-                        "Linked fingerprint ID %s to user ID %s",
-                        fingerprint_id, original_command.user_id
-                    )
-            except Exception as e:
-                db.session.rollback()
-                app.logger.error(f"Failed to create/update Fingerprint link: {e}")
-
-        elif log_type == "delete.success" and cmd_id:
-            
-            original_command = db.session.get(Command, cmd_id)
-            user = User.query.filter_by(id=original_command.user_id).first()
-            send_fingerprint_action_email(user.email, user.username, "delete") # send email when user delete a fingerprint successfully
+                out.append(build(obj))
+            except (TypeError, ValueError) as e:
+                out.append(e)
+        return out
+
+    rows = build_all()
+    db.session.add_all([r for r in rows if not isinstance(r, Exception)])
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        if len(objs) == 1:
+            raise
+        rows = []
+        for obj in objs:
             try:
-                original_command = db.session.get(Command, cmd_id)
-                user = User.query.filter_by(id=original_command.user_id).first()
-                fingerprint_id_to_delete = payload_data.get("id")
-                if fingerprint_id_to_delete is None:
-                    raise ValueError("payload.id missing for delete.success")
-                fingerprint_id_to_delete = int(fingerprint_id_to_delete)
-
-                Fingerprint.query.filter_by(id=fingerprint_id_to_delete).delete()
-                db.session.commit()
-                app.logger.info(
-                    "Deleted fingerprint record ID %s from database.",
-                    fingerprint_id_to_delete
-                )
-            except Exception as e:
-                db.session.rollback()
-                app.logger.error(f"Failed to delete Fingerprint record: {e}")
-
-        # 4) Always store the log row
-        log = Log(
-            created_at     = int(obj["created_at"]),
-            log_type       = obj.get("log_type"),
-            description    = obj.get("description"),
-            payload        = obj.get("payload"),
-            topic          = MQTT_TOPIC_FINGERPRINT_LOG,
-            command_id     = cmd_id,
-        )
-        db.session.add(log)
+                with db.session.begin_nested():
+                    row = build(obj)
+                    db.session.add(row)
+                rows.append(row)
+            except (IntegrityError, TypeError, ValueError) as e:
+                rows.append(e)
+        db.session.commit()
+
+    stored = [r for r in rows if not isinstance(r, Exception)]
+    if stored:
+        invalidate_dashboard(*INGEST_DASHBOARD_SECTIONS[topic])
+    if topic == MQTT_TOPIC_CAPTURE:
+        for cap in stored:
+            current_app.extensions['capture_times'].add(cap.id, cap.timestamp)
+    if len(objs) == 1 and stored:
+        ingest_logger().info("Stored %s id=%s", DEVICE_TOPICS[topic], stored[0].id)
+    return rows
+
+def _record_error(e: Exception) -> str:
+    return str(getattr(e, "orig", None) or e)
+
+def spool_message(topic: str, raw: bytes) -> bool:
+    spool = current_app.extensions['ingest_spool']
+    if not spool.append(topic, raw):
+        current_app.logger.error("Ingest spool full; dropped message on %s", topic)
+        return False
+    current_app.extensions['spool_replayer'].notify()
+    return True
+
+def ingest(topic: str, raw: bytes, replay: bool = False) -> list | None:
+    # -> kết quả từng record [{"index", "ok", "id" | "error" | "spooled"}], None nếu JSON hỏng
+    validate, _, notify = INGEST_PIPELINES[topic]
+    data = decode_message(topic, raw)
+    if data is None:
+        return None
+    batch   = isinstance(data, list)
+    records = data if batch else [data]
+    if batch and len(records) > current_app.config['INGEST_BATCH_MAX']:
+        current_app.logger.warning("Batch of %s records on %s exceeds INGEST_BATCH_MAX; dropped", len(records), topic)
+        return [{"index": i, "ok": False, "error": "batch too large"} for i in range(len(records))]
+
+    results: list = [None] * len(records)
+    valid = []                                   # (index, obj)
+    for i, rec in enumerate(records):
+        try:
+            obj = validate(rec)
+        except ValueError as e:
+            current_app.logger.warning("Rejected record on %s: %s | payload=%r", topic, e, rec)
+            results[i] = {"index": i, "ok": False, "error": str(e)}
+            continue
+        valid.append((i, obj))
+        if not replay:
+            track_device(topic, obj)
+    if not valid:
+        return results
+
+    def mark_spooled(ok: bool):
+        for i, _ in valid:
+            results[i] = {"index": i, "ok": ok, "spooled": ok} if ok else {"index": i, "ok": False, "error": "database unavailable"}
+        return results
+
+    spool = current_app.extensions.get('ingest_spool')
+    if spool is not None and not replay and len(spool):
+        return mark_spooled(spool_message(topic, raw))
+
+    try:
+        rows = store_records(topic, [obj for _, obj in valid])
+    except IntegrityError as e:
+        db.session.rollback()
+        current_app.logger.info("Duplicate/invalid row ignored on %s: %s", topic, e.orig)
+        i = valid[0][0]
+        results[i] = {"index": i, "ok": False, "error": _record_error(e)}
+        return results
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        if replay:
+            raise                       # SpoolReplayer giữ record lại và thử lại sau
+        if spool is None:
+            current_app.logger.exception("DB insert failed: %s", e)
+            return mark_spooled(False)
+        current_app.logger.warning("DB insert failed on %s, spooled for replay: %s", topic, e)
+        return mark_spooled(spool_message(topic, raw))
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.exception("Ingest failed on %s: %s", topic, e)
+        return mark_spooled(False)
+
+    for (i, obj), row in zip(valid, rows):
+        if isinstance(row, Exception):
+            current_app.logger.info("Record %s rejected on %s: %s", i, topic, _record_error(row))
+            results[i] = {"index": i, "ok": False, "error": _record_error(row)}
+            continue
+        results[i] = {"index": i, "ok": True, "id": row.id}
         try:
-            db.session.commit()
-            app.logger.info("Stored fingerprint log id=%s", log.id)
+            notify(obj, row)
         except Exception as e:
             db.session.rollback()
-            app.logger.exception("DB insert failed for fingerprint log: %s", e)
+            current_app.logger.exception("Notify failed on %s: %s", topic, e)
+    if batch:
+        ingest_logger().info("Stored %s/%s record(s) from batch on %s",
+                             sum(1 for r in results if r["ok"]), len(records), topic)
+    return results
+
+def replay_spooled(topic: str, raw: bytes):
+    ingest(topic, raw, replay=True)
+
+def handle_capture_topic(client, userdata, message):
+    ingest(MQTT_TOPIC_CAPTURE, message.payload)
+
+def handle_servo_log(client, userdata, message):
+    ingest(MQTT_TOPIC_SERVO_LOG, message.payload)
 
-@app.route('/api/servo', methods=['POST'])
+def handle_fingerprint_log(client, userdata, message):
+    ingest(MQTT_TOPIC_FINGERPRINT_LOG, message.payload)
+
+@api.route('/api/servo', methods=['POST'])
 @jwt_required()
 def servo_command():
     # 0) caller identity ----------------------------------------------------
@@ -518,11 +1368,38 @@ def servo_command():
     action = (data.get('action') or '').lower()
     if action not in ('open', 'close'):
         return jsonify(error="action must be 'open' or 'close'"), 400
+    auto_close = data.get('auto_close')          # giây; chỉ dùng với 'open'
+    if auto_close is not None and (action != 'open' or not isinstance(auto_close, int) or isinstance(auto_close, bool) or auto_close <= 0):
+        return jsonify(error="auto_close must be a positive number of seconds and requires action 'open'"), 400
+
+    # 2-5) Command row + coalesce + publish -----------------------------------
+    cmd, ticket, held = issue_servo_command(uid, action)
+    if auto_close:
+        add_schedule(Schedule(user_id=uid, command_type='servo.close', kind='once',
+                              next_run_at=int(time.time()) + auto_close))
+    if held:
+        return jsonify(id=cmd.id, status=cmd.status, topic=cmd.topic, payload=cmd.payload), 202
+
+    # 6) optionally wait for the broker's PUBACK ------------------------------
+    code = wait_for_command(cmd, ticket)
 
+    return (
+        jsonify(
+            id      = cmd.id,
+            status  = cmd.status,
+            topic   = cmd.topic,
+            payload = cmd.payload,
+            note    = cmd.note
+        ),
+        code
+    )
+
+def issue_servo_command(uid: int, action: str):
+    # Dùng chung cho /api/servo và Schedule -> (cmd, ticket, held)
     created_at   = int(datetime.utcnow().timestamp())
     command_type = f"servo.{action}"
 
-    # 2) create row first, flush to get ID ----------------------------------
+    # create row first, flush to get ID
     cmd = Command(
         created_at   = created_at,
         user_id      = uid,
@@ -533,120 +1410,70 @@ def servo_command():
     db.session.add(cmd)
     db.session.flush()                    # allocates cmd.id without commit
 
-    # 3) build payload & publish -------------------------------------------
-    payload = json.dumps({"cmd_id": cmd.id, "action": action})
-    published_ok = mqtt.publish(MQTT_TOPIC_SERVO_COMMAND, payload, qos=0)
-        
-    # 4) finalise row -------------------------------------------------------
-    cmd.payload = payload
-    cmd.status  = 'sent' if published_ok else 'error'
-    cmd.note    = None   if published_ok else 'mqtt.publish() returned False'
+    # build payload, commit so the scheduler thread can see the row
+    cmd.payload = json.dumps({"cmd_id": cmd.id, "action": action})
     db.session.commit()
 
-    return (
-        jsonify(
-            id      = cmd.id,
-            status  = cmd.status,
-            topic   = cmd.topic,
-            payload = cmd.payload
-        ),
-        200 if published_ok else 500
-    )
-
-from sqlalchemy import or_, and_
-import json
-
-@app.route('/api/servo/last-open', methods=['GET'])
-@jwt_required()
-def api_servo_last_open():
-    # Lấy một tập ứng viên mới nhất gồm:
-    # - servo.status + payload == "open"  (mở bằng giao diện web)
-    # - match.success                    (mở bằng vân tay)
-    candidates = db.session.execute(
-        select(Log)
-        .where(
-            or_(
-                and_(Log.log_type == 'servo.status', Log.payload.in_(['open', '"open"'])),
-                Log.log_type == 'match.success'
-            )
-        )
+    # coalesce: rapid toggles within the window are held, last one wins
+    scheduler = current_app.extensions.get('command_scheduler')
+    if scheduler and scheduler.submit(MQTT_TOPIC_SERVO_COMMAND, action, cmd.id) == HELD:
+        return cmd, None, True
+    return cmd, publish_command(cmd), False
+
+def last_open_event() -> dict | None:
+    # Hai nguồn mở cửa, mỗi nguồn là một lookup theo index (không parse payload từng dòng):
+    # - servo.status + action == "open"  (mở bằng giao diện web)  -> ix_log_action_created
+    # - match.success + fingerprint_id     (mở bằng vân tay)        -> ix_log_type_created
+    web = db.session.execute(
+        select(Log.id, Log.created_at, User.id, User.username)
+        .join(Command, Command.id == Log.command_id)
+        .join(User, User.id == Command.user_id)
+        .where(Log.action == 'open', Log.log_type == 'servo.status')
         .order_by(Log.created_at.desc(), Log.id.desc())
-        .limit(200)
-    ).scalars().all()
-
-    for log in candidates:
-        # Trường hợp mở bằng web: servo.status + payload=open
-        if log.log_type == 'servo.status':
-            payload_val = (str(log.payload) or '').strip('"').lower()
-            if payload_val != 'open':
-                continue
-            if not log.command_id:
-                continue
-
-            cmd = db.session.get(Command, int(log.command_id))
-            if not cmd or not cmd.user_id:
-                continue
-
-            user = cmd.user or db.session.get(User, int(cmd.user_id))
-            if not user:
-                continue
-
-            return jsonify({
-                "id": user.id,
-                "username": user.username,
-                "source": "web",
-                "log_id": log.id,
-                "created_at": log.created_at
-            }), 200
-
-        # Trường hợp mở bằng vân tay: match.success + payload chứa {"id": <fingerprint_id>, ...}
-        elif log.log_type == 'match.success':
-            fp_id = None
-            raw = log.payload
-
-            if isinstance(raw, dict):
-                fp_id = raw.get('id')
-            else:
-                data = {}
-                try:
-                    data = json.loads(raw) if raw else {}
-                except Exception:
-                    try:
-                        import ast
-                        data = ast.literal_eval(raw) if raw else {}
-                    except Exception:
-                        data = {}
-                if isinstance(data, dict):
-                    fp_id = data.get('id')
-
-            try:
-                fp_id = int(fp_id) if fp_id is not None else None
-            except Exception:
-                fp_id = None
+        .limit(1)
+    ).first()
 
-            if not fp_id:
-                continue
+    finger = db.session.execute(
+        select(Log.id, Log.created_at, User.id, User.username, Log.fingerprint_id)
+        .join(Fingerprint, Fingerprint.id == Log.fingerprint_id)
+        .join(User, User.id == Fingerprint.user_id)
+        .where(Log.log_type == 'match.success')
+        .order_by(Log.created_at.desc(), Log.id.desc())
+        .limit(1)
+    ).first()
 
-            fp = db.session.get(Fingerprint, fp_id)
-            if not fp or not fp.user_id:
-                continue
+    if web is None and finger is None:
+        return None
 
-            user = db.session.get(User, int(fp.user_id))
-            if not user:
-                continue
+    if finger is None or (web is not None and (web[1], web[0]) > (finger[1], finger[0])):
+        log_id, created_at, user_id, username = web
+        return {
+            "id": user_id,
+            "username": username,
+            "source": "web",
+            "log_id": log_id,
+            "created_at": created_at
+        }
 
-            return jsonify({
-                "id": user.id,
-                "username": user.username,
-                "source": "fingerprint",
-                "fingerprint_id": fp_id,
-                "log_id": log.id,
-                "created_at": log.created_at
-            }), 200
+    log_id, created_at, user_id, username, fp_id = finger
+    return {
+        "id": user_id,
+        "username": username,
+        "source": "fingerprint",
+        "fingerprint_id": fp_id,
+        "log_id": log_id,
+        "created_at": created_at
+    }
 
-    return jsonify(error="No open event found"), 404
+@api.route('/api/servo/last-open', methods=['GET'])
+@jwt_required()
+def api_servo_last_open():
+    event = last_open_event()
+    if event is None:
+        return jsonify(error="No open event found"), 404
+    return jsonify(event), 200
 
-@app.route('/api/lcd', methods=['POST'])
+@api.route('/api/lcd', methods=['POST'])
 @jwt_required()
 def lcd_command():
     data = request.get_json()
@@ -654,41 +1481,338 @@ def lcd_command():
     if not message:
         return jsonify({"error": "Message is required"}), 400
     
-    user_id = get_jwt_identity()
+    cmd, ticket, skipped = issue_lcd_command(get_jwt_identity(), message)
+    if skipped:
+        return jsonify({"status": "ok", "message": message, "skipped": True})
+    code = wait_for_command(cmd, ticket)
+    if code == 500:
+        return jsonify(error=cmd.note or "LCD command failed", command_id=cmd.id), 500
+    return jsonify({"status": "ok", "message": message, "command_id": cmd.id, "command_status": cmd.status}), code
+
+def issue_lcd_command(user_id, message: str):
+    # Dùng chung cho /api/lcd và Schedule -> (cmd, ticket, skipped)
     cmd = Command(
         created_at=int(datetime.utcnow().timestamp()),
         user_id=user_id,
         command_type='lcd.set',
         topic=MQTT_TOPIC_LCD_COMMAND,
         payload=message,
-        status='sent'
+        status='pending'
     )
     db.session.add(cmd)
+    # LCD đang hiển thị đúng nội dung này -> không gửi lại xuống thiết bị
+    scheduler = current_app.extensions.get('command_scheduler')
+    if scheduler and scheduler.is_current(MQTT_TOPIC_LCD_COMMAND, message):
+        cmd.status = 'superseded'
+        cmd.note   = 'identical to current display'
+        db.session.commit()
+        return cmd, None, True
+    db.session.commit()
+    # Publish to MQTT; trạng thái LCD được cập nhật khi có ack (on_command_published)
+    return cmd, publish_command(cmd), False
+
+# ─── Schedules ────────────────────────────────────────────────────────────────
+# Mỗi schedule đang bật nằm trong TimerHeap (RAM) với deadline next_run_at; thread của heap chỉ
+# thức ở deadline gần nhất. Bảng schedule là nguồn gốc: load_schedules() nạp lại sau restart.
+
+def schedule_next_run(s: 'Schedule', after: int) -> int | None:
+    if s.kind == 'interval':
+        base = s.next_run_at or after
+        # bỏ qua các lần đã lỡ, giữ nguyên nhịp (base + k * every_s)
+        return base + ((after - base) // s.every_s + 1) * s.every_s
+    if s.kind == 'weekly':
+        return next_weekly(after, s.weekdays, s.time_of_day, ZoneInfo(current_app.config['SCHEDULE_TZ']))
+    return None
+
+def add_schedule(s: 'Schedule') -> 'Schedule':
+    s.created_at = int(time.time())
+    s.enabled    = True
+    db.session.add(s)
+    db.session.commit()
+    timers = current_app.extensions.get('schedule_timers')
+    if timers is not None and s.next_run_at is not None:
+        timers.schedule(s.id, s.next_run_at)
+    return s
+
+def load_schedules():
+    timers = current_app.extensions.get('schedule_timers')
+    if timers is None:
+        return
+    try:
+        rows = db.session.execute(
+            select(Schedule.id, Schedule.next_run_at)
+            .where(Schedule.enabled.is_(True), Schedule.next_run_at.isnot(None))
+        ).all()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        current_app.logger.warning("Loading schedules failed: %s", e)
+        return
+    for schedule_id, next_run_at in rows:
+        timers.schedule(schedule_id, next_run_at)
+    current_app.logger.info("Loaded %s schedule(s)", len(rows))
+
+def run_schedule(schedule_id: int):
+    # gọi từ thread của TimerHeap khi tới hạn
+    s = db.session.get(Schedule, schedule_id)
+    if s is None or not s.enabled or s.next_run_at is None:
+        return
+    timers = current_app.extensions['schedule_timers']
+    now, due = int(time.time()), s.next_run_at
+    if due > now:
+        timers.schedule(schedule_id, due)
+        return
+    nxt = schedule_next_run(s, now)
+    # claim: nhiều worker cùng nạp schedule -> chỉ worker cập nhật được next_run_at mới chạy lệnh
+    claimed = db.session.execute(
+        update(Schedule)
+        .where(Schedule.id == schedule_id, Schedule.next_run_at == due)
+        .values(next_run_at=nxt, enabled=nxt is not None, last_run_at=now)
+    ).rowcount
+    db.session.commit()
+    if not claimed:
+        return
+    if nxt is not None:
+        timers.schedule(schedule_id, nxt)
+    if now - due > current_app.config['SCHEDULE_MISFIRE_GRACE']:
+        current_app.logger.warning("Schedule %s missed its run at %s by %ss; skipped", schedule_id, due, now - due)
+        return
+
+    s = db.session.get(Schedule, schedule_id)
+    if s.command_type == 'lcd.set':
+        cmd, _, _ = issue_lcd_command(s.user_id, s.message)
+    else:
+        cmd, _, _ = issue_servo_command(s.user_id, s.command_type.split('.', 1)[1])
+    s.last_command_id = cmd.id
     db.session.commit()
+    current_app.logger.info("Schedule %s issued command %s (%s)", schedule_id, cmd.id, s.command_type)
+
+def _schedule_int(data: dict, name: str) -> int:
+    value = data[name]
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f"{name} must be an integer")
+    try:
+        return int(value)
+    except (ValueError, OverflowError):
+        raise ValueError(f"{name} must be an integer") from None
+
+def parse_schedule(data: dict, uid: int) -> 'Schedule':
+    # {"command": "servo.open"|"servo.close"|"lcd.set", "message"?, và một trong:
+    #  "delay": giây | "at": epoch | "every": giây[, "start": epoch] | "weekly": {"days": [...], "time": "HH:MM"}}
+    # Lỗi đầu vào -> ValueError với thông điệp trả thẳng cho client
+    if not isinstance(data, dict):
+        raise ValueError("body must be a JSON object")
+    command_type = data.get('command') or ''
+    command_type = command_type.lower() if isinstance(command_type, str) else ''
+    if command_type not in ('servo.open', 'servo.close', 'lcd.set'):
+        raise ValueError("command must be 'servo.open', 'servo.close' or 'lcd.set'")
+    message = data.get('message')
+    if message is not None and not isinstance(message, str):
+        raise ValueError("message must be a string")
+    message = (message or '').strip() or None
+    if command_type == 'lcd.set' and not message:
+        raise ValueError("message is required for lcd.set")
+
+    now = int(time.time())
+    s = Schedule(user_id=uid, command_type=command_type, message=message if command_type == 'lcd.set' else None)
+    if data.get('delay') is not None or data.get('at') is not None:
+        s.kind = 'once'
+        s.next_run_at = now + _schedule_int(data, 'delay') if data.get('delay') is not None else _schedule_int(data, 'at')
+        if s.next_run_at <= now:
+            raise ValueError("schedule time must be in the future")
+    elif data.get('every') is not None:
+        s.kind, s.every_s = 'interval', _schedule_int(data, 'every')
+        if s.every_s < current_app.config['SCHEDULE_MIN_INTERVAL']:
+            raise ValueError(f"every must be >= {current_app.config['SCHEDULE_MIN_INTERVAL']} seconds")
+        s.next_run_at = _schedule_int(data, 'start') if data.get('start') else now + s.every_s
+        if s.next_run_at <= now:
+            s.next_run_at = schedule_next_run(s, now)
+    elif isinstance(data.get('weekly'), dict):
+        days = data['weekly'].get('days') or []
+        if not isinstance(days, list):
+            raise ValueError("weekly.days must be a list")
+        s.kind        = 'weekly'
+        s.weekdays    = weekday_mask(days)
+        s.time_of_day = parse_time_of_day(str(data['weekly'].get('time') or ''))
+        s.next_run_at = schedule_next_run(s, now)
+    else:
+        raise ValueError("one of delay, at, every or weekly is required")
+    return s
+
+@api.route('/api/schedules', methods=['GET'])
+@jwt_required()
+def list_schedules():
+    uid = int(get_jwt_identity())
+    items = db.session.execute(
+        select(Schedule).where(Schedule.user_id == uid).order_by(Schedule.next_run_at.is_(None), Schedule.next_run_at)
+    ).scalars().all()
+    return jsonify(items=[s.to_dict() for s in items], timezone=current_app.config['SCHEDULE_TZ']), 200
+
+@api.route('/api/schedules', methods=['POST'])
+@jwt_required()
+def create_schedule():
+    try:
+        uid = int(get_jwt_identity() or -1)
+    except ValueError:
+        return jsonify(error='Invalid token identity'), 422
+    count = db.session.execute(
+        select(func.count()).select_from(Schedule).where(Schedule.user_id == uid, Schedule.enabled.is_(True))
+    ).scalar_one()
+    if count >= current_app.config['SCHEDULE_MAX_PER_USER']:
+        return jsonify(error="Too many active schedules"), 409
+    try:
+        s = parse_schedule(request.get_json() or {}, uid)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(add_schedule(s).to_dict()), 201
 
-    # Publish to MQTT
-    mqtt.publish(MQTT_TOPIC_LCD_COMMAND, message)
-    return jsonify({"status": "ok", "message": message})
+@api.route('/api/schedules/<int:schedule_id>', methods=['DELETE'])
+@jwt_required()
+def delete_schedule(schedule_id):
+    uid = int(get_jwt_identity())
+    s = db.session.get(Schedule, schedule_id)
+    if s is None or s.user_id != uid:
+        return jsonify(error="Schedule not found"), 404
+    db.session.delete(s)
+    db.session.commit()
+    timers = current_app.extensions.get('schedule_timers')
+    if timers is not None:
+        timers.cancel(schedule_id)
+    return jsonify(message="Schedule deleted", id=schedule_id), 200
 
-@app.route('/api/fingerprints', methods=['GET'])
+@api.route('/api/fingerprints', methods=['GET'])
 @jwt_required()
 def get_all_fingerprints():
-    fingerprints = Fingerprint.query.order_by(Fingerprint.id).all()
-    count = len(fingerprints)
+    items = Fingerprint.list_dicts()
+    count = len(items)
 
     # Gói dữ liệu vào một object
     response_data = {
-        "items": [fp.to_dict() for fp in fingerprints],
+        "items": items,
         "count": count,
-        "capacity": FINGERPRINT_MAX_CAPACITY
+        "capacity": current_app.config['FINGERPRINT_MAX_CAPACITY']
     }
     return jsonify(response_data), 200
 
-@app.route('/api/fingerprint/register', methods=['POST'])
+def fingerprint_slots_used() -> int:
+    # slot đã có Fingerprint + enroll của batch đang chờ thiết bị (chưa quá hạn), trong một query
+    recent = int(time.time()) - current_app.config['FINGERPRINT_ENROLL_TIMEOUT']
+    return db.session.execute(select(
+        select(func.count()).select_from(Fingerprint).scalar_subquery()
+        + select(func.count()).select_from(CommandItem).where(
+            CommandItem.action == 'enroll',
+            CommandItem.status.in_(('pending', 'sent')),
+            CommandItem.updated_at >= recent,
+        ).scalar_subquery()
+    )).scalar_one()
+
+def batch_to_dict(cmd) -> dict:
+    items = db.session.execute(
+        select(CommandItem).where(CommandItem.command_id == cmd.id).order_by(CommandItem.seq)
+    ).scalars().all()
+    counts: dict[str, int] = {}
+    for item in items:
+        counts[item.status] = counts.get(item.status, 0) + 1
+    return dict(cmd.to_dict(), items=[item.to_dict() for item in items], counts=counts)
+
+MAX_FINGERPRINT_BATCH = 50
+
+@api.route('/api/fingerprints/batch', methods=['POST'])
+@jwt_required()
+def fingerprint_batch_command():
+    # {"action": "enroll", "count": N}
+    # {"action": "delete", "ids": [...]} | {"action": "delete", "user_id": X} | {"action": "delete", "all": true}
+    try:
+        uid = int(get_jwt_identity() or -1)
+    except ValueError:
+        return jsonify(error='Invalid token identity'), 422
+
+    data   = request.get_json() or {}
+    action = (data.get('action') or '').lower()
+    if action == 'enroll':
+        count = data.get('count')
+        if not isinstance(count, int) or not (1 <= count <= MAX_FINGERPRINT_BATCH):
+            return jsonify(error=f"count must be an integer in [1, {MAX_FINGERPRINT_BATCH}]"), 400
+        slots = [None] * count
+    elif action == 'delete':
+        if data.get('all'):
+            slots = list(db.session.execute(select(Fingerprint.id).order_by(Fingerprint.id)).scalars())
+        elif data.get('user_id') is not None:
+            slots = list(db.session.execute(
+                select(Fingerprint.id).where(Fingerprint.user_id == data.get('user_id')).order_by(Fingerprint.id)
+            ).scalars())
+        else:
+            ids = data.get('ids')
+            if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+                return jsonify(error="ids must be a list of fingerprint ids"), 400
+            slots = list(dict.fromkeys(ids))
+        if not slots:
+            return jsonify(error="No fingerprints to delete"), 404
+        if len(slots) > MAX_FINGERPRINT_BATCH:
+            return jsonify(error=f"At most {MAX_FINGERPRINT_BATCH} fingerprints per batch"), 400
+    else:
+        return jsonify(error="action must be 'enroll' or 'delete'"), 400
+
+    now = int(time.time())
+    cmd = Command(
+        created_at   = now,
+        user_id      = uid,
+        command_type = f"{BATCH_COMMAND_PREFIX}{action}",
+        topic        = MQTT_TOPIC_FINGERPRINT_COMMAND,
+        payload      = json.dumps({"action": action, "count": len(slots), "ids": [i for i in slots if i is not None]}),
+        status       = 'pending',
+    )
+    db.session.add(cmd)
+    # INSERT trước khi đếm: SQLite giữ write lock tới commit nên batch khác phải chờ -> phép
+    # kiểm tra capacity + ghi item là atomic
+    db.session.flush()
+    if action == 'enroll':
+        used, capacity = fingerprint_slots_used(), current_app.config['FINGERPRINT_MAX_CAPACITY']
+        if used + len(slots) > capacity:
+            db.session.rollback()
+            return jsonify(error="Not enough fingerprint capacity for this batch.",
+                           used=used, capacity=capacity, requested=len(slots)), 409
+    items = [
+        CommandItem(command_id=cmd.id, seq=i, action=action, fingerprint_id=slot, status='pending', updated_at=now)
+        for i, slot in enumerate(slots)
+    ]
+    db.session.add_all(items)
+    db.session.commit()
+    invalidate_dashboard('fingerprints', 'commands')
+
+    # Publish kiểu pipeline qua AckPublisher: không chờ PUBACK giữa các message
+    publisher = current_app.extensions.get('mqtt_publisher')
+    tickets = []
+    for item in items:
+        msg = {"cmd_id": cmd.id, "action": action}
+        if item.fingerprint_id is not None:
+            msg["id"] = item.fingerprint_id
+        if publisher is None:
+            on_batch_item_published(item.id, False, 'MQTT disabled')
+            continue
+        tickets.append(publisher.publish(cmd.topic, json.dumps(msg), current_app.config['MQTT_COMMAND_QOS'],
+                                         item=("item", item.id)))
+
+    deadline = time.monotonic() + ack_wait()
+    for ticket in tickets:
+        if not ticket.wait(max(0.0, deadline - time.monotonic())):
+            break
+    db.session.expire_all()
+    cmd = db.session.get(Command, cmd.id)
+    code = {'sent': 200, 'error': 500}.get(cmd.status, 202)
+    return jsonify(batch_to_dict(cmd)), code
+
+@api.route('/api/fingerprints/batch/<int:cmd_id>', methods=['GET'])
+@jwt_required()
+def fingerprint_batch_status(cmd_id):
+    cmd = db.session.get(Command, cmd_id)
+    if not is_batch_command(cmd):
+        return jsonify(error="Batch command not found"), 404
+    return jsonify(batch_to_dict(cmd)), 200
+
+@api.route('/api/fingerprint/register', methods=['POST'])
 @jwt_required()
 def fingerprint_register_command():
-    current_fingerprint_count = Fingerprint.query.count()
-    if current_fingerprint_count >= FINGERPRINT_MAX_CAPACITY:
+    if fingerprint_slots_used() >= current_app.config['FINGERPRINT_MAX_CAPACITY']:
         return jsonify(error="Fingerprint capacity is full. Cannot add more."), 409
     
     # 0) caller identity ----------------------------------------------------
@@ -711,27 +1835,25 @@ def fingerprint_register_command():
     db.session.add(cmd)
     db.session.flush()
 
-    # 3) build payload & publish -------------------------------------------
-    payload = json.dumps({"cmd_id": cmd.id, "action": "enroll"})
-    published_ok = mqtt.publish(MQTT_TOPIC_FINGERPRINT_COMMAND, payload, qos=1)
-
-    # 4) finalise row -------------------------------------------------------
-    cmd.payload = payload
-    cmd.status  = 'sent' if published_ok else 'error'
-    cmd.note    = None   if published_ok else 'mqtt.publish() returned False'
+    # 3) build payload, commit, publish -------------------------------------
+    cmd.payload = json.dumps({"cmd_id": cmd.id, "action": "enroll"})
     db.session.commit()
 
+    # 4) optionally wait for the broker's PUBACK ------------------------------
+    code = wait_for_command(cmd, publish_command(cmd))
+
     return (
         jsonify(
             id      = cmd.id,
             status  = cmd.status,
             topic   = cmd.topic,
-            payload = cmd.payload
+            payload = cmd.payload,
+            note    = cmd.note
         ),
-        200 if published_ok else 500
+        code
     )
 
-@app.route('/api/register/send-otp', methods=['POST'])
+@api.route('/api/register/send-otp', methods=['POST'])
 def register_send_otp():
     data = request.get_json() or {}
     form_username = data.get('username')
@@ -742,10 +1864,10 @@ def register_send_otp():
     if User.query.filter((User.username == form_username) | (User.email == form_email)).first():
         return jsonify(error='User exists'), 409
     code = OTPRequest.create(form_email, db)
-    send_registration_email(form_email, form_username ,code)
+    send_email(send_registration_email, form_email, form_username ,code)
     return jsonify(message='OTP sent'), 200
 
-@app.route('/api/register/verify', methods=['POST'])
+@api.route('/api/register/verify', methods=['POST'])
 def register_verify():
     data = request.get_json() or {}
     form_username = data.get('username')
@@ -754,6 +1876,14 @@ def register_verify():
     form_otp = data.get('otp')
     if not all([form_username, form_email, form_password, form_otp]):
         return jsonify(error='Missing fields'), 400 
+    if not isinstance(form_email, str) or not isinstance(form_password, str):
+        return jsonify(error='Invalid fields'), 400
+    limited = throttled(
+        ('ip', request.remote_addr),
+        ('email', f"verify:{form_email.strip().lower()}"),
+    )
+    if limited:
+        return limited
     if User.query.filter((User.username == form_username) | (User.email == form_email)).first():
         return jsonify(error='User exists'), 409
     
@@ -778,13 +1908,21 @@ def register_verify():
     db.session.commit()
     return jsonify(message='Registration complete'), 201
 
-@app.route('/api/login', methods=['POST'])
+@api.route('/api/login', methods=['POST'])
 def login():
     data = request.get_json() or {}
     e = data.get('email')
     p = data.get('password')
     if not all([e, p]):
         return jsonify(error='Missing fields'), 400
+    if not isinstance(e, str) or not isinstance(p, str):
+        return jsonify(error='Invalid fields'), 400
+    limited = throttled(
+        ('ip', request.remote_addr),
+        ('email', f"login:{e.strip().lower()}"),
+    )
+    if limited:
+        return limited
     user = User.query.filter_by(email=e).first()
     if user and user.check_password(p):
         token = create_access_token(identity=str(user.id))
@@ -793,7 +1931,7 @@ def login():
         return resp, 200
     return jsonify(error='Invalid credentials'), 401
 
-@app.route('/api/authorize', methods=['GET'])
+@api.route('/api/authorize', methods=['GET'])
 @jwt_required()
 def authorize():
     user_id = get_jwt_identity()
@@ -806,14 +1944,154 @@ def authorize():
     resp.headers.pop('ETag', None)
     return resp
 
-@app.route('/api/logout', methods=['POST'])
+@api.route('/api/health', methods=['GET'])
+def health():
+    return jsonify(
+        role          = current_app.config['APP_ROLE'],
+        mqtt_enabled  = current_app.config['MQTT_ENABLED'],
+        mqtt_connected= mqtt_connected(),
+        cold_start_ms = current_app.config.get('COLD_START_MS'),
+        log_dropped   = current_app.extensions['log_handler'].dropped,
+    ), 200
+
+@api.route('/api/admin/queries', methods=['GET'])
+@admin_required
+def admin_queries():
+    stats = current_app.extensions.get('query_stats')
+    if stats is None:
+        return jsonify(error="Query stats disabled"), 404
+    try:
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify(error="limit must be an integer"), 400
+    limit = max(1, min(limit, 500))
+    slow_only = request.args.get('slow_only', '').lower() in ('1', 'true', 'yes')
+    try:
+        snap = stats.snapshot(limit=limit, sort=request.args.get('sort', 'total'), slow_only=slow_only)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(snap), 200
+
+@api.route('/api/admin/queries', methods=['DELETE'])
+@admin_required
+def admin_queries_reset():
+    stats = current_app.extensions.get('query_stats')
+    if stats is None:
+        return jsonify(error="Query stats disabled"), 404
+    stats.reset()
+    return jsonify(message="Query stats reset"), 200
+
+# ─── Profiling ───────────────────────────────────
+# Sampling: admin bật cho một số endpoint và/hoặc MQTT handler trong `duration` giây.
+# cProfile: request của admin kèm header "X-Profile: 1" -> response có X-Profile-Id.
+
+PROFILE_HEADER = 'X-Profile'
+MAX_PROFILE_DURATION = 600
+
+@api.before_request
+def _profiling_begin():
+    profiler = current_app.extensions.get('profiler')
+    if profiler is None:
+        return
+    if request.headers.get(PROFILE_HEADER) and is_admin_request():
+        prof = profiler.begin_cprofile()
+        if prof is not None:
+            g.cprofile = (prof, time.time())
+    if profiler.wants_route(request.endpoint):
+        g.profile_track = profiler.sampler.track(request.endpoint)
+        g.profile_track.__enter__()
+
+@api.after_request
+def _profiling_end(resp):
+    started = g.pop('cprofile', None)
+    if started is not None:
+        entry = current_app.extensions['profiler'].end_cprofile(
+            started[0], f"{request.method} {request.path}", started[1])
+        resp.headers['X-Profile-Id'] = str(entry['id'])
+    return resp
+
+@api.teardown_request
+def _profiling_teardown(exc):
+    track = g.pop('profile_track', None)
+    if track is not None:
+        track.__exit__(None, None, None)
+    started = g.pop('cprofile', None)
+    if started is not None:
+        current_app.extensions['profiler'].end_cprofile(
+            started[0], f"{request.method} {request.path} (error)", started[1])
+
+@api.route('/api/admin/profiling', methods=['GET'])
+@admin_required
+def admin_profiling_status():
+    profiler = current_app.extensions['profiler']
+    return jsonify(
+        running    = profiler.sampler.running,
+        routes     = sorted(profiler.routes),
+        mqtt       = profiler.mqtt,
+        started_at = profiler.sampler.started_at if profiler.sampler.running else None,
+        endpoints  = sorted(e for e in current_app.view_functions if e.startswith('api.')),
+    ), 200
+
+@api.route('/api/admin/profiling', methods=['POST'])
+@admin_required
+def admin_profiling_start():
+    data = request.get_json() or {}
+    routes = data.get('routes') or []
+    if not isinstance(routes, list):
+        return jsonify(error="routes must be a list of endpoint names"), 400
+    unknown = [r for r in routes if r not in current_app.view_functions]
+    if unknown:
+        return jsonify(error=f"Unknown endpoints: {', '.join(map(str, unknown))}"), 400
+    mqtt_handlers = bool(data.get('mqtt'))
+    if not routes and not mqtt_handlers:
+        return jsonify(error="Select at least one endpoint or mqtt"), 400
+    try:
+        duration = float(data.get('duration', 60))
+    except (TypeError, ValueError):
+        return jsonify(error="duration must be a number of seconds"), 400
+    duration = max(1.0, min(duration, MAX_PROFILE_DURATION))
+
+    current_app.extensions['profiler'].start_sampling(routes, mqtt_handlers, duration)
+    return jsonify(message="Sampling started", routes=routes, mqtt=mqtt_handlers, duration=duration), 202
+
+@api.route('/api/admin/profiling', methods=['DELETE'])
+@admin_required
+def admin_profiling_stop():
+    entry = current_app.extensions['profiler'].stop_sampling()
+    if entry is None:
+        return jsonify(error="Sampling is not running"), 409
+    return jsonify({k: v for k, v in entry.items() if k != '_data'}), 200
+
+@api.route('/api/admin/profiles', methods=['GET'])
+@admin_required
+def admin_profiles():
+    return jsonify(items=current_app.extensions['profiler'].list()), 200
+
+@api.route('/api/admin/profiles/<int:profile_id>', methods=['GET'])
+@admin_required
+def admin_profile_download(profile_id):
+    found = current_app.extensions['profiler'].get(profile_id, request.args.get('format'))
+    if found is None:
+        return jsonify(error="Profile not found"), 404
+    entry, fmt, data = found
+    # collapsed: flamegraph.pl / speedscope; prof: pstats / snakeviz
+    ext, mimetype = {
+        'collapsed': ('folded', 'text/plain'),
+        'text':      ('txt', 'text/plain'),
+        'prof':      ('prof', 'application/octet-stream'),
+    }[fmt]
+    resp = Response(data, mimetype=mimetype)
+    resp.headers['Content-Disposition'] = f'attachment; filename="profile-{entry["id"]}.{ext}"'
+    return resp
+
+@api.route('/api/logout', methods=['POST'])
 @jwt_required()
 def logout():
     resp = make_response(jsonify(message='Logged out'), 200)
     unset_jwt_cookies(resp)
     return resp
 
-@app.route('/api/change-password', methods=['POST'])
+@api.route('/api/change-password', methods=['POST'])
 @jwt_required()
 def change_password():
     uid_str = get_jwt_identity()
@@ -826,6 +2104,14 @@ def change_password():
     new = data.get('new_password')
     if not all([old, new]):
         return jsonify(error='Missing fields'), 400
+    if not isinstance(old, str) or not isinstance(new, str):
+        return jsonify(error='Invalid fields'), 400
+    limited = throttled(
+        ('ip', request.remote_addr),
+        ('email', f"change-password:{uid}"),
+    )
+    if limited:
+        return limited
     user = db.session.get(User, uid)
     if not user or not user.check_password(old):
         return jsonify(error='Old password incorrect'), 401
@@ -833,7 +2119,7 @@ def change_password():
     db.session.commit()
     return jsonify(message='Password changed'), 200
 
-@app.route('/api/profile', methods=['GET'])
+@api.route('/api/profile', methods=['GET'])
 @jwt_required()
 def profile():
     uid_str = get_jwt_identity()
@@ -846,7 +2132,65 @@ def profile():
         return jsonify(error='User not found'), 404
     return jsonify(id=u.id, username=u.username, email=u.email), 200
 
-@app.route('/api/captures/latest', methods=['GET'])
+def recent_commands(limit: int) -> list[dict]:
+    rows = db.session.execute(
+        select(Command, User.username)
+        .outerjoin(User, User.id == Command.user_id)
+        .order_by(Command.created_at.desc(), Command.id.desc())
+        .limit(limit)
+    ).all()
+    return [dict(cmd.to_dict(), username=username) for cmd, username in rows]
+
+def fingerprint_summary() -> dict:
+    return {
+        "count": db.session.execute(select(func.count()).select_from(Fingerprint)).scalar_one(),
+        "used": fingerprint_slots_used(),
+        "capacity": current_app.config['FINGERPRINT_MAX_CAPACITY'],
+    }
+
+def latest_capture_dict() -> dict | None:
+    cap = Capture.get_last_capture()
+    return cap.to_dict() if cap else None
+
+DASHBOARD_SECTIONS = {
+    "latest_capture": latest_capture_dict,
+    "last_open":      last_open_event,
+    "fingerprints":   fingerprint_summary,
+    "commands":       lambda: recent_commands(current_app.config['DASHBOARD_RECENT_COMMANDS']),
+}
+
+@api.route('/api/dashboard', methods=['GET'])
+@jwt_required()
+def dashboard():
+    # Một round trip cho lần vẽ đầu của Dashboard; mỗi mục lấy từ SnapshotCache (hết hạn sau
+    # DASHBOARD_CACHE_TTL hoặc khi handler ghi invalidate), nên poll liên tục hầu như không chạm DB
+    cache = current_app.extensions['dashboard_cache']
+    body = {name: cache.get(name, loader) for name, loader in DASHBOARD_SECTIONS.items()}
+    devices = current_app.extensions['device_state'].snapshot()
+    servo = devices.get("servo") or {}
+    body["device"] = {
+        "door": servo.get("door"),
+        "door_changed_at": servo.get("door_changed_at"),
+        "last_seen": max((d["last_seen"] for d in devices.values() if d["last_seen"]), default=None),
+        "mqtt_connected": mqtt_connected(),
+    }
+    body["devices"] = devices
+    body["generated_at"] = int(time.time())
+    resp = jsonify(body)
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp, 200
+
+@api.route('/api/devices/state', methods=['GET'])
+@jwt_required()
+def devices_state():
+    # trả thẳng từ DeviceStateStore, không chạm DB
+    return jsonify(
+        devices        = current_app.extensions['device_state'].snapshot(),
+        mqtt_connected = mqtt_connected(),
+        generated_at   = int(time.time()),
+    ), 200
+
+@api.route('/api/captures/latest', methods=['GET'])
 def latest_capture():
     cap = Capture.get_last_capture()
     if not cap:
@@ -855,7 +2199,7 @@ def latest_capture():
     resp.headers['Cache-Control'] = 'no-store'
     return resp, 200
 
-@app.route('/api/captures', methods=['GET'])
+@api.route('/api/captures', methods=['GET'])
 def list_captures():
     start = request.args.get('start', type=int)
     end   = request.args.get('end',   type=int)
@@ -870,26 +2214,541 @@ def list_captures():
     offset = max(0, offset)
     order  = request.args.get('order', 'desc').lower()  # 'asc' | 'desc'
 
-    base = select(Capture).where(
+    base = select(*[getattr(Capture, c) for c in CAPTURE_COLUMNS]).where(
         Capture.timestamp >= start, Capture.timestamp <= end
     )
+    skip_duplicates = request.args.get('skip_duplicates', default=0, type=int) == 1
+    if skip_duplicates:
+        base = base.where(Capture.duplicate_of_id.is_(None))
     if order == 'asc':
         base = base.order_by(Capture.timestamp.asc(), Capture.id.asc())
     else:
         base = base.order_by(Capture.timestamp.desc(), Capture.id.desc())
 
+    if skip_duplicates:
+        # duplicate_of_id được gán bất đồng bộ (HashWorker) -> đếm trên DB
+        total = db.session.execute(
+            select(func.count()).select_from(base.subquery())
+        ).scalar_one()
+    else:
+        refresh_capture_times()
+        total = current_app.extensions['capture_times'].count(start, end)
+
+    page = db.session.execute(base.offset(offset).limit(limit)).all()
+    items = [dict(zip(CAPTURE_COLUMNS, row)) for row in page]
+    return jsonify({
+        "items": items, "total": total,
+        "start": start, "end": end, "limit": limit, "offset": offset
+    }), 200
+
+def check_device_token():
+    # -> response lỗi, hoặc None nếu header X-Device-Token hợp lệ
+    token = current_app.config['DEVICE_UPLOAD_TOKEN']
+    if not token:
+        return jsonify(error="Device upload is not configured"), 404
+    if not secrets.compare_digest(request.headers.get('X-Device-Token', ''), token):
+        return jsonify(error="Invalid device token"), 401
+    return None
+
+INGEST_HTTP_TOPICS = {
+    "captures":         MQTT_TOPIC_CAPTURE,
+    "servo-logs":       MQTT_TOPIC_SERVO_LOG,
+    "fingerprint-logs": MQTT_TOPIC_FINGERPRINT_LOG,
+}
+
+@api.route('/api/ingest/<kind>', methods=['POST'])
+def ingest_batch(kind):
+    # Thiết bị gửi bù sau khi mất kết nối: body = JSON array các record (cùng định dạng message
+    # MQTT của topic), một round trip; kết quả theo từng record
+    denied = check_device_token()
+    if denied:
+        return denied
+    topic = INGEST_HTTP_TOPICS.get(kind)
+    if topic is None:
+        return jsonify(error=f"kind must be one of: {', '.join(INGEST_HTTP_TOPICS)}"), 404
+    max_bytes = current_app.config['UPLOAD_MAX_BYTES']
+    if request.content_length is not None and request.content_length > max_bytes:
+        return jsonify(error=f"Body larger than {max_bytes} bytes"), 413
+    results = ingest(topic, request.get_data(cache=False))
+    if results is None:
+        return jsonify(error="Body must be a JSON array of records"), 400
+    if any(r.get("error") == "database unavailable" for r in results):
+        return jsonify(error="Database unavailable, retry later", results=results), 503
+    stored = sum(1 for r in results if r["ok"])
+    return jsonify(stored=stored, rejected=len(results) - stored, results=results), 200
+
+@api.route('/api/captures/upload', methods=['POST'])
+def upload_capture():
+    # ESP32 gửi JPEG gốc một lần (body = image/jpeg); thumbnail/biến thể render ở backend
+    denied = check_device_token()
+    if denied:
+        return denied
+
+    max_bytes = current_app.config['UPLOAD_MAX_BYTES']
+    if request.content_length is not None and request.content_length > max_bytes:
+        return jsonify(error=f"Image larger than {max_bytes} bytes"), 413
+    data = request.get_data(cache=False)
+    if len(data) > max_bytes:
+        return jsonify(error=f"Image larger than {max_bytes} bytes"), 413
+    if not data.startswith(JPEG_MAGIC):
+        return jsonify(error="Body must be a JPEG image"), 415
+
+    ts   = request.args.get('timestamp', type=int) or int(time.time())
+    desc = request.args.get('description')
+
+    digest = current_app.extensions['blob_store'].put(data)
+    thumb  = 'thumb' if 'thumb' in current_app.config['IMAGE_VARIANTS'] else None
+    cap = Capture(timestamp=ts, url=blob_url(digest), thumb_url=blob_url(digest, thumb) if thumb else None,
+                  description=desc)
+    db.session.add(cap)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # cùng nội dung -> cùng URL: ảnh đã được upload trước đó
+        db.session.rollback()
+        existing = db.session.execute(select(Capture).where(Capture.url == cap.url)).scalar_one_or_none()
+        if existing:
+            return jsonify(existing.to_dict()), 200
+        return jsonify(error="Capture conflicts with an existing row"), 409
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        current_app.logger.warning("Storing uploaded capture failed: %s", e)
+        return jsonify(error="Database unavailable, retry later"), 503
+    current_app.logger.info("Stored uploaded capture id=%s blob=%s (%s bytes)", cap.id, digest, len(data))
+    current_app.extensions['capture_times'].add(cap.id, cap.timestamp)
+    invalidate_dashboard('latest_capture')
+
+    fut = render_capture_variants(digest, data)
+    fut.add_done_callback(functools.partial(
+        _with_app_context(current_app._get_current_object(), store_capture_variants), cap.id, digest
+    ))
+    return jsonify(cap.to_dict()), 201
+
+@api.route('/api/blobs/<digest>', defaults={'variant': None}, methods=['GET'])
+@api.route('/api/blobs/<digest>/<variant>', methods=['GET'])
+def get_blob(digest, variant):
+    store = current_app.extensions['blob_store']
+    if not store.valid(digest, variant):
+        return jsonify(error="Blob not found"), 404
+    path = store.path(digest, variant)
+    if path is None and variant in current_app.config['IMAGE_VARIANTS'] and store.path(digest):
+        # biến thể chưa render xong (hoặc cấu hình biến thể mới) -> render ngay từ bản gốc
+        try:
+            variants = render_capture_variants(digest, store.read(digest)).result(
+                timeout=current_app.config['IMAGE_RENDER_TIMEOUT'])
+        except Exception as e:
+            current_app.logger.warning("Rendering blob %s/%s failed: %s", digest, variant, e)
+            return jsonify(error="Rendering failed, retry later"), 503
+        for name, data in variants.items():
+            store.put_variant(digest, name, data)
+        path = store.path(digest, variant)
+    if path is None:
+        return jsonify(error="Blob not found"), 404
+
+    # conditional=True: ETag/If-None-Match + Range (206); file gửi qua wsgi.file_wrapper (sendfile)
+    resp = send_file(path, mimetype='image/jpeg', conditional=True,
+                     etag=f"{digest}.{variant}" if variant else digest, max_age=31536000)
+    resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return resp
+
+MAX_TIMELAPSE_FPS = 30
+
+@api.route('/api/captures/timelapse', methods=['GET'])
+def capture_timelapse():
+    rng, err = _export_range()
+    if err:
+        return err
+    start, end = rng
+    fps = request.args.get('fps', default=5.0, type=float)
+    if fps is None or not (0 < fps <= MAX_TIMELAPSE_FPS):
+        return jsonify(error=f"fps must be in (0, {MAX_TIMELAPSE_FPS}]"), 400
+    use_thumb = request.args.get('size', 'full').lower() == 'thumb'
+
+    stmt = select(Capture.id, Capture.url, Capture.thumb_url).where(
+        Capture.timestamp >= start, Capture.timestamp <= end
+    )
+    if request.args.get('skip_duplicates', default=0, type=int) == 1:
+        stmt = stmt.where(Capture.duplicate_of_id.is_(None))
+    stmt = stmt.order_by(Capture.timestamp.asc(), Capture.id.asc())
+
+    # Worker thread của prefetch không có app context -> lấy sẵn những gì fetch cần
+    store        = current_app.extensions['blob_store']
+    full_variant = current_app.config['TIMELAPSE_FULL_VARIANT'] or None
+    timeout      = current_app.config['CAPTURE_HASH_TIMEOUT']
+    logger       = current_app.logger
+
+    def fetch(row):
+        url = (row.thumb_url or row.url) if use_thumb else row.url
+        key = blob_key(url)
+        if key:
+            digest, variant = key
+            if variant is None and full_variant and store.path(digest, full_variant):
+                variant = full_variant    # bản đã thu nhỏ đủ xem, nhẹ hơn ảnh gốc
+            return store.read(digest, variant)
+        r = http_session().get(url, timeout=timeout)
+        r.raise_for_status()
+        return r.content
+
+    def rows():
+        result = db.session.execute(stmt.execution_options(yield_per=EXPORT_YIELD_PER))
+        try:
+            yield from result
+        finally:
+            result.close()
+
+    frames = (
+        data for _, data in prefetch(
+            rows(), fetch, depth=current_app.config['TIMELAPSE_PREFETCH'],
+            on_error=lambda row, e: logger.info("Timelapse skipped capture id=%s: %s", row.id, e),
+        )
+    )
+    resp = Response(
+        stream_with_context(mjpeg_stream(frames, fps)),
+        mimetype=f'multipart/x-mixed-replace; boundary={MJPEG_BOUNDARY}',
+    )
+    resp.headers['Cache-Control'] = 'no-store'
+    resp.headers['X-Accel-Buffering'] = 'no'      # nginx: không buffer stream
+    return resp
+
+@api.route('/api/captures/<int:capture_id>/similar', methods=['GET'])
+def similar_captures(capture_id):
+    max_distance = max(0, min(request.args.get('max_distance', default=10, type=int), 32))
+    limit        = max(1, min(request.args.get('limit', default=20, type=int), 100))
+
+    cap = db.session.get(Capture, capture_id)
+    if not cap:
+        return jsonify(error="Capture not found"), 404
+    if cap.phash is None:
+        return jsonify(error="Capture has not been hashed yet"), 409
+
+    refresh_capture_index()
+    matches = current_app.extensions['capture_index'].query(to_unsigned(cap.phash), max_distance, limit, exclude_id=cap.id)
+    by_id = {
+        row[0]: row for row in db.session.execute(
+            select(*[getattr(Capture, c) for c in CAPTURE_COLUMNS]).where(Capture.id.in_([m[0] for m in matches]))
+        )
+    } if matches else {}
+    items = [dict(zip(CAPTURE_COLUMNS, by_id[i]), distance=d) for i, d in matches if i in by_id]
+    return jsonify({"capture_id": cap.id, "max_distance": max_distance, "items": items}), 200
+
+MAX_TIMELINE_BUCKETS = 2000
+
+@api.route('/api/captures/timeline', methods=['GET'])
+def capture_timeline():
+    start = request.args.get('start', type=int)
+    end   = request.args.get('end',   type=int)
+    if start is None or end is None:
+        return jsonify(error="start and end are required"), 400
+    if end < start:
+        return jsonify(error="end must be >= start"), 400
+
+    bucket_minutes = request.args.get('bucket', default=5, type=int)
+    if bucket_minutes is None or bucket_minutes < 1:
+        return jsonify(error="bucket must be a positive number of minutes"), 400
+
+    # Giới hạn số bucket: range quá dài thì tự nới bucket (làm tròn lên theo phút)
+    bucket_seconds = bucket_minutes * 60
+    span = end - start + 1
+    if span / bucket_seconds > MAX_TIMELINE_BUCKETS:
+        bucket_seconds = math.ceil(span / MAX_TIMELINE_BUCKETS / 60) * 60
+
+    skip_duplicates = request.args.get('skip_duplicates', default=0, type=int) == 1
+    items = Capture.get_timeline(start, end, bucket_seconds, skip_duplicates=skip_duplicates)
+    resp = jsonify({
+        "items": items, "start": start, "end": end,
+        "bucket_seconds": bucket_seconds,
+    })
+    # range đã hoàn toàn ở quá khứ thì kết quả không đổi -> cho phép cache ngắn
+    resp.headers['Cache-Control'] = 'private, max-age=60' if end < int(time.time()) else 'no-store'
+    return resp, 200
+
+@api.route('/api/captures/histogram', methods=['GET'])
+def capture_histogram():
+    # Mật độ capture theo bucket, tính hoàn toàn trên TimestampIndex (searchsorted vector hoá)
+    start = request.args.get('start', type=int)
+    end   = request.args.get('end',   type=int)
+    if start is None or end is None:
+        return jsonify(error="start and end are required"), 400
+    if end < start:
+        return jsonify(error="end must be >= start"), 400
+
+    bucket_seconds = request.args.get('bucket', default=300, type=int)
+    if bucket_seconds is None or bucket_seconds < 1:
+        return jsonify(error="bucket must be a positive number of seconds"), 400
+    span = end - start + 1
+    if span / bucket_seconds > MAX_TIMELINE_BUCKETS:
+        bucket_seconds = math.ceil(span / MAX_TIMELINE_BUCKETS)
+
+    refresh_capture_times()
+    counts = current_app.extensions['capture_times'].histogram(start, end, bucket_seconds)
+    resp = jsonify({
+        "start": start, "end": end, "bucket_seconds": bucket_seconds,
+        "counts": counts, "total": sum(counts),
+    })
+    resp.headers['Cache-Control'] = 'private, max-age=60' if end < int(time.time()) else 'no-store'
+    return resp, 200
+
+EXPORT_YIELD_PER = 1000
+
+def _export_response(stmt, columns, name):
+    fmt = (request.args.get('format') or 'ndjson').lower()
+    if fmt not in EXPORT_FORMATS:
+        return jsonify(error=f"format must be one of: {', '.join(EXPORT_FORMATS)}"), 400
+    use_gzip = request.args.get('gzip', default=0, type=int) == 1
+
+    # yield_per -> đọc theo lô bằng cursor, không dựng cả list trong bộ nhớ
+    def rows():
+        result = db.session.execute(stmt.execution_options(yield_per=EXPORT_YIELD_PER))
+        try:
+            for row in result:
+                yield tuple(row)
+        finally:
+            result.close()
+
+    body = export_stream(rows(), columns, fmt, gzip=use_gzip)
+    filename = f"{name}.{fmt}" + (".gz" if use_gzip else "")
+    resp = Response(
+        stream_with_context(body),
+        mimetype='application/gzip' if use_gzip else EXPORT_FORMATS[fmt],
+    )
+    resp.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp
+
+def _export_range():
+    start = request.args.get('start', type=int)
+    end   = request.args.get('end',   type=int)
+    if start is None or end is None:
+        return None, (jsonify(error="start and end are required"), 400)
+    if end < start:
+        return None, (jsonify(error="end must be >= start"), 400)
+    return (start, end), None
+
+@api.route('/api/captures/export', methods=['GET'])
+def export_captures():
+    rng, err = _export_range()
+    if err:
+        return err
+    start, end = rng
+
+    columns = ("id", "timestamp", "url", "thumb_url", "description")
+    stmt = (
+        select(Capture.id, Capture.timestamp, Capture.url, Capture.thumb_url, Capture.description)
+        .where(Capture.timestamp >= start, Capture.timestamp <= end)
+        .order_by(Capture.timestamp.asc(), Capture.id.asc())
+    )
+    return _export_response(stmt, columns, f"captures_{start}_{end}")
+
+@api.route('/api/logs/export', methods=['GET'])
+@jwt_required()
+def export_logs():
+    rng, err = _export_range()
+    if err:
+        return err
+    start, end = rng
+
+    # chọn cột trực tiếp để tránh joined-load Command/User/related_log trên từng dòng
+    stmt = select(*[getattr(Log, c) for c in LOG_COLUMNS]).where(
+        Log.created_at >= start, Log.created_at <= end
+    )
+
+    log_type = request.args.get('log_type')
+    if log_type:
+        stmt = stmt.where(Log.log_type == log_type)
+    stmt = stmt.order_by(Log.created_at.asc(), Log.id.asc())
+    return _export_response(stmt, LOG_COLUMNS, f"logs_{start}_{end}")
+
+@api.route('/api/logs', methods=['GET'])
+@jwt_required()
+def list_logs():
+    start = request.args.get('start', type=int)
+    end   = request.args.get('end',   type=int)
+    if start is not None and end is not None and end < start:
+        return jsonify(error="end must be >= start"), 400
+
+    limit  = request.args.get('limit',  default=30, type=int)
+    offset = request.args.get('offset', default=0,  type=int)
+    limit  = max(1, min(limit, 100))
+    offset = max(0, offset)
+    order  = request.args.get('order', 'desc').lower()  # 'asc' | 'desc'
+
+    conds = []
+    # log_type + created_at -> dùng được index ix_log_type_created
+    log_types = [t.strip() for t in (request.args.get('log_type') or '').split(',') if t.strip()]
+    if len(log_types) == 1:
+        conds.append(Log.log_type == log_types[0])
+    elif log_types:
+        conds.append(Log.log_type.in_(log_types))
+    if start is not None:
+        conds.append(Log.created_at >= start)
+    if end is not None:
+        conds.append(Log.created_at <= end)
+
+    command_id = request.args.get('command_id', type=int)
+    if command_id is not None:
+        conds.append(Log.command_id == command_id)
+
+    fingerprint_id = request.args.get('fingerprint_id', type=int)
+    if fingerprint_id is not None:
+        conds.append(Log.fingerprint_id == fingerprint_id)
+
+    action = (request.args.get('action') or '').strip().lower()
+    if action:
+        conds.append(Log.action == action)
+
+    user_id = request.args.get('user_id', type=int)
+    if user_id is not None:
+        # lệnh do user gửi, hoặc sự kiện trên vân tay thuộc user
+        conds.append(or_(
+            Log.command_id.in_(select(Command.id).where(Command.user_id == user_id)),
+            Log.fingerprint_id.in_(select(Fingerprint.id).where(Fingerprint.user_id == user_id)),
+        ))
+
+    q = (request.args.get('q') or '').strip()
+    if q:
+        if db.engine.dialect.name == 'sqlite':
+            match = fts_match_query(q)
+            if match is None:
+                return jsonify(error="q has no searchable terms"), 400
+            fts_ids = text("SELECT rowid FROM log_fts WHERE log_fts MATCH :match").bindparams(match=match)
+            conds.append(Log.id.in_(fts_ids.columns(column('rowid'))))
+        else:
+            pattern = like_pattern(q)
+            conds.append(or_(Log.description.ilike(pattern, escape='\\'), Log.payload.ilike(pattern, escape='\\')))
+
+    base = select(*[getattr(Log, c) for c in LOG_COLUMNS]).where(*conds)
+    if order == 'asc':
+        base = base.order_by(Log.created_at.asc(), Log.id.asc())
+    else:
+        base = base.order_by(Log.created_at.desc(), Log.id.desc())
+
     total = db.session.execute(
         select(func.count()).select_from(base.subquery())
     ).scalar_one()
 
-    page = db.session.execute(base.offset(offset).limit(limit)).scalars().all()
-    items = [c.to_dict() for c in page]
+    page = db.session.execute(base.offset(offset).limit(limit)).all()
+    items = [dict(zip(LOG_COLUMNS, row)) for row in page]
     return jsonify({
         "items": items, "total": total,
         "start": start, "end": end, "limit": limit, "offset": offset
     }), 200
 
-@app.route('/api/fingerprints/<int:fingerprint_id>', methods=['DELETE'])
+# Nguồn của activity feed; vị trí trong tuple = hạng khi trùng timestamp
+ACTIVITY_SOURCES = ("command", "log", "capture")
+
+def _keyset_before(ts_col, id_col, rank: int, cur: tuple[int, int, int]):
+    # Feed sắp giảm dần theo (ts, rank, id): điều kiện để item của nguồn `rank` nằm sau cursor
+    t, s, i = cur
+    if rank < s:
+        return ts_col <= t
+    if rank > s:
+        return ts_col < t
+    return or_(ts_col < t, and_(ts_col == t, id_col < i))
+
+@api.route('/api/activity', methods=['GET'])
+@jwt_required()
+def activity_feed():
+    limit = max(1, min(request.args.get('limit', default=30, type=int), 100))
+    wanted = [x.strip() for x in (request.args.get('sources') or ','.join(ACTIVITY_SOURCES)).split(',') if x.strip()]
+    unknown = [x for x in wanted if x not in ACTIVITY_SOURCES]
+    if unknown:
+        return jsonify(error=f"sources must be a subset of: {', '.join(ACTIVITY_SOURCES)}"), 400
+    user_id = request.args.get('user_id', type=int)
+
+    cur = None
+    if request.args.get('cursor'):
+        try:
+            c = decode_cursor(request.args['cursor'])
+            cur = (int(c['t']), int(c['s']), int(c['i']))
+        except (ValueError, KeyError, TypeError):
+            return jsonify(error="Invalid cursor"), 400
+
+    # Mỗi nguồn: range scan giảm dần trên index thời gian, đọc tối đa limit + 1 dòng;
+    # heapq.merge trộn k nguồn đã sắp xếp -> không UNION cả bảng
+    sources = []
+    if 'command' in wanted:
+        rank = ACTIVITY_SOURCES.index('command')
+        conds = []
+        if user_id is not None:
+            conds.append(Command.user_id == user_id)
+        if cur:
+            conds.append(_keyset_before(Command.created_at, Command.id, rank, cur))
+        stmt = (
+            select(Command.created_at, Command.id, Command.command_type, Command.status,
+                   Command.user_id, User.username)
+            .outerjoin(User, User.id == Command.user_id)
+            .where(*conds)
+            .order_by(Command.created_at.desc(), Command.id.desc())
+            .limit(limit + 1)
+        )
+        sources.append([
+            (r.created_at, rank, r.id, {
+                "type": "command", "id": r.id, "created_at": r.created_at,
+                "command_type": r.command_type, "status": r.status,
+                "user_id": r.user_id, "username": r.username,
+            })
+            for r in db.session.execute(stmt)
+        ])
+
+    if 'log' in wanted:
+        rank = ACTIVITY_SOURCES.index('log')
+        cmd_user, fp_user = aliased(User), aliased(User)
+        conds = []
+        if user_id is not None:
+            conds.append(or_(
+                Log.command_id.in_(select(Command.id).where(Command.user_id == user_id)),
+                Log.fingerprint_id.in_(select(Fingerprint.id).where(Fingerprint.user_id == user_id)),
+            ))
+        if cur:
+            conds.append(_keyset_before(Log.created_at, Log.id, rank, cur))
+        stmt = (
+            select(Log.created_at, Log.id, Log.log_type, Log.description, Log.action,
+                   Log.fingerprint_id, Log.command_id,
+                   func.coalesce(Command.user_id, Fingerprint.user_id).label("user_id"),
+                   func.coalesce(cmd_user.username, fp_user.username).label("username"))
+            .outerjoin(Command, Command.id == Log.command_id)
+            .outerjoin(cmd_user, cmd_user.id == Command.user_id)
+            .outerjoin(Fingerprint, Fingerprint.id == Log.fingerprint_id)
+            .outerjoin(fp_user, fp_user.id == Fingerprint.user_id)
+            .where(*conds)
+            .order_by(Log.created_at.desc(), Log.id.desc())
+            .limit(limit + 1)
+        )
+        sources.append([
+            (r.created_at, rank, r.id, {
+                "type": "log", "id": r.id, "created_at": r.created_at,
+                "log_type": r.log_type, "description": r.description, "action": r.action,
+                "fingerprint_id": r.fingerprint_id, "command_id": r.command_id,
+                "user_id": r.user_id, "username": r.username,
+            })
+            for r in db.session.execute(stmt)
+        ])
+
+    if 'capture' in wanted and user_id is None:      # capture không gắn với user
+        rank = ACTIVITY_SOURCES.index('capture')
+        conds = [_keyset_before(Capture.timestamp, Capture.id, rank, cur)] if cur else []
+        stmt = (
+            select(Capture.timestamp, Capture.id, Capture.url, Capture.thumb_url, Capture.description)
+            .where(*conds)
+            .order_by(Capture.timestamp.desc(), Capture.id.desc())
+            .limit(limit + 1)
+        )
+        sources.append([
+            (r.timestamp, rank, r.id, {
+                "type": "capture", "id": r.id, "created_at": r.timestamp,
+                "url": r.url, "thumb_url": r.thumb_url, "description": r.description,
+            })
+            for r in db.session.execute(stmt)
+        ])
+
+    page, more = merge_desc(sources, key=lambda item: item[:3], limit=limit)
+    next_cursor = None
+    if more and page:
+        t, s, i, _ = page[-1]
+        next_cursor = encode_cursor({"t": t, "s": s, "i": i})
+    return jsonify({"items": [item[3] for item in page], "next_cursor": next_cursor, "limit": limit}), 200
+
+@api.route('/api/fingerprints/<int:fingerprint_id>', methods=['DELETE'])
 @jwt_required()
 def fingerprint_delete_command(fingerprint_id):
     uid = int(get_jwt_identity())
@@ -906,16 +2765,13 @@ def fingerprint_delete_command(fingerprint_id):
     db.session.flush()
 
     # Tạo payload và gửi MQTT
-    payload = json.dumps({"cmd_id": cmd.id, "action": "delete", "id": fingerprint_id})
-    published_ok = mqtt.publish(MQTT_TOPIC_FINGERPRINT_COMMAND, payload, qos=1)
-
-    cmd.payload = payload
-    cmd.status = 'sent' if published_ok else 'error'
+    cmd.payload = json.dumps({"cmd_id": cmd.id, "action": "delete", "id": fingerprint_id})
     db.session.commit()
+    code = wait_for_command(cmd, publish_command(cmd))
 
-    return jsonify(message="Delete command sent."), 200 if published_ok else 500
+    return jsonify(message="Delete command sent.", id=cmd.id, status=cmd.status, note=cmd.note), code
 
-@app.route('/api/chat', methods=['POST'])
+@api.route('/api/chat', methods=['POST'])
 def chat_with_gemini():
     data = request.get_json()
     user_message = data.get('message', '').lower()
@@ -955,7 +2811,10 @@ def chat_with_gemini():
         f"{prompt_last_open}{prompt_general}Câu hỏi người dùng: \"{user_message}\""
     )
 
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={GEMINI_API_KEY}"
+    api_key = current_app.config.get('GEMINI_API_KEY')
+    if not api_key:
+        return jsonify({'error': 'Chat is not configured'}), 503
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={api_key}"
     payload = {
         "contents": [
             {
@@ -965,7 +2824,8 @@ def chat_with_gemini():
     }
 
     try:
-        res = requests.post(url, json=payload)
+        session = http_session()
+        res = session.post(url, json=payload)
         res.raise_for_status()
         reply = res.json()['candidates'][0]['content']['parts'][0]['text']
 
@@ -1006,12 +2866,12 @@ def chat_with_gemini():
                 return jsonify({'error': 'Missing or invalid JWT token'}), 401
 
             servo_url = request.host_url.rstrip('/') + '/api/servo'
-            servo_resp = requests.post(
+            servo_resp = session.post(
                 servo_url,
                 json={"action": action},
                 cookies=request.cookies
             )
-            if servo_resp.status_code != 200:
+            if not servo_resp.ok:
                 return jsonify({'reply': reply, 'servo_error': servo_resp.json()}), 500
 
         # Thực thi hiển thị LCD
@@ -1022,7 +2882,7 @@ def chat_with_gemini():
                 return jsonify({'error': 'Missing or invalid JWT token'}), 401
 
             lcd_url = request.host_url.rstrip('/') + '/api/lcd'
-            lcd_resp = requests.post(
+            lcd_resp = session.post(
                 lcd_url,
                 json={"message": lcd_message},
                 cookies=request.cookies
@@ -1033,7 +2893,7 @@ def chat_with_gemini():
         # Thực thi lấy ảnh mới nhất
         if capture_requested:
             cap_url = request.host_url.rstrip('/') + '/api/captures/latest'
-            cap_resp = requests.get(cap_url, cookies=request.cookies)
+            cap_resp = session.get(cap_url, cookies=request.cookies)
             if cap_resp.status_code == 200:
                 cap_data = cap_resp.json()
                 image_url = cap_data.get('url')
@@ -1052,7 +2912,7 @@ def chat_with_gemini():
                 return jsonify({'error': 'Missing or invalid JWT token'}), 401
 
             last_url = request.host_url.rstrip('/') + '/api/servo/last-open'
-            last_resp = requests.get(last_url, cookies=request.cookies)
+            last_resp = session.get(last_url, cookies=request.cookies)
 
             if last_resp.status_code == 200:
                 info = last_resp.json()
@@ -1103,12 +2963,11 @@ def chat_with_gemini():
         return jsonify({'reply': reply})
 
     except Exception as e:
-        app.logger.error(f"Chat error: {str(e)}")
-        app.logger.error(traceback.format_exc())
+        current_app.logger.exception("Chat error: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/webhook', methods=['POST'])
+@api.route('/api/webhook', methods=['POST'])
 @jwt_required()
 def update_webhook():
     try:
@@ -1131,6 +2990,176 @@ def update_webhook():
     db.session.commit()
     return jsonify(message='Webhook saved successfully')
 
+def _with_app_context(app, fn):
+    # callback MQTT / worker chạy ngoài request (thread của paho, thread nền) -> cần push app context
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with app.app_context():
+            return fn(*args, **kwargs)
+    return wrapper
+
+def register_mqtt_handlers(app):
+    for t, handler in (
+        (MQTT_TOPIC_CAPTURE,         handle_capture_topic),
+        (MQTT_TOPIC_SERVO_LOG,       handle_servo_log),
+        (MQTT_TOPIC_FINGERPRINT_LOG, handle_fingerprint_log),
+        (MQTT_TOPIC_LCD_LOG,         handle_lcd_log),
+        (MQTT_TOPIC_DEVICE_STATUS,   handle_device_status),
+    ):
+        handler = app.extensions['profiler'].instrument(f"mqtt.{handler.__name__}", handler)
+        app.extensions['mqtt'].client.message_callback_add(t, _with_app_context(app, handler))
+
+def create_app(config: dict | None = None) -> Flask:
+    t0 = time.perf_counter()
+    app = Flask(__name__)
+    app.config.update(default_config())
+    if config:
+        app.config.update(config)
+
+    # log qua queue: thread gọi chỉ enqueue, listener thread format JSON và ghi stderr;
+    # listener chỉ start sau khi fork process pool (bên dưới)
+    app.extensions['log_handler'] = setup_logging(
+        app.logger,
+        level        = app.config['LOG_LEVEL'],
+        as_json      = app.config['LOG_JSON'],
+        sample_rates = app.config['LOG_SAMPLE'],
+        queue_size   = app.config['LOG_QUEUE_SIZE'],
+        start        = False,
+    )
+
+    role = app.config['APP_ROLE']
+    if role not in APP_ROLES:
+        raise ValueError(f"APP_ROLE must be one of: {', '.join(APP_ROLES)}")
+    serve_api, ingest = APP_ROLES[role]
+
+    db.init_app(app)
+    jwt.init_app(app)
+    app.extensions['blob_store'] = BlobStore(app.config['BLOB_ROOT'])
+    app.extensions['dashboard_cache'] = SnapshotCache(app.config['DASHBOARD_CACHE_TTL'])
+    app.extensions['device_state'] = DeviceStateStore(app.config['DEVICE_HEARTBEAT_TIMEOUT'])
+    # perceptual hash của capture (tìm ảnh tương tự) và Capture.timestamp đã sắp xếp (đếm / histogram
+    # không qua SQL); đọc bù tăng dần từ DB, riêng cho từng app
+    app.extensions['capture_index'] = HammingIndex()
+    app.extensions['capture_times'] = TimestampIndex()
+    app.extensions['anomaly_lock'] = threading.Lock()
+    app.extensions['profiler'] = Profiler(
+        ring_size = app.config['PROFILE_RING_SIZE'],
+        interval  = app.config['PROFILE_SAMPLE_INTERVAL_MS'] / 1000,
+    )
+
+    if app.config['QUERY_STATS_ENABLED']:
+        stats = QueryStats(
+            threshold_ms   = app.config['SLOW_QUERY_MS'],
+            max_statements = app.config['QUERY_STATS_MAX_STATEMENTS'],
+            logger         = app.logger,
+        )
+        with app.app_context():
+            stats.install(db.engine)
+        app.extensions['query_stats'] = stats
+
+    if serve_api:
+        CORS(app, resources={r"/api/*": {"origins": app.config['FRONT_END_URL']}}, supports_credentials=True)
+        app.register_blueprint(api)
+        app.extensions['command_scheduler'] = DeviceCommandScheduler(
+            publish     = _with_app_context(app, publish_held_command),
+            supersede   = _with_app_context(app, supersede_command),
+            window      = app.config['COMMAND_COALESCE_WINDOW'],
+            current_ttl = app.config['LCD_DEDUP_TTL'],
+        )
+        app.extensions['login_limiters'] = {
+            'email': TokenBucketLimiter(app.config['LOGIN_EMAIL_PER_MINUTE'] / 60, app.config['LOGIN_EMAIL_BURST']),
+            'ip':    TokenBucketLimiter(app.config['LOGIN_IP_PER_MINUTE'] / 60, app.config['LOGIN_IP_BURST']),
+        }
+        app.extensions['image_pool'] = ImagePool(app.config['IMAGE_WORKERS'])
+        app.extensions['schedule_timers'] = TimerHeap(_with_app_context(app, run_schedule), logger=app.logger)
+        app.extensions['password_hasher'] = PasswordHasher(
+            workers     = app.config['PASSWORD_HASH_WORKERS'],
+            max_pending = app.config['PASSWORD_HASH_MAX_PENDING'],
+            timeout     = app.config['PASSWORD_HASH_TIMEOUT'],
+        )
+        # fork worker process trước mọi thread nền của app (log listener, MQTT network thread,
+        # timer heap, device state sync)
+        app.extensions['password_hasher'].start()
+        app.extensions['image_pool'].start()
+
+    app.extensions['log_handler'].listener.start()
+
+    if app.config['MQTT_ENABLED']:
+        mqtt = app.extensions['mqtt'] = Mqtt()
+        app.extensions['mqtt_subscriptions'] = (
+            [MQTT_TOPIC_CAPTURE, MQTT_TOPIC_FINGERPRINT_LOG, MQTT_TOPIC_SERVO_LOG, MQTT_TOPIC_LCD_LOG,
+             MQTT_TOPIC_DEVICE_STATUS]
+            if ingest else []
+        )
+        mqtt.on_connect()(_with_app_context(app, handle_connect))
+        mqtt.init_app(app)
+        if ingest:
+            register_mqtt_handlers(app)
+        if serve_api:
+            publisher = AckPublisher(
+                publish      = lambda t, payload, qos: mqtt.publish(t, payload, qos=qos),
+                on_result    = _with_app_context(app, on_command_published),
+                max_inflight = app.config['MQTT_MAX_INFLIGHT'],
+                ack_timeout  = app.config['MQTT_ACK_TIMEOUT'],
+                logger       = app.logger,
+            )
+            mqtt.client.max_inflight_messages_set(app.config['MQTT_MAX_INFLIGHT'])
+            mqtt.client.on_publish = lambda client, userdata, mid: publisher.on_publish(mid)
+            publisher.start()
+            app.extensions['mqtt_publisher'] = publisher
+
+    if ingest and app.config['INGEST_SPOOL_ENABLED']:
+        spool = Spool(app.config['INGEST_SPOOL_PATH'], capacity=app.config['INGEST_SPOOL_SIZE_MB'] << 20,
+                      logger=app.logger)
+        if len(spool):
+            app.logger.warning("Ingest spool has %s message(s) pending replay", len(spool))
+        replayer = SpoolReplayer(
+            spool,
+            replay = _with_app_context(app, replay_spooled),
+            retry  = app.config['INGEST_SPOOL_RETRY'],
+            logger = app.logger,
+        )
+        app.extensions['ingest_spool'] = spool
+        app.extensions['spool_replayer'] = replayer
+        replayer.start()
+
+    if ingest:
+        app.extensions['webhook_digester'] = EventDigester(
+            deliver   = _with_app_context(app, deliver_webhook_digest),
+            window    = app.config['WEBHOOK_DIGEST_WINDOW'],
+            immediate = app.config['WEBHOOK_DIGEST_IMMEDIATE'],
+            logger    = app.logger,
+        )
+
+    if serve_api:
+        app.extensions['schedule_timers'].start()   # sau khi fork process pool
+
+    # ingest ghi snapshot trạng thái thiết bị; process chỉ chạy API đọc lại bản ingest đã ghi
+    app.extensions['device_state'].start(
+        sync     = _with_app_context(app, persist_device_state if ingest else reload_device_state),
+        interval = app.config['DEVICE_STATE_SYNC_INTERVAL'],
+        logger   = app.logger,
+    )
+
+    # capture tới từ MQTT (ingest) lẫn upload POST /api/captures (api) -> role nào cũng băm
+    if app.config['CAPTURE_HASH_ENABLED']:
+        hasher = HashWorker(
+            fetch   = _with_app_context(app, _fetch_image),
+            on_hash = _with_app_context(app, store_capture_hash),
+            algo    = app.config['CAPTURE_HASH_ALGO'],
+            logger  = app.logger,
+        )
+        hasher.start()
+        app.extensions['capture_hasher'] = hasher
+
+    # Email, Gemini và HTTP session cho webhook được khởi tạo lười ở lần dùng đầu tiên
+    app.config['COLD_START_MS'] = round((time.perf_counter() - t0) * 1000, 2)
+    app.logger.info("App created (role=%s, mqtt=%s) in %.1f ms",
+                    role, app.config['MQTT_ENABLED'], app.config['COLD_START_MS'])
+    return app
+
 if __name__ == '__main__':
-    init_db()
-    app.run(host='0.0.0.0', port=BACK_END_PORT, debug=True)
\ No newline at end of file
+    app = create_app()
+    init_db(app)
+    # reloader chạy app trong process con thứ hai -> hai bản thread nền / spool lock bị giữ
+    app.run(host='0.0.0.0', port=app.config['BACK_END_PORT'], debug=True, use_reloader=False)
\ No newline at end of file
@@ -0,0 +1,120 @@
+"""Băm capture + đánh dấu gần trùng, với ảnh lấy từ một HTTP server local.
+
+Chạy từ thư mục backend:
+    python -m unittest tests.test_capture_hash
+"""
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as backend  # noqa: E402
+
+
+def _jpeg(pixel) -> bytes:
+    # ảnh 64x48 theo hàm pixel(x, y) -> mức xám
+    im = Image.new("L", (64, 48))
+    im.putdata([pixel(x, y) for y in range(48) for x in range(64)])
+    buf = io.BytesIO()
+    im.convert("RGB").save(buf, "JPEG", quality=90)
+    return buf.getvalue()
+
+
+IMAGES = {
+    "/frame-1.jpg": _jpeg(lambda x, y: (x * 4 + y) % 256),
+    "/frame-2.jpg": _jpeg(lambda x, y: min(255, (x * 4 + y) % 256 + (6 if (x, y) == (10, 10) else 0))),
+    "/other.jpg":   _jpeg(lambda x, y: 255 - (y * 5 + x) % 256),
+}
+
+
+class _ImageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = IMAGES.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class CaptureHashTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _ImageHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.server.server_port}"
+        # sqlite file (không phải :memory:) vì thread băm dùng connection riêng
+        self.app = backend.create_app({
+            'TESTING': True,
+            'APP_ROLE': 'api',
+            'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(self.tmp, 'test.sqlite')}",
+            'JWT_SECRET_KEY': 'test',
+            'BLOB_ROOT': os.path.join(self.tmp, 'blobs'),
+            'MQTT_ENABLED': False,
+            'EMAIL_ENABLED': False,
+            'WEBHOOKS_ENABLED': False,
+            'ANOMALY_ENABLED': False,
+            'PASSWORD_HASH_WORKERS': 0,
+            'IMAGE_WORKERS': 0,
+            'CAPTURE_HASH_ENABLED': True,
+            'CAPTURE_HASH_ALGO': 'dhash',
+        })
+        backend.init_db(self.app)
+
+    def tearDown(self):
+        self.app.extensions['device_state'].stop()
+        self.app.extensions['schedule_timers'].stop()
+        self.app.extensions['log_handler'].listener.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        with self.app.app_context():
+            backend.db.engine.dispose()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _wait_hashed(self, ids, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.app.app_context():
+                caps = [backend.db.session.get(backend.Capture, i) for i in ids]
+                if all(c.phash is not None for c in caps):
+                    return {c.id: c.duplicate_of_id for c in caps}
+            time.sleep(0.05)
+        self.fail("captures were not hashed in time")
+
+    def test_near_identical_frame_is_marked_duplicate(self):
+        with self.app.app_context():
+            caps = [
+                backend.Capture(timestamp=1000, url=f"{self.base}/frame-1.jpg"),
+                backend.Capture(timestamp=1010, url=f"{self.base}/frame-2.jpg"),
+                backend.Capture(timestamp=1020, url=f"{self.base}/other.jpg"),
+            ]
+            backend.db.session.add_all(caps)
+            backend.db.session.commit()
+            ids = [c.id for c in caps]
+            # cùng đường với upload qua /api/captures ở role api
+            for cap in caps:
+                backend.notify_capture(None, cap)
+
+        duplicate_of = self._wait_hashed(ids)
+        self.assertIsNone(duplicate_of[ids[0]])
+        self.assertEqual(duplicate_of[ids[1]], ids[0])
+        self.assertIsNone(duplicate_of[ids[2]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+"""Đo thời gian khởi động backend: import module + create_app() cho từng role.
+
+Chạy từ thư mục backend:
+    python tools/bench_startup.py [số lần lặp]
+
+MQTT, email và Gemini bị tắt để chỉ đo phần khởi tạo của chính app.
+"""
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BASE_CONFIG = {
+    'TESTING': True,
+    'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+    'JWT_SECRET_KEY': 'bench',
+    'MQTT_ENABLED': False,
+    'EMAIL_ENABLED': False,
+    'WEBHOOKS_ENABLED': False,
+    'PASSWORD_HASH_WORKERS': 0,
+}
+
+
+def main(runs: int = 20) -> None:
+    t0 = time.perf_counter()
+    import app as backend
+    import_ms = (time.perf_counter() - t0) * 1000
+    print(f"import app: {import_ms:.1f} ms")
+
+    for role in backend.APP_ROLES:
+        samples = []
+        for _ in range(runs):
+            t = time.perf_counter()
+            backend.create_app({**BASE_CONFIG, 'APP_ROLE': role})
+            samples.append((time.perf_counter() - t) * 1000)
+        print(f"create_app(role={role:<6}) x{runs}: "
+              f"median {statistics.median(samples):.2f} ms, max {max(samples):.2f} ms")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,93 @@
+import threading
+from collections import deque
+
+HOURS_PER_WEEK = 168
+# 1970-01-01 là thứ Năm -> cộng 72 giờ để giờ 0 của tuần là 00:00 thứ Hai
+_EPOCH_WEEK_OFFSET_HOURS = 72
+
+
+def _np():
+    import numpy as np
+    return np
+
+
+def hour_of_week(ts, tz_offset_hours: int = 0):
+    # nhận int hoặc mảng NumPy (vector hoá khi rebuild)
+    return ((ts + tz_offset_hours * 3600) // 3600 + _EPOCH_WEEK_OFFSET_HOURS) % HOURS_PER_WEEK
+
+
+class AccessAnomalyModel:
+    # Histogram giờ-trong-tuần cho từng user (mảng float32 n_users x 168) + cửa sổ trượt các lần
+    # quét thất bại. Chấm điểm mỗi sự kiện O(1); rebuild từ lịch sử Log bằng bincount vector hoá.
+    #
+    # score truy cập = 1 - p * 168, với p là xác suất (đã làm mượt) user mở cửa vào giờ đó:
+    # 0 khi giờ đó phổ biến như phân bố đều, tiến về 1 khi gần như chưa từng xảy ra.
+    def __init__(self, tz_offset_hours: int = 7, min_events: int = 20, threshold: float = 0.8,
+                 smoothing: float = 0.5, fail_window: int = 60, fail_burst: int = 3):
+        self.tz_offset_hours = tz_offset_hours
+        self.min_events = min_events
+        self.threshold = threshold
+        self.smoothing = smoothing
+        self.fail_window = fail_window
+        self.fail_burst = fail_burst
+
+        np = _np()
+        self._rows: dict[int, int] = {}
+        self._hist = np.zeros((0, HOURS_PER_WEEK), dtype=np.float32)
+        self._totals = np.zeros(0, dtype=np.float32)
+        self._fails: deque[int] = deque()
+        self._last_burst_alert = None
+        self._lock = threading.Lock()
+
+    def rebuild(self, user_ids, timestamps) -> int:
+        np = _np()
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        users, inverse = np.unique(user_ids, return_inverse=True)
+        how = hour_of_week(timestamps, self.tz_offset_hours)
+        counts = np.bincount(inverse * HOURS_PER_WEEK + how, minlength=len(users) * HOURS_PER_WEEK)
+        hist = counts.reshape(len(users), HOURS_PER_WEEK).astype(np.float32)
+        with self._lock:
+            self._rows = {int(u): i for i, u in enumerate(users)}
+            self._hist = hist
+            self._totals = hist.sum(axis=1)
+        return len(timestamps)
+
+    def _row(self, user_id: int) -> int:
+        np = _np()
+        row = self._rows.get(user_id)
+        if row is None:
+            row = len(self._rows)
+            if row >= len(self._hist):
+                grow = max(8, len(self._hist))
+                self._hist = np.vstack([self._hist, np.zeros((grow, HOURS_PER_WEEK), dtype=np.float32)])
+                self._totals = np.concatenate([self._totals, np.zeros(grow, dtype=np.float32)])
+            self._rows[user_id] = row
+        return row
+
+    def score_access(self, user_id: int, ts: int) -> tuple[float, bool]:
+        # -> (score, anomalous); sau khi chấm thì cập nhật histogram với chính sự kiện này
+        how = int(hour_of_week(int(ts), self.tz_offset_hours))
+        with self._lock:
+            row = self._row(int(user_id))
+            total = float(self._totals[row])
+            p = (float(self._hist[row, how]) + self.smoothing) / (total + HOURS_PER_WEEK * self.smoothing)
+            score = max(0.0, min(1.0, 1.0 - p * HOURS_PER_WEEK))
+            self._hist[row, how] += 1
+            self._totals[row] += 1
+        return score, total >= self.min_events and score >= self.threshold
+
+    def score_failure(self, ts: int) -> tuple[float, int, bool]:
+        # -> (score, số lần fail trong cửa sổ, anomalous); mỗi đợt burst chỉ báo một lần
+        ts = int(ts)
+        with self._lock:
+            self._fails.append(ts)
+            while self._fails and self._fails[0] <= ts - self.fail_window:
+                self._fails.popleft()
+            count = len(self._fails)
+            anomalous = count >= self.fail_burst and (
+                self._last_burst_alert is None or self._last_burst_alert <= ts - self.fail_window
+            )
+            if anomalous:
+                self._last_burst_alert = ts
+        return min(1.0, count / self.fail_burst), count, anomalous
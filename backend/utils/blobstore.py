@@ -0,0 +1,62 @@
+import hashlib
+import os
+import re
+import tempfile
+
+_DIGEST = re.compile(r"^[0-9a-f]{64}$")
+_VARIANT = re.compile(r"^[a-z0-9_-]{1,32}$")
+
+
+class BlobStore:
+    # Lưu ảnh theo nội dung: tên file = sha256 của bytes gốc, chia thư mục 2 cấp (ab/cd/<digest>)
+    # để không dồn hàng chục nghìn file vào một thư mục. Biến thể (thumbnail...) nằm cạnh bản gốc.
+    # Ghi qua file tạm + os.replace -> reader không bao giờ thấy file ghi dở.
+    def __init__(self, root: str, ext: str = ".jpg"):
+        self.root = root
+        self.ext = ext
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def valid(digest: str, variant: str | None = None) -> bool:
+        return bool(_DIGEST.match(digest)) and (variant is None or bool(_VARIANT.match(variant)))
+
+    def _path(self, digest: str, variant: str | None = None) -> str:
+        if not self.valid(digest, variant):
+            raise ValueError("invalid blob key")
+        name = digest + (f".{variant}" if variant else "") + self.ext
+        return os.path.join(self.root, digest[:2], digest[2:4], name)
+
+    def _write(self, path: str, data: bytes) -> None:
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def put(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        self._write(self._path(digest), data)
+        return digest
+
+    def put_variant(self, digest: str, variant: str, data: bytes) -> None:
+        self._write(self._path(digest, variant), data)
+
+    def path(self, digest: str, variant: str | None = None) -> str | None:
+        # -> đường dẫn file nếu blob tồn tại
+        if not self.valid(digest, variant):
+            return None
+        p = self._path(digest, variant)
+        return p if os.path.exists(p) else None
+
+    def read(self, digest: str, variant: str | None = None) -> bytes:
+        p = self.path(digest, variant)
+        if p is None:
+            raise FileNotFoundError(f"blob {digest}{'/' + variant if variant else ''} not found")
+        with open(p, "rb") as f:
+            return f.read()
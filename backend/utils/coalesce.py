@@ -0,0 +1,95 @@
+import threading
+import time
+from typing import Callable, Hashable
+
+PUBLISH_NOW = "now"
+HELD = "held"
+
+
+class _DeviceState:
+    __slots__ = ("last_sent", "last_value", "held", "timer", "current", "current_at")
+
+    def __init__(self):
+        self.last_sent = float("-inf")
+        self.last_value = None
+        self.held = None          # (value, item) đang chờ cuối cửa sổ
+        self.timer = None
+        self.current = None       # giá trị đang hiển thị (LCD)
+        self.current_at = 0.0
+
+
+class DeviceCommandScheduler:
+    # Lập lịch lệnh theo từng thiết bị (key = topic lệnh):
+    # - submit(): lệnh đầu tiên được publish ngay; các lệnh tới trong `window` giây bị giữ lại,
+    #   lệnh mới thay lệnh cũ (last writer wins, lệnh cũ -> supersede). Hết cửa sổ thì publish lệnh
+    #   còn giữ, trừ khi nó trùng với giá trị vừa publish.
+    # - is_current()/mark_current(): bỏ qua nội dung trùng với thứ thiết bị đang hiển thị.
+    def __init__(self, publish: Callable[[object], None], supersede: Callable[[object, str], None],
+                 window: float = 0.5, current_ttl: float = 300.0):
+        self.window = window
+        self.current_ttl = current_ttl
+        self._publish = publish
+        self._supersede = supersede
+        self._devices: dict[Hashable, _DeviceState] = {}
+        self._lock = threading.Lock()
+
+    def _state(self, device: Hashable) -> _DeviceState:
+        st = self._devices.get(device)
+        if st is None:
+            st = self._devices[device] = _DeviceState()
+        return st
+
+    def submit(self, device: Hashable, value, item) -> str:
+        # -> PUBLISH_NOW: caller publish ngay (đồng bộ, trong request); HELD: scheduler sẽ xử lý sau
+        superseded = None
+        now = time.monotonic()
+        with self._lock:
+            st = self._state(device)
+            if st.timer is None and now - st.last_sent >= self.window:
+                st.last_sent, st.last_value = now, value
+                return PUBLISH_NOW
+            if st.held is not None:
+                superseded = st.held[1]
+            st.held = (value, item)
+            if st.timer is None:
+                st.timer = threading.Timer(max(0.0, st.last_sent + self.window - now), self._flush, (device,))
+                st.timer.daemon = True
+                st.timer.start()
+        if superseded is not None:
+            self._supersede(superseded, "superseded by a newer command")
+        return HELD
+
+    def _flush(self, device: Hashable) -> None:
+        with self._lock:
+            st = self._state(device)
+            held, st.held, st.timer = st.held, None, None
+            if held is None:
+                return
+            value, item = held
+            duplicate = value == st.last_value
+            if not duplicate:
+                st.last_sent, st.last_value = time.monotonic(), value
+        if duplicate:
+            self._supersede(item, "no-op: same as the last published command")
+        else:
+            self._publish(item)
+
+    def is_current(self, device: Hashable, value) -> bool:
+        with self._lock:
+            st = self._devices.get(device)
+            return (
+                st is not None and st.current is not None and st.current == value
+                and time.monotonic() - st.current_at < self.current_ttl
+            )
+
+    def mark_current(self, device: Hashable, value) -> None:
+        with self._lock:
+            st = self._state(device)
+            st.current, st.current_at = value, time.monotonic()
+
+    def invalidate(self, device: Hashable) -> None:
+        # thiết bị tự đổi nội dung (vd. LCD in thông báo quét vân tay)
+        with self._lock:
+            st = self._devices.get(device)
+            if st is not None:
+                st.current = None
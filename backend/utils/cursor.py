@@ -0,0 +1,29 @@
+import base64
+import heapq
+import json
+from itertools import islice
+from typing import Callable, Iterable
+
+
+def encode_cursor(data: dict) -> str:
+    raw = json.dumps(data, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> dict:
+    # cursor do client gửi lại -> ValueError nếu không hợp lệ
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError("invalid cursor") from e
+    if not isinstance(data, dict):
+        raise ValueError("invalid cursor")
+    return data
+
+
+def merge_desc(sources: Iterable[Iterable], key: Callable, limit: int) -> tuple[list, bool]:
+    # k-way merge (heap) các nguồn đã sắp giảm dần theo key -> (limit item đầu, còn nữa không)
+    merged = heapq.merge(*sources, key=key, reverse=True)
+    items = list(islice(merged, limit + 1))
+    return items[:limit], len(items) > limit
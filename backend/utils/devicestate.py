@@ -0,0 +1,100 @@
+import copy
+import threading
+import time
+from typing import Callable
+
+
+class DeviceStateStore:
+    # Trạng thái thiết bị trong RAM, cập nhật từ mọi message MQTT (không quét bảng Log):
+    # - touch(): message của thiết bị -> last_seen + các field (door, last_capture_at, last_log...)
+    # - set_presence(): message trạng thái / Last-Will của thiết bị ("online" | "offline")
+    # - online = presence gần nhất, trừ khi đã quá `heartbeat_timeout` giây không thấy message nào
+    # Thay đổi đánh dấu dirty; sync() định kỳ (thread nền) ghi snapshot xuống DB hoặc đọc lại từ DB.
+    def __init__(self, heartbeat_timeout: float = 300.0):
+        self.heartbeat_timeout = heartbeat_timeout
+        self._devices: dict[str, dict] = {}
+        self._dirty: set[str] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def _device(self, name: str) -> dict:
+        st = self._devices.get(name)
+        if st is None:
+            st = self._devices[name] = {"last_seen": None, "presence": None, "presence_at": None}
+        return st
+
+    def touch(self, name: str, seen_at: int, **fields) -> None:
+        # message cũ (replay, tới trễ) không ghi đè trạng thái mới hơn
+        with self._lock:
+            st = self._device(name)
+            if st["last_seen"] is not None and seen_at < st["last_seen"]:
+                return
+            st["last_seen"] = seen_at
+            st.update(fields)
+            if st["presence"] == "offline" and seen_at >= (st["presence_at"] or 0):
+                st["presence"], st["presence_at"] = "online", seen_at
+            self._dirty.add(name)
+
+    def set_presence(self, name: str, presence: str, at: int) -> None:
+        with self._lock:
+            st = self._device(name)
+            st["presence"], st["presence_at"] = presence, at
+            if presence == "online":
+                st["last_seen"] = max(st["last_seen"] or 0, at)
+            self._dirty.add(name)
+
+    def _view(self, st: dict, now: float) -> dict:
+        out = dict(st)
+        fresh = st["last_seen"] is not None and now - st["last_seen"] <= self.heartbeat_timeout
+        out["online"] = fresh and st["presence"] != "offline"
+        return out
+
+    def snapshot(self) -> dict[str, dict]:
+        now = time.time()
+        with self._lock:
+            return {name: self._view(st, now) for name, st in self._devices.items()}
+
+    def get(self, name: str) -> dict | None:
+        with self._lock:
+            st = self._devices.get(name)
+            return self._view(st, time.time()) if st else None
+
+    # ── persistence ──
+    def take_dirty(self) -> dict[str, dict]:
+        # -> bản sao các thiết bị thay đổi từ lần gọi trước (để ghi DB ngoài lock)
+        with self._lock:
+            changed = {name: copy.deepcopy(self._devices[name]) for name in self._dirty}
+            self._dirty.clear()
+        return changed
+
+    def mark_dirty(self, names) -> None:
+        # ghi DB lỗi -> để lần sync sau ghi lại
+        with self._lock:
+            self._dirty.update(n for n in names if n in self._devices)
+
+    def load(self, devices: dict[str, dict]) -> None:
+        # khôi phục từ DB; chỉ nhận bản mới hơn bản đang có trong RAM
+        with self._lock:
+            for name, st in devices.items():
+                cur = self._devices.get(name)
+                if cur is None or (st.get("last_seen") or 0) >= (cur["last_seen"] or 0):
+                    self._devices[name] = dict(self._device(name), **st)
+
+    def start(self, sync: Callable[[], None], interval: float, logger=None) -> None:
+        if self._thread is not None:
+            return
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    sync()
+                except Exception:
+                    if logger:
+                        logger.exception("Device state sync failed")
+
+        self._thread = threading.Thread(target=run, name="device-state-sync", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
@@ -0,0 +1,74 @@
+import threading
+from typing import Callable, Hashable
+
+
+class _Window:
+    __slots__ = ("sent", "count", "first_ts", "last_ts", "timer")
+
+    def __init__(self):
+        self.sent = 0          # số event đã gửi ngay trong cửa sổ hiện tại
+        self.count = 0         # số event đang gom chờ digest
+        self.first_ts = None
+        self.last_ts = None
+        self.timer = None
+
+
+class EventDigester:
+    # Gom event lặp lại theo key (vd. (webhook_id, event)): `immediate` event đầu của mỗi cửa sổ
+    # được gửi ngay, phần còn lại chỉ đếm; hết `window` giây thì gọi deliver(key, count, first_ts,
+    # last_ts) một lần. Cửa sổ nào có digest thì mở tiếp cửa sổ mới (vẫn đang có burst), cửa sổ
+    # trống thì đóng -> event kế tiếp lại được gửi ngay.
+    def __init__(self, deliver: Callable[[Hashable, int, int, int], None],
+                 window: float = 60.0, immediate: int = 1, logger=None):
+        self.window = window
+        self.immediate = immediate
+        self._deliver = deliver
+        self._logger = logger
+        self._windows: dict[Hashable, _Window] = {}
+        self._lock = threading.Lock()
+
+    def offer(self, key: Hashable, ts: int) -> bool:
+        # -> True: caller gửi event này ngay; False: đã gom vào digest
+        if self.window <= 0:
+            return True
+        with self._lock:
+            w = self._windows.get(key)
+            if w is None:
+                w = self._windows[key] = _Window()
+                self._arm(key, w)
+            if w.sent < self.immediate:
+                w.sent += 1
+                return True
+            w.count += 1
+            w.first_ts = ts if w.first_ts is None else w.first_ts
+            w.last_ts = ts
+            return False
+
+    def _arm(self, key: Hashable, w: _Window) -> None:
+        w.timer = threading.Timer(self.window, self._flush, (key,))
+        w.timer.daemon = True
+        w.timer.start()
+
+    def _flush(self, key: Hashable) -> None:
+        with self._lock:
+            w = self._windows.get(key)
+            if w is None:
+                return
+            count, first_ts, last_ts = w.count, w.first_ts, w.last_ts
+            if count:
+                # burst vẫn tiếp diễn: cửa sổ sau chỉ gom, không gửi lẻ nữa
+                w.count, w.first_ts, w.last_ts = 0, None, None
+                w.sent = self.immediate
+                self._arm(key, w)
+            else:
+                del self._windows[key]
+        if count:
+            try:
+                self._deliver(key, count, first_ts, last_ts)
+            except Exception as e:
+                if self._logger:
+                    self._logger.warning("Digest delivery failed for %r: %s", key, e)
+
+    def pending(self) -> dict[Hashable, int]:
+        with self._lock:
+            return {k: w.count for k, w in self._windows.items() if w.count}
@@ -1,9 +1,15 @@
 import os
-import resend
 
-# initialize with your API key
-resend.api_key = os.environ["RESEND_API_KEY"]
-login_url = os.environ["FRONT_END_URL"] + "/login"
+_resend = None
+
+def _client():
+    # import + đọc RESEND_API_KEY ở lần gửi đầu tiên, không phải lúc import module
+    global _resend
+    if _resend is None:
+        import resend
+        resend.api_key = os.environ["RESEND_API_KEY"]
+        _resend = resend
+    return _resend
 
 def send_registration_email(to_email: str, username: str, otp_code: str) -> None:
 
@@ -94,6 +100,7 @@ def send_registration_email(to_email: str, username: str, otp_code: str) -> None
     </body>
     </html>
     """
+    resend = _client()
     params: resend.Emails.SendParams = {
         "from": "IOT Smart Door <Nhom8_23CLC03@obiwan.io.vn>",
         "to": [to_email],
@@ -178,6 +185,7 @@ def send_fingerprint_action_email(to_email: str, username: str, action: str) ->
     </body>
     </html>
     """
+    resend = _client()
     params: resend.Emails.SendParams = {
         "from": "IOT Smart Door <Nhom8_23CLC03@obiwan.io.vn>",
         "to": [to_email],
@@ -0,0 +1,62 @@
+import csv
+import io
+import json
+import zlib
+from typing import Iterable, Iterator, Sequence
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+# Gom các dòng nhỏ thành chunk ~64 KB để giảm số lần write xuống socket
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_ndjson(rows: Iterable[Sequence], columns: Sequence[str]) -> Iterator[str]:
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n"
+
+
+def iter_csv(rows: Iterable[Sequence], columns: Sequence[str]) -> Iterator[str]:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(row)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate(0)
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def iter_chunks(lines: Iterable[str], size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    parts, total = [], 0
+    for line in lines:
+        data = line.encode("utf-8")
+        parts.append(data)
+        total += len(data)
+        if total >= size:
+            yield b"".join(parts)
+            parts, total = [], 0
+    if parts:
+        yield b"".join(parts)
+
+
+def iter_gzip(chunks: Iterable[bytes], level: int = 6) -> Iterator[bytes]:
+    # wbits=31 -> gzip container, nén từng chunk mà không cần giữ toàn bộ file
+    comp = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        out = comp.compress(chunk)
+        if out:
+            yield out
+    yield comp.flush()
+
+
+def export_stream(rows: Iterable[Sequence], columns: Sequence[str], fmt: str, gzip: bool = False) -> Iterator[bytes]:
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(EXPORT_FORMATS)}")
+    lines = iter_csv(rows, columns) if fmt == "csv" else iter_ndjson(rows, columns)
+    chunks = iter_chunks(lines)
+    return iter_gzip(chunks) if gzip else chunks
@@ -0,0 +1,22 @@
+import threading
+
+_session = None
+_lock = threading.Lock()
+
+
+def http_session():
+    # requests.Session dùng chung (keep-alive, connection pool) cho webhook và Gemini;
+    # chỉ import/khởi tạo ở lần gọi đầu tiên để không làm chậm lúc khởi động
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16)
+                s.mount("https://", adapter)
+                s.mount("http://", adapter)
+                _session = s
+    return _session
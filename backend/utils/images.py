@@ -0,0 +1,76 @@
+import io
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+
+JPEG_MAGIC = b"\xff\xd8\xff"
+
+
+def _noop() -> None:
+    return None
+
+
+def parse_variants(spec: str) -> dict[str, int]:
+    # "thumb:320,medium:1024" -> {"thumb": 320, "medium": 1024} (cạnh dài tối đa, pixel)
+    out = {}
+    for part in spec.split(","):
+        if part.strip():
+            name, _, size = part.partition(":")
+            out[name.strip()] = int(size)
+    return out
+
+
+def render_variants(data: bytes, sizes: dict[str, int], quality: int = 80) -> dict[str, bytes]:
+    # Chạy trong process worker: decode một lần (draft -> JPEG tự scale khi decode), resize
+    # từ lớn tới nhỏ, encode lại JPEG
+    from PIL import Image
+
+    out = {}
+    with Image.open(io.BytesIO(data)) as im:
+        biggest = max(sizes.values())
+        im.draft("RGB", (biggest, biggest))
+        im = im.convert("RGB")
+        for name, size in sorted(sizes.items(), key=lambda kv: -kv[1]):
+            variant = im.copy()
+            variant.thumbnail((size, size), Image.LANCZOS)
+            buf = io.BytesIO()
+            variant.save(buf, "JPEG", quality=quality, optimize=True)
+            out[name] = buf.getvalue()
+    return out
+
+
+class ImagePool:
+    # Process pool cho việc resize/encode ảnh (CPU-bound, giữ GIL nếu chạy trong thread).
+    # workers=0 -> chạy ngay trong thread gọi (dev / test).
+    def __init__(self, workers: int = 2):
+        self.workers = max(0, workers)
+        self._lock = threading.Lock()
+        self._executor: ProcessPoolExecutor | None = None
+
+    def start(self) -> None:
+        # như PasswordHasher: fork worker ngay (submit no-op) trước khi app mở thread nền
+        if self.workers == 0:
+            return
+        with self._lock:
+            if self._executor is None:
+                methods = multiprocessing.get_all_start_methods()
+                ctx = multiprocessing.get_context("fork" if "fork" in methods else None)
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx)
+                self._executor.submit(_noop).result()
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def submit(self, fn, *args) -> Future:
+        if self.workers == 0:
+            fut: Future = Future()
+            try:
+                fut.set_result(fn(*args))
+            except Exception as e:
+                fut.set_exception(e)
+            return fut
+        self.start()
+        return self._executor.submit(fn, *args)
@@ -0,0 +1,120 @@
+import itertools
+import json
+import logging
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+# thuộc tính có sẵn của LogRecord; phần còn lại là field truyền qua extra={...}
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+_PRIMITIVES = (str, int, float, bool, type(None))
+
+
+def parse_sample_rates(spec: str) -> dict[str, float]:
+    # "ingest:0.1,webhook:0.5" -> {"ingest": 0.1, "webhook": 0.5} (tên logger con, tương đối)
+    out = {}
+    for part in spec.split(","):
+        if part.strip():
+            name, _, rate = part.partition(":")
+            out[name.strip()] = min(1.0, max(0.0, float(rate)))
+    return out
+
+
+class SamplingFilter(logging.Filter):
+    # Giữ 1/N record dưới WARNING của các logger con được cấu hình (đếm, không random -> đều và rẻ);
+    # WARNING trở lên luôn được giữ. Chạy trên thread gọi log, trước khi vào queue.
+    def __init__(self, base: str, rates: dict[str, float]):
+        super().__init__()
+        self._rates = {f"{base}.{name}": rate for name, rate in rates.items()}
+        self._counters: dict[str, itertools.count] = {}
+        self._lock = threading.Lock()
+
+    def _rate(self, name: str) -> float | None:
+        while name:
+            if name in self._rates:
+                return self._rates[name]
+            name = name.rpartition(".")[0]
+        return None
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate(record.name)
+        if rate is None or rate >= 1.0:
+            return True
+        if rate <= 0.0:
+            return False
+        counter = self._counters.get(record.name)
+        if counter is None:
+            with self._lock:
+                counter = self._counters.setdefault(record.name, itertools.count())
+        return next(counter) % round(1 / rate) == 0
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    # Thread gọi log chỉ đưa record vào queue; format (message, JSON, traceback) do listener làm.
+    # Queue đầy -> bỏ record và đếm, không bao giờ chặn request / MQTT handler.
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # args là object (ORM row...) có thể đổi / không dùng được ở thread khác -> render ngay;
+        # args kiểu nguyên thủy thì để listener format
+        if record.args and not all(isinstance(a, _PRIMITIVES) for a in (
+                record.args.values() if isinstance(record.args, dict) else record.args)):
+            record.msg, record.args = record.getMessage(), None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "thread": record.threadName,
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                out[key] = value if isinstance(value, _PRIMITIVES) else repr(value)
+        if record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            out["exc"] = record.exc_text
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+
+def setup_logging(logger: logging.Logger, level: str = "INFO", as_json: bool = True,
+                  sample_rates: dict[str, float] | None = None, queue_size: int = 10000,
+                  start: bool = True) -> NonBlockingQueueHandler:
+    # Thay handler của logger (Flask: app.logger) bằng queue + listener thread ghi ra stderr.
+    # start=False: record chỉ nằm trong queue tới khi caller gọi handler.listener.start()
+    # (vd. sau khi fork process pool). -> handler (handler.dropped, handler.listener)
+    stream = logging.StreamHandler()
+    stream.setFormatter(JsonFormatter() if as_json else logging.Formatter(
+        "%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    q: queue.Queue = queue.Queue(maxsize=queue_size)
+    handler = NonBlockingQueueHandler(q)
+    if sample_rates:
+        handler.addFilter(SamplingFilter(logger.name, sample_rates))
+    for h in list(logger.handlers):
+        logger.removeHandler(h)
+        # create_app() gọi lại (test, bench); listener có thể chưa start (start=False)
+        if isinstance(h, NonBlockingQueueHandler) and h.listener._thread is not None:
+            h.listener.stop()
+    logger.addHandler(handler)
+    logger.setLevel(level.upper())
+    logger.propagate = False
+    handler.listener = QueueListener(q, stream, respect_handler_level=True)
+    if start:
+        handler.listener.start()
+    return handler
+
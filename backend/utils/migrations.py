@@ -0,0 +1,180 @@
+import json
+import re
+import time
+from typing import Callable
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+
+from utils.payload import parse_payload, extract_fields
+
+# (version, name, fn) — chạy đúng một lần theo thứ tự version, sau db.create_all()
+_MIGRATIONS: list[tuple[int, str, Callable[[Connection], None]]] = []
+
+
+def migration(version: int, name: str):
+    def decorator(fn: Callable[[Connection], None]):
+        _MIGRATIONS.append((version, name, fn))
+        return fn
+    return decorator
+
+
+def run_migrations(engine: Engine, logger=None) -> list[int]:
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            " version INTEGER PRIMARY KEY,"
+            " name VARCHAR(128) NOT NULL,"
+            " applied_at BIGINT NOT NULL)"
+        ))
+        applied = {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+    done = []
+    for version, name, fn in sorted(_MIGRATIONS, key=lambda m: m[0]):
+        if version in applied:
+            continue
+        with engine.begin() as conn:
+            fn(conn)
+            conn.execute(
+                text("INSERT INTO schema_migrations (version, name, applied_at) VALUES (:v, :n, :t)"),
+                {"v": version, "n": name, "t": int(time.time())},
+            )
+        done.append(version)
+        if logger:
+            logger.info("Applied migration %s (%s)", version, name)
+    return done
+
+
+def is_sqlite(conn: Connection) -> bool:
+    return conn.dialect.name == "sqlite"
+
+
+def has_column(conn: Connection, table: str, column: str) -> bool:
+    return any(c["name"] == column for c in inspect(conn).get_columns(table))
+
+
+def has_index(conn: Connection, table: str, index: str) -> bool:
+    return any(i["name"] == index for i in inspect(conn).get_indexes(table))
+
+
+def rebuild_sqlite_table(conn: Connection, table: str, create_sql: str) -> None:
+    # SQLite không ALTER được CHECK constraint: tạo bảng mới, copy, drop, rename, tạo lại index
+    # (foreign_keys của SQLite mặc định tắt nên các FK trỏ tới bảng vẫn giữ nguyên theo tên)
+    indexes = [r[0] for r in conn.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL", (table,)
+    )]
+    tmp = f"{table}__new"
+    conn.exec_driver_sql(re.sub(rf'^CREATE TABLE\s+"?{table}"?', f"CREATE TABLE {tmp}", create_sql, count=1))
+    conn.exec_driver_sql(f"INSERT INTO {tmp} SELECT * FROM {table}")
+    conn.exec_driver_sql(f"DROP TABLE {table}")
+    conn.exec_driver_sql(f"ALTER TABLE {tmp} RENAME TO {table}")
+    for sql in indexes:
+        conn.exec_driver_sql(sql)
+
+
+# ─── Migrations ────────────────────────────────────────
+
+@migration(1, "log_fts")
+def _log_fts(conn: Connection) -> None:
+    # FTS5 external-content table trên log(description, payload); trigger giữ đồng bộ khi ingest
+    if not is_sqlite(conn):
+        return
+    for stmt in (
+        "CREATE VIRTUAL TABLE IF NOT EXISTS log_fts USING fts5("
+        " description, payload, content='log', content_rowid='id')",
+        "CREATE TRIGGER IF NOT EXISTS log_fts_ai AFTER INSERT ON log BEGIN"
+        " INSERT INTO log_fts(rowid, description, payload) VALUES (new.id, new.description, new.payload);"
+        " END",
+        "CREATE TRIGGER IF NOT EXISTS log_fts_ad AFTER DELETE ON log BEGIN"
+        " INSERT INTO log_fts(log_fts, rowid, description, payload) VALUES ('delete', old.id, old.description, old.payload);"
+        " END",
+        "CREATE TRIGGER IF NOT EXISTS log_fts_au AFTER UPDATE OF description, payload ON log BEGIN"
+        " INSERT INTO log_fts(log_fts, rowid, description, payload) VALUES ('delete', old.id, old.description, old.payload);"
+        " INSERT INTO log_fts(rowid, description, payload) VALUES (new.id, new.description, new.payload);"
+        " END",
+        "INSERT INTO log_fts(log_fts) VALUES ('rebuild')",
+    ):
+        conn.exec_driver_sql(stmt)
+
+
+@migration(2, "log_structured_payload")
+def _log_structured_payload(conn: Connection) -> None:
+    for name, ddl in (
+        ("payload_json",   "ALTER TABLE log ADD COLUMN payload_json JSON"),
+        ("fingerprint_id", "ALTER TABLE log ADD COLUMN fingerprint_id INTEGER"),
+        ("action",         "ALTER TABLE log ADD COLUMN action VARCHAR(16)"),
+    ):
+        if not has_column(conn, "log", name):
+            conn.exec_driver_sql(ddl)
+    if not has_index(conn, "log", "ix_log_fingerprint_created"):
+        conn.exec_driver_sql("CREATE INDEX ix_log_fingerprint_created ON log (fingerprint_id, created_at)")
+    if not has_index(conn, "log", "ix_log_action_created"):
+        conn.exec_driver_sql("CREATE INDEX ix_log_action_created ON log (action, created_at)")
+
+    # Backfill theo lô: parse payload cũ một lần rồi ghi vào cột có cấu trúc
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            text("SELECT id, log_type, payload FROM log"
+                 " WHERE id > :last AND payload IS NOT NULL AND payload_json IS NULL"
+                 " ORDER BY id LIMIT 1000"),
+            {"last": last_id},
+        ).all()
+        if not rows:
+            break
+        updates = []
+        for log_id, log_type, raw in rows:
+            data = parse_payload(raw)
+            fingerprint_id, action = extract_fields(log_type, data)
+            updates.append({
+                "id": log_id,
+                "pj": json.dumps(data, ensure_ascii=False) if data is not None else None,
+                "fp": fingerprint_id,
+                "ac": action,
+            })
+        conn.execute(
+            text("UPDATE log SET payload_json = :pj, fingerprint_id = :fp, action = :ac WHERE id = :id"),
+            updates,
+        )
+        last_id = rows[-1][0]
+
+
+@migration(3, "capture_phash")
+def _capture_phash(conn: Connection) -> None:
+    if not has_column(conn, "capture", "phash"):
+        conn.exec_driver_sql("ALTER TABLE capture ADD COLUMN phash BIGINT")
+    if not has_column(conn, "capture", "duplicate_of_id"):
+        conn.exec_driver_sql("ALTER TABLE capture ADD COLUMN duplicate_of_id INTEGER REFERENCES capture (id) ON DELETE SET NULL")
+    if not has_index(conn, "capture", "ix_capture_phash"):
+        conn.exec_driver_sql("CREATE INDEX ix_capture_phash ON capture (phash)")
+    if not has_index(conn, "capture", "ix_capture_duplicate_of_id"):
+        conn.exec_driver_sql("CREATE INDEX ix_capture_duplicate_of_id ON capture (duplicate_of_id)")
+
+
+@migration(4, "command_status_superseded")
+def _command_status_superseded(conn: Connection) -> None:
+    statuses = "'sent','error','pending','superseded'"
+    if not is_sqlite(conn):
+        conn.exec_driver_sql("ALTER TABLE command DROP CONSTRAINT ck_command_status")
+        conn.exec_driver_sql(f"ALTER TABLE command ADD CONSTRAINT ck_command_status CHECK (status IN ({statuses}))")
+        return
+    sql = conn.exec_driver_sql("SELECT sql FROM sqlite_master WHERE type='table' AND name='command'").scalar()
+    if not sql or "superseded" in sql:
+        return
+    new_sql, n = re.subn(r"status IN \([^)]*\)", f"status IN ({statuses})", sql, count=1)
+    if n:
+        rebuild_sqlite_table(conn, "command", new_sql)
+
+
+@migration(5, "foreign_key_indexes")
+def _foreign_key_indexes(conn: Connection) -> None:
+    # lookup theo FK trước đây là full scan (thấy qua /api/admin/queries)
+    for table, col in (
+        ("webhook", "user_id"),
+        ("fingerprint", "user_id"),
+        ("log", "command_id"),
+        ("log", "related_log_id"),
+    ):
+        name = f"ix_{table}_{col}"
+        if not has_index(conn, table, name):
+            conn.exec_driver_sql(f"CREATE INDEX {name} ON {table} ({col})")
@@ -0,0 +1,65 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HashingBusy(Exception):
+    """Pool đã đủ số job đang chờ; request nên trả 503 thay vì xếp hàng."""
+
+
+def _noop() -> None:
+    return None
+
+
+class PasswordHasher:
+    # Băm/kiểm tra mật khẩu (PBKDF2/scrypt) trong process pool riêng để không chiếm
+    # thread xử lý request; semaphore giới hạn số job đồng thời (đang chạy + đang chờ).
+    def __init__(self, workers: int = 2, max_pending: int = 8, timeout: float = 10.0):
+        self.workers = max(0, workers)
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+        self._lock = threading.Lock()
+        self._executor: ProcessPoolExecutor | None = None
+
+    def start(self) -> None:
+        # Gọi sớm lúc khởi động (trước khi MQTT mở thread) để fork worker từ process còn "sạch"
+        if self.workers == 0:
+            return
+        with self._lock:
+            if self._executor is None:
+                methods = multiprocessing.get_all_start_methods()
+                ctx = multiprocessing.get_context("fork" if "fork" in methods else None)
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx)
+                self._executor.submit(_noop).result()
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def _run(self, fn, *args):
+        if self.workers == 0:
+            return fn(*args)
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy("password hashing queue is full")
+        try:
+            self.start()
+            try:
+                return self._executor.submit(fn, *args).result(timeout=self.timeout)
+            except BrokenProcessPool:
+                self.shutdown()
+                raise
+            except FutureTimeout:
+                raise HashingBusy("password hashing timed out")
+        finally:
+            self._slots.release()
+
+    def hash(self, password: str) -> str:
+        return self._run(generate_password_hash, password)
+
+    def verify(self, password_hash: str, password: str) -> bool:
+        return self._run(check_password_hash, password_hash, password)
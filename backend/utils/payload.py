@@ -0,0 +1,60 @@
+import ast
+import json
+
+FINGERPRINT_LOG_PREFIXES = ("match.", "enroll.", "delete.")
+
+
+def parse_payload(raw):
+    # Chuẩn hoá payload một lần lúc ingest: dict/list nếu là JSON (hoặc literal Python),
+    # chuỗi đã strip nếu là text thường ('open', '3'), None nếu rỗng
+    if raw is None or isinstance(raw, (dict, list, int, float, bool)):
+        return raw
+    s = str(raw).strip()
+    if not s:
+        return None
+    try:
+        return json.loads(s)
+    except (ValueError, TypeError):
+        pass
+    if s[0] in "{[":
+        try:
+            return ast.literal_eval(s)
+        except (ValueError, SyntaxError):
+            pass
+    return s
+
+
+def payload_text(raw) -> str | None:
+    if raw is None or isinstance(raw, str):
+        return raw
+    return json.dumps(raw, ensure_ascii=False)
+
+
+def _as_int(v) -> int | None:
+    if isinstance(v, bool):
+        return None
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return None
+
+
+def extract_fields(log_type: str | None, data) -> tuple[int | None, str | None]:
+    # -> (fingerprint_id, action) để lưu thành cột có index
+    log_type = log_type or ""
+    fingerprint_id, action = None, None
+
+    if isinstance(data, dict):
+        if log_type.startswith(FINGERPRINT_LOG_PREFIXES):
+            fingerprint_id = _as_int(data.get("id"))
+        if isinstance(data.get("action"), str):
+            action = data["action"]
+    elif log_type.startswith(FINGERPRINT_LOG_PREFIXES):
+        # enroll.progress gửi payload là slot id dạng "3"
+        fingerprint_id = _as_int(data)
+    elif isinstance(data, str):
+        action = data
+
+    if action is not None:
+        action = action.strip().lower()[:16] or None
+    return fingerprint_id, action
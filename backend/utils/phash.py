@@ -0,0 +1,174 @@
+import io
+import queue
+import threading
+from typing import Callable
+
+# NumPy/Pillow chỉ được import khi thật sự băm ảnh hoặc truy vấn index,
+# để role không dùng tới (api-only, test) không phải trả chi phí import lúc khởi động
+
+_POPCOUNT = None
+
+
+def _np():
+    import numpy as np
+    return np
+
+
+def to_signed(h: int) -> int:
+    # cột INTEGER của SQLite là int64 có dấu
+    return h - (1 << 64) if h >= (1 << 63) else h
+
+
+def to_unsigned(h: int) -> int:
+    return h + (1 << 64) if h < 0 else h
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(to_unsigned(a) ^ to_unsigned(b)).count("1")
+
+
+def _gray(data: bytes, size: tuple[int, int]):
+    from PIL import Image
+
+    np = _np()
+    with Image.open(io.BytesIO(data)) as im:
+        im.draft("L", (size[0] * 4, size[1] * 4))   # JPEG: giảm kích thước ngay khi decode
+        return np.asarray(im.convert("L").resize(size, Image.BILINEAR), dtype=np.float32)
+
+
+def _pack(bits) -> int:
+    np = _np()
+    return int.from_bytes(np.packbits(bits.astype(np.uint8)).tobytes(), "big")
+
+
+def dhash(data: bytes, size: int = 8) -> int:
+    g = _gray(data, (size + 1, size))
+    return _pack((g[:, 1:] > g[:, :-1]).ravel())
+
+
+def _dct_matrix(n: int):
+    np = _np()
+    k = np.arange(n)[:, None]
+    m = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    m[0] /= np.sqrt(2.0)
+    return m
+
+
+def phash(data: bytes, size: int = 8, highfreq: int = 4) -> int:
+    np = _np()
+    n = size * highfreq
+    d = _dct_matrix(n)
+    low = (d @ _gray(data, (n, n)) @ d.T)[:size, :size]
+    return _pack((low > np.median(low.ravel()[1:])).ravel())
+
+
+HASHERS = {"dhash": dhash, "phash": phash}
+
+
+class HammingIndex:
+    # Index trong bộ nhớ: mảng id + hash 64-bit liền kề, truy vấn bằng XOR + popcount vector hoá.
+    # Hash được ghi bất đồng bộ (không theo thứ tự id) -> không dùng watermark id để loại trùng mà
+    # giữ tập id đã có; load() đọc lại một khoảng id phía dưới watermark để bắt hash tới muộn.
+    def __init__(self):
+        self._ids = None
+        self._hashes = None
+        self._n = 0
+        self._present: set[int] = set()
+        self.watermark = 0              # id lớn nhất đã đọc từ DB (add() cục bộ không đổi giá trị này)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._n
+
+    def _append(self, ids, hashes) -> None:
+        # gọi khi đang giữ lock; ids chưa có trong index
+        np = _np()
+        ids = np.asarray(ids, dtype=np.int64)
+        hashes = np.asarray([to_unsigned(int(h)) for h in hashes], dtype=np.uint64)
+        if not len(ids):
+            return
+        need = self._n + len(ids)
+        if self._ids is None or need > len(self._ids):
+            cap = max(1024, need, 2 * (len(self._ids) if self._ids is not None else 0))
+            new_ids = np.zeros(cap, dtype=np.int64)
+            new_hashes = np.zeros(cap, dtype=np.uint64)
+            if self._n:
+                new_ids[: self._n] = self._ids[: self._n]
+                new_hashes[: self._n] = self._hashes[: self._n]
+            self._ids, self._hashes = new_ids, new_hashes
+        self._ids[self._n: need] = ids
+        self._hashes[self._n: need] = hashes
+        self._n = need
+        self._present.update(int(i) for i in ids)
+
+    def add(self, capture_id: int, h: int) -> None:
+        # hash do process này vừa tính
+        with self._lock:
+            if capture_id not in self._present:
+                self._append([capture_id], [h])
+
+    def load(self, rows) -> int:
+        # rows: (id, hash) đọc từ DB -> số hash mới được thêm
+        with self._lock:
+            fresh = [(cid, h) for cid, h in rows if cid not in self._present]
+            self.watermark = max([self.watermark] + [cid for cid, _ in rows])
+            self._append([cid for cid, _ in fresh], [h for _, h in fresh])
+            return len(fresh)
+
+    def query(self, h: int, max_distance: int, limit: int, exclude_id: int | None = None) -> list[tuple[int, int]]:
+        global _POPCOUNT
+        np = _np()
+        with self._lock:
+            if not self._n:
+                return []
+            ids = self._ids[: self._n]
+            x = self._hashes[: self._n] ^ np.uint64(to_unsigned(h))
+        if _POPCOUNT is None:
+            _POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+        dist = _POPCOUNT[x.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.int32)
+        mask = dist <= max_distance
+        if exclude_id is not None:
+            mask &= ids != exclude_id
+        idx = np.nonzero(mask)[0]
+        idx = idx[np.lexsort((-ids[idx], dist[idx]))][:limit]   # gần nhất trước, mới hơn trước
+        return [(int(ids[i]), int(dist[i])) for i in idx]
+
+
+class HashWorker:
+    # Thread nền: tải thumbnail -> băm -> gọi on_hash(capture_id, hash). Queue có giới hạn,
+    # đầy thì bỏ qua (handler MQTT không bao giờ bị chặn vì việc băm ảnh)
+    def __init__(self, fetch: Callable[[str], bytes], on_hash: Callable[[int, int], None],
+                 algo: str = "dhash", maxsize: int = 256, logger=None):
+        if algo not in HASHERS:
+            raise ValueError(f"algo must be one of: {', '.join(HASHERS)}")
+        self._fetch = fetch
+        self._on_hash = on_hash
+        self._hash = HASHERS[algo]
+        self._queue: queue.Queue = queue.Queue(maxsize=maxsize)
+        self._logger = logger
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="capture-hasher", daemon=True)
+            self._thread.start()
+
+    def submit(self, capture_id: int, url: str) -> bool:
+        try:
+            self._queue.put_nowait((capture_id, url))
+            return True
+        except queue.Full:
+            if self._logger:
+                self._logger.warning("Capture hash queue full; skipped capture id=%s", capture_id)
+            return False
+
+    def _run(self) -> None:
+        while True:
+            capture_id, url = self._queue.get()
+            try:
+                self._on_hash(capture_id, self._hash(self._fetch(url)))
+            except Exception as e:
+                if self._logger:
+                    self._logger.warning("Hashing capture id=%s failed: %s", capture_id, e)
+            finally:
+                self._queue.task_done()
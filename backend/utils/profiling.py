@@ -0,0 +1,196 @@
+import cProfile
+import io
+import itertools
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+
+def _frame_label(frame) -> str:
+    co = frame.f_code
+    return f"{co.co_name} ({os.path.basename(co.co_filename)}:{co.co_firstlineno})"
+
+
+def collapse_stack(frame, max_depth: int = 64) -> str:
+    # stack từ gốc -> lá, nối bằng ';' (định dạng collapsed của flamegraph.pl / speedscope)
+    names = []
+    while frame is not None and len(names) < max_depth:
+        names.append(_frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    # Thread nền chụp sys._current_frames() mỗi `interval` giây, nhưng chỉ ghi stack của các
+    # thread đang nằm trong track(label) -> chi phí gần như bằng 0 cho request không được chọn.
+    def __init__(self, interval: float = 0.005, max_depth: int = 64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self._tracked: dict[int, str] = {}
+        self._counts: Counter = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.started_at = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    @contextmanager
+    def track(self, label: str):
+        tid = threading.get_ident()
+        self._tracked[tid] = label
+        try:
+            yield
+        finally:
+            self._tracked.pop(tid, None)
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._counts = Counter()
+            self._stop.clear()
+            self.started_at = time.time()
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> Counter:
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return Counter()
+        self._stop.set()
+        thread.join()
+        return self._counts
+
+    def _run(self) -> None:
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            if not self._tracked:
+                continue
+            frames = sys._current_frames()
+            for tid, label in list(self._tracked.items()):
+                frame = frames.get(tid)
+                if frame is not None and tid != me:
+                    self._counts[f"{label};{collapse_stack(frame, self.max_depth)}"] += 1
+
+
+def collapsed_text(counts: Counter) -> bytes:
+    return "".join(f"{stack} {n}\n" for stack, n in counts.most_common()).encode("utf-8")
+
+
+class Profiler:
+    # Gom cả hai chế độ và giữ kết quả trong ring có giới hạn (profile cũ nhất bị đẩy ra):
+    # - sampling theo endpoint / MQTT handler được admin bật trong một khoảng thời gian
+    # - cProfile cho một request riêng lẻ (header)
+    def __init__(self, ring_size: int = 20, interval: float = 0.005):
+        self.sampler = SamplingProfiler(interval=interval)
+        self.routes: set[str] = set()
+        self.mqtt = False
+        self._ring: deque = deque(maxlen=ring_size)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._timer: threading.Timer | None = None
+        self._cprofile_lock = threading.Lock()
+
+    # ── sampling ──
+    def start_sampling(self, routes, mqtt: bool, duration: float | None) -> None:
+        self.stop_sampling()
+        self.routes = set(routes)
+        self.mqtt = mqtt
+        self.sampler.start()
+        if duration:
+            self._timer = threading.Timer(duration, self.stop_sampling)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def stop_sampling(self) -> dict | None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        started_at = self.sampler.started_at
+        if not self.sampler.running:
+            return None
+        counts = self.sampler.stop()
+        label = ",".join(sorted(self.routes) + (["mqtt"] if self.mqtt else [])) or "-"
+        self.routes, self.mqtt = set(), False
+        return self.add("sample", label, {"collapsed": collapsed_text(counts)},
+                        started_at=started_at, samples=sum(counts.values()))
+
+    def wants_route(self, endpoint: str | None) -> bool:
+        return self.sampler.running and endpoint in self.routes
+
+    def wants_mqtt(self) -> bool:
+        return self.sampler.running and self.mqtt
+
+    def instrument(self, label: str, fn):
+        # bọc callback MQTT: chỉ track khi đang sampling MQTT
+        def wrapper(*args, **kwargs):
+            if not self.wants_mqtt():
+                return fn(*args, **kwargs)
+            with self.sampler.track(label):
+                return fn(*args, **kwargs)
+        wrapper.__name__ = getattr(fn, "__name__", "handler")
+        return wrapper
+
+    # ── cProfile ──
+    def begin_cprofile(self) -> cProfile.Profile | None:
+        # Python 3.12+: mỗi lúc chỉ một profiler được bật -> request khác đang profile thì bỏ qua
+        if not self._cprofile_lock.acquire(blocking=False):
+            return None
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            self._cprofile_lock.release()
+            return None
+        return prof
+
+    def end_cprofile(self, prof: cProfile.Profile, label: str, started_at: float) -> dict:
+        try:
+            prof.disable()
+        finally:
+            self._cprofile_lock.release()
+        prof.create_stats()
+        out = io.StringIO()
+        pstats.Stats(prof, stream=out).sort_stats("cumulative").print_stats(60)
+        return self.add("cprofile", label, {
+            "text": out.getvalue().encode("utf-8"),
+            "prof": marshal.dumps(prof.stats),     # đọc bằng pstats / snakeviz
+        }, started_at=started_at, samples=None)
+
+    # ── ring ──
+    def add(self, kind: str, label: str, data: dict[str, bytes], started_at: float, samples) -> dict:
+        entry = {
+            "id": next(self._ids),
+            "kind": kind,
+            "label": label,
+            "started_at": started_at,
+            "duration_s": round(time.time() - started_at, 3) if started_at else None,
+            "samples": samples,
+            "formats": list(data),          # phần tử đầu = định dạng mặc định
+            "_data": data,
+        }
+        with self._lock:
+            self._ring.append(entry)
+        return entry
+
+    def list(self) -> list[dict]:
+        with self._lock:
+            return [{k: v for k, v in e.items() if k != "_data"} for e in reversed(self._ring)]
+
+    def get(self, profile_id: int, fmt: str | None = None) -> tuple[dict, str, bytes] | None:
+        with self._lock:
+            entry = next((e for e in self._ring if e["id"] == profile_id), None)
+        if entry is None:
+            return None
+        fmt = fmt or entry["formats"][0]
+        data = entry["_data"].get(fmt)
+        return (entry, fmt, data) if data is not None else None
@@ -0,0 +1,132 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+
+# Số mid "ack tới trước khi kịp đăng ký" được giữ lại (paho có thể gọi on_publish
+# trên network thread trước khi publish() trả mid về cho thread gọi)
+_EARLY_ACKS_MAX = 256
+
+# paho MQTT_ERR_NO_CONN: mất kết nối nhưng message QoS>0 đã vào hàng đợi của client và sẽ được
+# gửi (rồi ack) sau khi reconnect -> vẫn chờ PUBACK như bình thường
+_MQTT_ERR_NO_CONN = 4
+
+
+class PublishTicket:
+    __slots__ = ("item", "mid", "sent_at", "ok", "error", "_done")
+
+    def __init__(self, item):
+        self.item = item
+        self.mid = None
+        self.sent_at = time.monotonic()
+        self.ok = None
+        self.error = None
+        self._done = threading.Event()
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: float) -> bool:
+        return self._done.wait(timeout)
+
+
+class AckPublisher:
+    # Publish kiểu pipeline: không chờ PUBACK giữa các lệnh, chỉ giới hạn số message QoS>0
+    # đang bay bằng semaphore (max_inflight). on_publish(mid) từ paho đóng ticket tương ứng và
+    # gọi on_result(item, ok, error); ticket quá ack_timeout mà chưa có PUBACK thì bị đánh lỗi.
+    def __init__(self, publish: Callable[[str, str, int], tuple[int, int]],
+                 on_result: Callable[[object, bool, str | None], None],
+                 max_inflight: int = 20, ack_timeout: float = 10.0, slot_timeout: float = 2.0,
+                 logger=None):
+        self.max_inflight = max_inflight
+        self.ack_timeout = ack_timeout
+        self.slot_timeout = slot_timeout
+        self._publish = publish
+        self._on_result = on_result
+        self._logger = logger
+        self._slots = threading.BoundedSemaphore(max_inflight)
+        self._inflight: dict[int, PublishTicket] = {}
+        self._early: OrderedDict[int, float] = OrderedDict()
+        self._lock = threading.Lock()
+        self._reaper: threading.Thread | None = None
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    def start(self) -> None:
+        if self._reaper is None:
+            self._reaper = threading.Thread(target=self._reap, name="mqtt-ack-reaper", daemon=True)
+            self._reaper.start()
+
+    def publish(self, topic: str, payload: str, qos: int = 1, item=None) -> PublishTicket:
+        ticket = PublishTicket(item)
+        if qos > 0 and not self._slots.acquire(timeout=self.slot_timeout):
+            self._finish(ticket, False, "in-flight window full")
+            return ticket
+        try:
+            rc, mid = self._publish(topic, payload, qos)
+        except Exception as e:
+            rc, mid = None, None
+            error = str(e)
+        else:
+            queued = rc == _MQTT_ERR_NO_CONN and qos > 0 and mid is not None
+            error = f"publish rc={rc}" if rc != 0 and not queued else None
+        if error is not None or qos == 0:
+            if qos > 0:
+                self._slots.release()
+            self._finish(ticket, error is None, error)
+            return ticket
+
+        ticket.mid = mid
+        with self._lock:
+            acked = self._early.pop(mid, None) is not None
+            if not acked:
+                self._inflight[mid] = ticket
+        if acked:
+            self._slots.release()
+            self._finish(ticket, True, None)
+        return ticket
+
+    def on_publish(self, mid: int) -> None:
+        # network thread của paho; mid không có trong _inflight -> ack tới sớm (hoặc QoS 0)
+        with self._lock:
+            ticket = self._inflight.pop(mid, None)
+            if ticket is None:
+                self._early[mid] = time.monotonic()
+                while len(self._early) > _EARLY_ACKS_MAX:
+                    self._early.popitem(last=False)
+                return
+        self._slots.release()
+        self._finish(ticket, True, None)
+
+    def expire(self) -> int:
+        cutoff = time.monotonic() - self.ack_timeout
+        with self._lock:
+            stale = [mid for mid, t in self._inflight.items() if t.sent_at < cutoff]
+            tickets = [self._inflight.pop(mid) for mid in stale]
+        for ticket in tickets:
+            self._slots.release()
+            self._finish(ticket, False, f"no PUBACK within {self.ack_timeout:g}s")
+        return len(tickets)
+
+    def _reap(self) -> None:
+        interval = max(0.5, self.ack_timeout / 4)
+        while True:
+            time.sleep(interval)
+            try:
+                self.expire()
+            except Exception as e:
+                if self._logger:
+                    self._logger.warning("MQTT ack reaper failed: %s", e)
+
+    def _finish(self, ticket: PublishTicket, ok: bool, error: str | None) -> None:
+        ticket.ok, ticket.error = ok, error
+        try:
+            if ticket.item is not None:
+                self._on_result(ticket.item, ok, error)
+        except Exception as e:
+            if self._logger:
+                self._logger.warning("Publish result handler failed for %r: %s", ticket.item, e)
+        finally:
+            ticket._done.set()
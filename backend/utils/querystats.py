@@ -0,0 +1,142 @@
+import re
+import threading
+import time
+
+from sqlalchemy import event
+
+_WS = re.compile(r"\s+")
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\bIN\s*\((?:\s*\?\s*,)+\s*\?\s*\)", re.IGNORECASE)
+_EXPLAINABLE = ("SELECT", "WITH", "UPDATE", "DELETE")
+
+
+def normalize_sql(sql: str) -> str:
+    # gom các câu lệnh chỉ khác literal / số phần tử IN (...) về cùng một key
+    sql = _WS.sub(" ", sql).strip()
+    sql = _STRING.sub("?", sql)
+    sql = _NUMBER.sub("?", sql)
+    return _IN_LIST.sub("IN (?...)", sql)
+
+
+class _Stat:
+    __slots__ = ("count", "total_ms", "max_ms", "slow", "plan", "full_scans", "last_slow_at")
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.slow = 0
+        self.plan = None
+        self.full_scans = []
+        self.last_slow_at = None
+
+
+class QueryStats:
+    # Hook before/after_cursor_execute của một Engine: đo từng statement, gom theo SQL đã
+    # chuẩn hoá, và với statement chậm hơn threshold_ms thì chụp EXPLAIN (QUERY PLAN) một lần
+    # (chụp lại nếu lần sau chậm hơn). SCAN không dùng index trong plan = gợi ý thiếu index.
+    def __init__(self, threshold_ms: float = 100.0, max_statements: int = 500, logger=None):
+        self.threshold_ms = threshold_ms
+        self.max_statements = max_statements
+        self._logger = logger
+        self._stats: dict[str, _Stat] = {}
+        self._dropped = 0
+        self._lock = threading.Lock()
+
+    def install(self, engine) -> None:
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("query_start")
+        if not starts:
+            return
+        elapsed_ms = (time.perf_counter() - starts.pop()) * 1000
+        key = normalize_sql(statement)
+        slow = elapsed_ms >= self.threshold_ms
+
+        with self._lock:
+            st = self._stats.get(key)
+            if st is None:
+                if len(self._stats) >= self.max_statements:
+                    self._dropped += 1
+                    return
+                st = self._stats[key] = _Stat()
+            st.count += 1
+            st.total_ms += elapsed_ms
+            need_plan = slow and (st.plan is None or elapsed_ms > st.max_ms)
+            st.max_ms = max(st.max_ms, elapsed_ms)
+            if slow:
+                st.slow += 1
+                st.last_slow_at = int(time.time())
+
+        if not slow:
+            return
+        if self._logger:
+            self._logger.warning("Slow query (%.1f ms): %s", elapsed_ms, key)
+        if need_plan and not executemany:
+            plan = self._explain(conn, cursor, statement, parameters)
+            if plan is not None:
+                with self._lock:
+                    st.plan = plan
+                    st.full_scans = [p for p in plan if p.startswith("SCAN ") and "INDEX" not in p]
+
+    def _explain(self, conn, cursor, statement, parameters) -> list[str] | None:
+        if not statement.lstrip().upper().startswith(_EXPLAINABLE):
+            return None
+        sqlite = conn.dialect.name == "sqlite"
+        prefix = "EXPLAIN QUERY PLAN " if sqlite else "EXPLAIN "
+        try:
+            # chạy thẳng trên DBAPI connection -> không kích hoạt lại event của Engine
+            cur = cursor.connection.cursor()
+            try:
+                cur.execute(prefix + statement, parameters or ())
+                rows = cur.fetchall()
+            finally:
+                cur.close()
+        except Exception as e:
+            if self._logger:
+                self._logger.debug("EXPLAIN failed: %s", e)
+            return None
+        # SQLite: (id, parent, notused, detail); dialect khác: một cột text mỗi dòng
+        return [str(r[-1]) if sqlite else " ".join(str(c) for c in r) for r in rows]
+
+    def snapshot(self, limit: int = 50, sort: str = "total", slow_only: bool = False) -> dict:
+        keys = {
+            "total": lambda kv: kv[1].total_ms,
+            "max":   lambda kv: kv[1].max_ms,
+            "count": lambda kv: kv[1].count,
+            "mean":  lambda kv: kv[1].total_ms / kv[1].count,
+            "slow":  lambda kv: kv[1].slow,
+        }
+        if sort not in keys:
+            raise ValueError(f"sort must be one of: {', '.join(keys)}")
+        with self._lock:
+            items = [(k, v) for k, v in self._stats.items() if v.count and (v.slow or not slow_only)]
+            items.sort(key=keys[sort], reverse=True)
+            rows = [{
+                "sql": k,
+                "count": v.count,
+                "total_ms": round(v.total_ms, 3),
+                "mean_ms": round(v.total_ms / v.count, 3),
+                "max_ms": round(v.max_ms, 3),
+                "slow": v.slow,
+                "last_slow_at": v.last_slow_at,
+                "plan": v.plan,
+                "full_scans": v.full_scans,
+            } for k, v in items[:limit]]
+            return {
+                "threshold_ms": self.threshold_ms,
+                "statements": len(self._stats),
+                "dropped": self._dropped,
+                "items": rows,
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+            self._dropped = 0
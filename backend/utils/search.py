@@ -0,0 +1,18 @@
+import re
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+MAX_TERMS = 8
+
+
+def fts_match_query(q: str) -> str | None:
+    # Chuyển text người dùng thành biểu thức MATCH an toàn cho FTS5:
+    # mỗi từ được quote + prefix (*), các từ nối với nhau bằng AND ngầm định
+    terms = _TOKEN_RE.findall(q or "")[:MAX_TERMS]
+    if not terms:
+        return None
+    return " ".join(f'"{t}"*' for t in terms)
+
+
+def like_pattern(q: str) -> str:
+    escaped = (q or "").replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
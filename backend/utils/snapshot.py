@@ -0,0 +1,52 @@
+import threading
+import time
+from typing import Callable
+
+
+class SnapshotCache:
+    # Cache theo tên mục (section) cho các endpoint tổng hợp:
+    # - get(): còn hạn thì trả bản đã lưu; hết hạn / bị invalidate thì chỉ một thread chạy loader,
+    #   các thread khác chờ và dùng chung kết quả (không dồn N query giống nhau khi cache nguội)
+    # - invalidate(): handler ghi dữ liệu gọi ngay sau commit (cùng process)
+    # - ttl giới hạn độ cũ khi bên ghi chạy ở process khác (APP_ROLE=ingest) và không invalidate được
+    def __init__(self, ttl: float = 5.0):
+        self.ttl = ttl
+        self._entries: dict[str, tuple[float, int, object]] = {}
+        self._versions: dict[str, int] = {}
+        self._locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _section_lock(self, name: str) -> threading.Lock:
+        with self._lock:
+            lock = self._locks.get(name)
+            if lock is None:
+                lock = self._locks[name] = threading.Lock()
+            return lock
+
+    def _fresh(self, name: str):
+        entry = self._entries.get(name)
+        if entry is None:
+            return None
+        stored_at, version, value = entry
+        if version != self._versions.get(name, 0) or time.monotonic() - stored_at > self.ttl:
+            return None
+        return entry
+
+    def get(self, name: str, loader: Callable[[], object]):
+        entry = self._fresh(name)
+        if entry is not None:
+            return entry[2]
+        with self._section_lock(name):
+            entry = self._fresh(name)
+            if entry is not None:
+                return entry[2]
+            # version đọc trước khi load: invalidate xảy ra trong lúc load -> kết quả không được dùng lại
+            version = self._versions.get(name, 0)
+            value = loader()
+            self._entries[name] = (time.monotonic(), version, value)
+            return value
+
+    def invalidate(self, *names: str) -> None:
+        with self._lock:
+            for name in names:
+                self._versions[name] = self._versions.get(name, 0) + 1
@@ -0,0 +1,197 @@
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Callable
+
+# Layout file: [header 64B][record][record]...
+#   header: magic, head (offset record cũ nhất chưa replay), tail (offset ghi tiếp theo)
+#   record: body_len u32 | crc32(body) u32 | topic_len u16 | topic | payload
+# Record được ghi trước, tail trong header cập nhật sau -> crash giữa chừng chỉ mất record đang ghi.
+_MAGIC = b"IOTSPL01"
+_HEADER = struct.Struct("<8sQQ")
+_HEADER_SIZE = 64
+_RECORD = struct.Struct("<IIH")
+
+
+class SpoolError(Exception):
+    pass
+
+
+class Spool:
+    # Hàng đợi append-only trên một file mmap kích thước cố định, an toàn cho nhiều thread ghi
+    # và một consumer (peek/pop). Đầy thì compact phần chưa replay về đầu file; vẫn không đủ
+    # chỗ thì append() trả False.
+    def __init__(self, path: str, capacity: int = 16 << 20, sync: bool = True, logger=None):
+        self.path = path
+        self.sync = sync
+        self._logger = logger
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, "r+b" if os.path.exists(path) else "w+b")
+        # một process ghi / replay duy nhất (reloader, worker thứ hai, ingest chạy song song...);
+        # lock tự nhả khi file đóng hoặc process chết
+        try:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._file.close()
+            raise SpoolError(f"{path} is locked by another process") from None
+        size = os.fstat(self._file.fileno()).st_size
+        self.capacity = max(capacity, size)
+        if size < self.capacity:
+            self._file.truncate(self.capacity)
+        self._mm = mmap.mmap(self._file.fileno(), self.capacity)
+
+        magic, head, tail = _HEADER.unpack_from(self._mm, 0)
+        if magic == _MAGIC:
+            self._head, self._tail = head, tail
+        elif magic == b"\0" * len(_MAGIC):
+            self._head = self._tail = _HEADER_SIZE
+            self._write_header()
+        else:
+            raise SpoolError(f"{path} is not a spool file")
+        self._count = self._recover()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _write_header(self) -> None:
+        _HEADER.pack_into(self._mm, 0, _MAGIC, self._head, self._tail)
+
+    def _flush(self) -> None:
+        if self.sync:
+            self._mm.flush()
+
+    def _read(self, offset: int):
+        # -> (topic, payload, next_offset) hoặc None nếu record hỏng / vượt tail
+        if offset + _RECORD.size > self._tail:
+            return None
+        body_len, crc, topic_len = _RECORD.unpack_from(self._mm, offset)
+        start = offset + _RECORD.size
+        end = start + body_len
+        if body_len < topic_len or end > self._tail:
+            return None
+        body = self._mm[start:end]
+        if zlib.crc32(struct.pack("<H", topic_len) + body) != crc:
+            return None
+        return body[:topic_len].decode("utf-8"), body[topic_len:], end
+
+    def _recover(self) -> int:
+        # đếm record hợp lệ từ head; gặp record hỏng thì cắt tail tại đó
+        if not (_HEADER_SIZE <= self._head <= self._tail <= self.capacity):
+            raise SpoolError(f"{self.path}: invalid head/tail {self._head}/{self._tail}")
+        count, offset = 0, self._head
+        while offset < self._tail:
+            rec = self._read(offset)
+            if rec is None:
+                if self._logger:
+                    self._logger.error("Spool %s corrupt at offset %s; dropped %s bytes",
+                                       self.path, offset, self._tail - offset)
+                self._tail = offset
+                self._write_header()
+                self._flush()
+                break
+            count, offset = count + 1, rec[2]
+        return count
+
+    def append(self, topic: str, payload: bytes) -> bool:
+        t = topic.encode("utf-8")
+        body = t + payload
+        need = _RECORD.size + len(body)
+        with self._lock:
+            if self._tail + need > self.capacity:
+                self._compact()
+                if self._tail + need > self.capacity:
+                    return False
+            crc = zlib.crc32(struct.pack("<H", len(t)) + body)
+            _RECORD.pack_into(self._mm, self._tail, len(body), crc, len(t))
+            self._mm[self._tail + _RECORD.size: self._tail + need] = body
+            self._tail += need
+            self._write_header()
+            self._flush()
+            self._count += 1
+            return True
+
+    def _compact(self) -> None:
+        if self._head == _HEADER_SIZE:
+            return
+        live = self._tail - self._head
+        if live:
+            self._mm.move(_HEADER_SIZE, self._head, live)
+        self._head, self._tail = _HEADER_SIZE, _HEADER_SIZE + live
+        self._write_header()
+
+    def peek(self) -> tuple[str, bytes] | None:
+        with self._lock:
+            if self._head >= self._tail:
+                return None
+            rec = self._read(self._head)
+            if rec is None:
+                raise SpoolError(f"{self.path}: corrupt record at offset {self._head}")
+            return rec[0], rec[1]
+
+    def pop(self) -> None:
+        # bỏ record ở head (sau khi consumer đã xử lý xong)
+        with self._lock:
+            rec = self._read(self._head)
+            if rec is None:
+                return
+            self._head = rec[2]
+            if self._head >= self._tail:
+                self._head = self._tail = _HEADER_SIZE
+            self._write_header()
+            self._flush()
+            self._count -= 1
+
+    def close(self) -> None:
+        with self._lock:
+            self._mm.flush()
+            self._mm.close()
+            self._file.close()
+
+
+class SpoolReplayer:
+    # Thread nền: replay(topic, payload) lần lượt từng record theo thứ tự ghi. replay raise
+    # (vd. DB vẫn chưa sẵn sàng) -> giữ nguyên record, thử lại sau retry giây (backoff tới max_retry).
+    def __init__(self, spool: Spool, replay: Callable[[str, bytes], None],
+                 retry: float = 2.0, max_retry: float = 60.0, logger=None):
+        self.spool = spool
+        self.retry = retry
+        self.max_retry = max_retry
+        self._replay = replay
+        self._logger = logger
+        self._wake = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="spool-replayer", daemon=True)
+            self._thread.start()
+
+    def notify(self) -> None:
+        self._wake.set()
+
+    def _run(self) -> None:
+        delay = self.retry
+        while True:
+            rec = self.spool.peek()
+            if rec is None:
+                self._wake.wait(self.retry)
+                self._wake.clear()
+                continue
+            try:
+                self._replay(*rec)
+            except Exception as e:
+                if self._logger:
+                    self._logger.warning("Spool replay failed (%s pending), retrying in %.0fs: %s",
+                                         len(self.spool), delay, e)
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_retry)
+                continue
+            self.spool.pop()
+            delay = self.retry
@@ -0,0 +1,84 @@
+import threading
+import time
+
+# NumPy chỉ được import khi index được dùng lần đầu (như utils.phash)
+
+
+def _np():
+    import numpy as np
+    return np
+
+
+class TimestampIndex:
+    # Mảng int64 timestamp đã sắp xếp (liền kề, tăng dung lượng gấp đôi) cho đếm theo khoảng và
+    # histogram bằng binary search, không cần COUNT(*) trên DB.
+    # Nguồn dữ liệu:
+    # - add(): capture do chính process này ghi (thường tăng dần -> append O(1))
+    # - load(): các row id > watermark đọc từ DB (khởi động, hoặc row do process khác ghi);
+    #   id đã add() cục bộ được bỏ qua để không đếm hai lần
+    def __init__(self):
+        self._ts = None
+        self._n = 0
+        self.watermark = 0              # id lớn nhất đã đọc từ DB
+        self._local: set[int] = set()   # id đã add() nhưng chưa vượt qua watermark
+        self.loaded_at = 0.0            # time.monotonic() của lần load() gần nhất
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._n
+
+    def _insert(self, values) -> None:
+        # values: mảng int64 đã sắp xếp; gọi khi đang giữ lock
+        np = _np()
+        m = len(values)
+        if not m:
+            return
+        need = self._n + m
+        if self._ts is None or need > len(self._ts):
+            grown = np.zeros(max(1024, need, 2 * (len(self._ts) if self._ts is not None else 0)), dtype=np.int64)
+            if self._n:
+                grown[: self._n] = self._ts[: self._n]
+            self._ts = grown
+        cur = self._ts[: self._n]
+        if not self._n or values[0] >= cur[-1]:
+            self._ts[self._n: need] = values
+        else:
+            self._ts[:need] = np.insert(cur, np.searchsorted(cur, values, side="right"), values)
+        self._n = need
+
+    def add(self, capture_id: int, ts: int) -> None:
+        np = _np()
+        with self._lock:
+            if capture_id <= self.watermark or capture_id in self._local:
+                return
+            self._local.add(capture_id)
+            self._insert(np.array([ts], dtype=np.int64))
+
+    def load(self, rows) -> int:
+        # rows: (id, timestamp) với id > watermark -> số timestamp mới được thêm
+        np = _np()
+        with self._lock:
+            fresh = [ts for cid, ts in rows if cid not in self._local and cid > self.watermark]
+            max_id = max((cid for cid, _ in rows), default=self.watermark)
+            self.watermark = max(self.watermark, max_id)
+            self._local = {cid for cid in self._local if cid > self.watermark}
+            self._insert(np.sort(np.asarray(fresh, dtype=np.int64)))
+            self.loaded_at = time.monotonic()
+            return len(fresh)
+
+    def count(self, start: int, end: int) -> int:
+        # số timestamp trong [start, end]
+        np = _np()
+        with self._lock:
+            ts = self._ts[: self._n] if self._n else np.zeros(0, dtype=np.int64)
+            return int(np.searchsorted(ts, end, side="right") - np.searchsorted(ts, start, side="left"))
+
+    def histogram(self, start: int, end: int, bucket: int) -> list[int]:
+        # số timestamp trong từng bucket [start + k*bucket, start + (k+1)*bucket), cắt tại end
+        np = _np()
+        edges = np.arange(start, end + 1, bucket, dtype=np.int64)
+        edges = np.append(edges, end + 1)
+        with self._lock:
+            ts = self._ts[: self._n] if self._n else np.zeros(0, dtype=np.int64)
+            pos = np.searchsorted(ts, edges, side="left")
+        return np.diff(pos).tolist()
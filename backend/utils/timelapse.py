@@ -0,0 +1,51 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator
+
+MJPEG_BOUNDARY = "frame"
+
+
+def prefetch(items: Iterable, fetch: Callable, depth: int = 4, workers: int = 4,
+             on_error: Callable[[object, Exception], None] | None = None) -> Iterator[tuple[object, bytes]]:
+    # Tải trước tối đa `depth` item (theo đúng thứ tự) trong khi item hiện tại đang được gửi đi;
+    # bộ nhớ giới hạn ở depth ảnh. Item lỗi -> on_error rồi bỏ qua.
+    it = iter(items)
+    pending: deque = deque()
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, depth)), thread_name_prefix="timelapse") as pool:
+        try:
+            for item in it:
+                pending.append((item, pool.submit(fetch, item)))
+                if len(pending) >= depth:
+                    break
+            while pending:
+                item, fut = pending.popleft()
+                nxt = next(it, None)
+                if nxt is not None:
+                    pending.append((nxt, pool.submit(fetch, nxt)))
+                try:
+                    data = fut.result()
+                except Exception as e:
+                    if on_error:
+                        on_error(item, e)
+                    continue
+                yield item, data
+        finally:
+            # client ngắt kết nối giữa chừng -> huỷ các lượt tải chưa chạy
+            for _, fut in pending:
+                fut.cancel()
+
+
+def mjpeg_stream(frames: Iterable[bytes], fps: float, boundary: str = MJPEG_BOUNDARY) -> Iterator[bytes]:
+    # multipart/x-mixed-replace: mỗi part là một JPEG; giãn nhịp theo fps (frame tới muộn thì
+    # phát ngay, không cố bù)
+    interval = 1.0 / fps if fps > 0 else 0.0
+    due = time.monotonic()
+    for data in frames:
+        now = time.monotonic()
+        if due > now:
+            time.sleep(due - now)
+        due = max(due, now) + interval
+        yield (
+            f"--{boundary}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(data)}\r\n\r\n"
+        ).encode("ascii") + data + b"\r\n"
@@ -0,0 +1,138 @@
+import heapq
+import itertools
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Hashable
+
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+
+class TimerHeap:
+    # Min-heap (due, seq, key) + một thread chỉ thức dậy ở deadline gần nhất:
+    # schedule() O(log n), cancel() O(1) (xoá lười: entry cũ bị bỏ qua khi tới đỉnh heap).
+    # schedule() lại cùng key thay deadline cũ. fire(key) chạy trên thread của heap, ngoài lock.
+    def __init__(self, fire: Callable[[Hashable], None], logger=None, max_sleep: float = 60.0):
+        self._fire = fire
+        self._logger = logger
+        self._max_sleep = max_sleep          # thức định kỳ để theo kịp khi đồng hồ hệ thống nhảy
+        self._heap: list[tuple[float, int, Hashable]] = []
+        self._live: dict[Hashable, int] = {}  # key -> seq của entry còn hiệu lực
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stop = False
+        self._thread: threading.Thread | None = None
+
+    def __len__(self) -> int:
+        return len(self._live)
+
+    def schedule(self, key: Hashable, due: float) -> None:
+        with self._cond:
+            seq = next(self._seq)
+            self._live[key] = seq
+            heapq.heappush(self._heap, (due, seq, key))
+            if len(self._heap) > 2 * len(self._live) + 64:
+                self._compact()
+            if self._heap[0][1] == seq:
+                self._cond.notify()
+
+    def cancel(self, key: Hashable) -> None:
+        with self._cond:
+            self._live.pop(key, None)
+
+    def next_due(self) -> float | None:
+        with self._cond:
+            self._drop_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def _compact(self) -> None:
+        self._heap = [e for e in self._heap if self._live.get(e[2]) == e[1]]
+        heapq.heapify(self._heap)
+
+    def _drop_stale(self) -> None:
+        while self._heap and self._live.get(self._heap[0][2]) != self._heap[0][1]:
+            heapq.heappop(self._heap)
+
+    def _next_ready(self) -> Hashable | None:
+        with self._cond:
+            while not self._stop:
+                self._drop_stale()
+                if not self._heap:
+                    self._cond.wait(self._max_sleep)
+                    continue
+                delay = self._heap[0][0] - time.time()
+                if delay <= 0:
+                    _, _, key = heapq.heappop(self._heap)
+                    del self._live[key]
+                    return key
+                self._cond.wait(min(delay, self._max_sleep))
+            return None
+
+    def _run(self) -> None:
+        while True:
+            key = self._next_ready()
+            if key is None:
+                return
+            try:
+                self._fire(key)
+            except Exception:
+                if self._logger:
+                    self._logger.exception("Timer %r failed", key)
+
+    def start(self) -> None:
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="timer-heap", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+
+
+def parse_time_of_day(text: str) -> int:
+    # "08:00" / "8:30:15" -> giây tính từ nửa đêm
+    try:
+        parts = [int(p) for p in text.split(":")]
+    except ValueError:
+        raise ValueError("time must be HH:MM[:SS]") from None
+    if not 2 <= len(parts) <= 3:
+        raise ValueError("time must be HH:MM[:SS]")
+    h, m, sec = (parts + [0])[:3]
+    if not (0 <= h < 24 and 0 <= m < 60 and 0 <= sec < 60):
+        raise ValueError("time out of range")
+    return h * 3600 + m * 60 + sec
+
+
+def weekday_mask(days) -> int:
+    # ["mon", "fri"] hoặc [0, 4] (0 = thứ Hai) -> bitmask
+    mask = 0
+    for d in days:
+        if isinstance(d, str) and d.lower()[:3] in WEEKDAYS:
+            idx = WEEKDAYS.index(d.lower()[:3])
+        elif isinstance(d, int) and not isinstance(d, bool):
+            idx = d
+        else:
+            raise ValueError("weekdays must be names (mon..sun) or numbers 0-6")
+        if not 0 <= idx < 7:
+            raise ValueError("weekday out of range")
+        mask |= 1 << idx
+    if not mask:
+        raise ValueError("at least one weekday is required")
+    return mask
+
+
+def next_weekly(after: float, mask: int, time_of_day: int, tz) -> int:
+    # lần chạy kế tiếp > after, theo giờ địa phương của tz (DST-safe: dựng lại datetime mỗi ngày)
+    local = datetime.fromtimestamp(after, tz)
+    for offset in range(8):
+        day = (local + timedelta(days=offset)).date()
+        if not mask & (1 << day.weekday()):
+            continue
+        candidate = datetime(day.year, day.month, day.day, tzinfo=tz) + timedelta(seconds=time_of_day)
+        ts = int(candidate.timestamp())
+        if ts > after:
+            return ts
+    raise ValueError("empty weekday mask")
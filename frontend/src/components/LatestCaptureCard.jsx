@@ -2,10 +2,10 @@
 import React, { useEffect, useMemo, useState } from 'react';
 import { getLatestCapture } from '../services/api';
 
-export default function LatestCaptureCard({ title = 'Latest Camera Capture', pollMs = 5000 }) {
-  const [imgUrl, setImgUrl] = useState(null);
-  const [timestamp, setTimestamp] = useState(null);
-  const [loading, setLoading] = useState(true);
+export default function LatestCaptureCard({ title = 'Latest Camera Capture', pollMs = 5000, initial }) {
+  const [imgUrl, setImgUrl] = useState(initial?.url ?? null);
+  const [timestamp, setTimestamp] = useState(initial?.timestamp ?? null);
+  const [loading, setLoading] = useState(initial === undefined);
   const [err, setErr] = useState(null);
   const [autoRefresh, setAutoRefresh] = useState(true);
   const [intervalMs, setIntervalMs] = useState(pollMs);
@@ -28,7 +28,15 @@ export default function LatestCaptureCard({ title = 'Latest Camera Capture', pol
     }
   };
 
-  useEffect(() => { fetchLatest(); }, []);
+  // initial (từ /api/dashboard) -> bỏ qua lần fetch đầu
+  useEffect(() => {
+    if (initial === undefined) fetchLatest();
+    else {
+      setImgUrl(initial?.url ?? null);
+      setTimestamp(initial?.timestamp ?? null);
+      setLoading(false);
+    }
+  }, [initial]);
   useEffect(() => {
     if (!autoRefresh) return;
     const id = setInterval(fetchLatest, intervalMs);
@@ -1,17 +1,31 @@
-import React, { useState } from 'react';
+import React, { useEffect, useState } from 'react';
 import LatestCaptureCard from '../components/LatestCaptureCard';
 import BigToggle from '../components/BigToggle';
-import { openDoor, closeDoor, registerFingerprint } from '../services/api';
+import { openDoor, closeDoor, registerFingerprint, getDashboard } from '../services/api';
 import ChatWidget from '../components/ChatWidget';
 import DisplayControl from '../components/DisplayControl';
 
 
 const sleep = (ms) => new Promise((r) => setTimeout(r, ms));
 
+// online theo presence / heartbeat của thiết bị (DeviceStateStore), không phải kết nối MQTT của server
+const anyDeviceOnline = (devices) => Object.values(devices || {}).some((d) => d.online);
+
 export default function Dashboard() {
   const [doorOpen, setDoorOpen]   = useState(false);
   const [cooldown, setCooldown]   = useState(false);
   const [error, setError]         = useState('');
+  const [snapshot, setSnapshot]   = useState(null);   // null: đang tải, false: lỗi -> card tự fetch
+
+  // Lần vẽ đầu: một request /api/dashboard thay cho nhiều call riêng lẻ
+  useEffect(() => {
+    getDashboard()
+      .then(({ data }) => {
+        setSnapshot(data);
+        setDoorOpen(data.device?.door === 'open');
+      })
+      .catch(() => setSnapshot(false));
+  }, []);
 
   
   const flipDoor = async () => {
@@ -35,7 +49,13 @@ export default function Dashboard() {
 
         <div className="row g-4">
           <div className="col-12 col-lg-8">
-            <LatestCaptureCard />
+            {snapshot === null ? (
+              <div className="card shadow-sm d-flex align-items-center justify-content-center" style={{ height: 420 }}>
+                <div className="spinner-border" role="status" aria-label="Loading" />
+              </div>
+            ) : (
+              <LatestCaptureCard initial={snapshot ? snapshot.latest_capture : undefined} />
+            )}
           </div>
 
           <div className="col-12 col-lg-4">
@@ -59,6 +79,41 @@ export default function Dashboard() {
                 <small className="text-muted d-block mt-2">wait&nbsp;3&nbsp;s…</small>
               )}
             </div>
+            {snapshot && (
+              <div className="card shadow-sm p-4 mb-4">
+                <h5 className="mb-3">Overview</h5>
+                <div className="small">
+                  <div>
+                    Last opened by:{' '}
+                    <strong>{snapshot.last_open ? snapshot.last_open.username : '-'}</strong>
+                    {snapshot.last_open && (
+                      <span className="text-muted">
+                        {' '}({snapshot.last_open.source}, {new Date(snapshot.last_open.created_at * 1000).toLocaleString()})
+                      </span>
+                    )}
+                  </div>
+                  <div>
+                    Fingerprints: <strong>{snapshot.fingerprints.count}</strong> / {snapshot.fingerprints.capacity}
+                  </div>
+                  <div>
+                    Device:{' '}
+                    <span className={anyDeviceOnline(snapshot.devices) ? 'text-success' : 'text-danger'}>
+                      {anyDeviceOnline(snapshot.devices) ? 'online' : 'offline'}
+                    </span>
+                  </div>
+                </div>
+                {snapshot.commands.length > 0 && (
+                  <ul className="list-unstyled small mt-3 mb-0">
+                    {snapshot.commands.map((c) => (
+                      <li key={c.id} className="d-flex justify-content-between">
+                        <span>{c.command_type} · {c.username || c.user_id}</span>
+                        <span className="text-muted">{c.status}</span>
+                      </li>
+                    ))}
+                  </ul>
+                )}
+              </div>
+            )}
             {/* DisplayControl dưới Door Control */}
             <DisplayControl />
           </div>
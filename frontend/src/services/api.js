@@ -68,6 +68,65 @@ export function getCaptures({ start, end, limit = 30, offset = 0, order = 'desc'
   });
 }
 
+// returns { items: [{ bucket_start, count, capture }], bucket_seconds, ... }
+export function getCaptureTimeline({ start, end, bucket = 5 }) {
+  return API.get('/api/captures/timeline', {
+    params: { start, end, bucket },
+  });
+}
+
+// returns { counts: [...], bucket_seconds, total } — bucket tính bằng giây
+export function getCaptureHistogram({ start, end, bucket = 300 }) {
+  return API.get('/api/captures/histogram', {
+    params: { start, end, bucket },
+  });
+}
+
+// MJPEG stream; dùng trực tiếp làm src của <img>
+export function getCaptureTimelapseUrl({ start, end, fps = 5, size = 'full', skip_duplicates = 0 }) {
+  const params = new URLSearchParams({ start, end, fps, size, skip_duplicates });
+  return `${import.meta.env.VITE_API_URL}/api/captures/timelapse?${params}`;
+}
+
+// ─── Activity ────────────────────────────────────
+// params: { limit, cursor, sources: 'command,log,capture', user_id }
+// returns { items: [{ type, id, created_at, ... }], next_cursor }
+export function getActivity(params = {}) {
+  return API.get('/api/activity', { params });
+}
+
+// latest capture, last opener, fingerprint count/capacity, recent commands, device state
+export function getDashboard() {
+  return API.get('/api/dashboard');
+}
+
+export function getDevicesState() {
+  return API.get('/api/devices/state');
+}
+
+// ─── Schedules ────────────────────────────────────────
+// body: { command: 'servo.open'|'servo.close'|'lcd.set', message?, delay | at | every | weekly: { days, time } }
+export function getSchedules() {
+  return API.get('/api/schedules');
+}
+
+export function createSchedule(body) {
+  return API.post('/api/schedules', body);
+}
+
+export function deleteSchedule(id) {
+  return API.delete(`/api/schedules/${id}`);
+}
+
+// ─── Logs ────────────────────────────────────────
+// filters: { log_type, start, end, command_id, user_id, q, limit, offset, order }
+export function getLogs(params = {}) {
+  return API.get('/api/logs', {
+    params,
+    headers: { 'Cache-Control': 'no-cache' },
+  });
+}
+
 // ─── Servo control ────────────────────────────────────────
 export function sendServoCommand(action) {
   return API.post('/api/servo', { action });
@@ -91,6 +150,15 @@ export function deleteFingerprint(id) {
   return API.delete(`/api/fingerprints/${id}`); 
 }
 
+// body: { action: 'enroll', count } | { action: 'delete', ids | user_id | all }
+export function batchFingerprints(body) {
+  return API.post('/api/fingerprints/batch', body);
+}
+
+export function getFingerprintBatch(id) {
+  return API.get(`/api/fingerprints/batch/${id}`);
+}
+
 // ─── Set webhook ────────────────────────────────────────
 export const updateWebhook = (data) => {
   console.log("SENDING WEBHOOK:", data);